@@ -5,7 +5,8 @@ from designsafe.apps.api.agave.filemanager.base import BaseFileManager
 from designsafe.apps.data.models.agave.files import (BaseFileResource,
                                                     BaseFilePermissionResource,
                                                     BaseAgaveFileHistoryRecord)
-from designsafe.apps.api.tasks import reindex_agave
+from designsafe.apps.data.managers.reindex_queue import ReindexQueue
+from designsafe.apps.data.managers.elasticsearch import FileManager as ESFileManager
 from requests import HTTPError
 import logging
 
@@ -54,9 +55,7 @@ class AgaveFileManager(BaseFileManager):
         f = BaseFileResource.listing(self._ag, system, file_path)
         res = f.import_data(from_system, from_file_path)
         file_name = from_file_path.split('/')[-1]
-        reindex_agave.apply_async(kwargs={'username': 'ds_admin',
-                                          'file_id': '{}/{}'.format(system, os.path.join(file_path, file_name))},
-                                  queue='indexing')
+        ReindexQueue().request(system, os.path.join(file_path, file_name))
         return res
 
     def copy(self, system, file_path, dest_path=None, dest_name=None):
@@ -77,19 +76,14 @@ class AgaveFileManager(BaseFileManager):
         copied_file = f.copy(dest_path, dest_name)
 
         # schedule celery task to index new copy
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}/{}'.format(system, dest_path.strip('/'), dest_name)},
-                                  queue='indexing')
+        ReindexQueue().request(system, os.path.join(dest_path.strip('/'), dest_name))
 
         return copied_file
 
     def delete(self, system, path):
         resp = BaseFileResource(self._ag, system, path).delete()
         parent_path = '/'.join(path.strip('/').split('/')[:-1])
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, parent_path),
-                                            'levels': 1}, 
-                                            queue='indexing')
+        ReindexQueue().request(system, parent_path, levels=1)
         return resp
 
     def download(self, system, path):
@@ -103,8 +97,47 @@ class AgaveFileManager(BaseFileManager):
     # def index(self):
     #     pass
 
-    def listing(self, system, file_path, offset=0, limit=100, **kwargs):
-        return BaseFileResource.listing(self._ag, system, file_path, offset, limit)
+    def listing(self, system, file_path, offset=0, limit=100, sort='name',
+                username=None, **kwargs):
+        """Lists a file.
+
+        Children are listed by Agave in name order. Sorted by size, largest
+        first, they are read from the files index instead, see
+        :meth:`~designsafe.apps.data.managers.elasticsearch.FileManager.listing`.
+
+        :param str system: system id
+        :param str file_path: path to list
+        :param int offset: offset of the first child
+        :param int limit: number of children
+        :param str sort: `'name'` or `'size'`
+        :param str username: username making the request, the children
+            sorted by size are filtered on its permissions
+
+        :rtype: :class:`BaseFileResource`
+        """
+        if sort != 'size':
+            return BaseFileResource.listing(self._ag, system, file_path, offset, limit)
+
+        listing = BaseFileResource.listing(self._ag, system, file_path, limit=1)
+        if listing.type != 'dir':
+            return listing
+        res, _ = ESFileManager(username).listing(system, file_path.strip('/') or '/',
+                                                 sort='size', offset=offset,
+                                                 limit=limit)
+        listing.children = [BaseFileResource(self._ag, **self._indexed_file(hit))
+                            for hit in res]
+        return listing
+
+    @staticmethod
+    def _indexed_file(hit):
+        """Maps a files index document to the fields of an Agave listing"""
+        doc = hit.to_dict()
+        fields = dict((key, doc[key]) for key in
+                      ('name', 'system', 'format', 'type', 'length', 'mimeType',
+                       'lastModified', 'totalLength', 'descendantCount')
+                      if key in doc)
+        fields['path'] = '/' + os.path.join(doc['path'], doc['name']).strip('/')
+        return fields
 
     def list_permissions(self, system, file_path):
         f = BaseFileResource(self._ag, system, file_path)
@@ -113,34 +146,57 @@ class AgaveFileManager(BaseFileManager):
     def mkdir(self, system, file_path, dir_name):
         f = BaseFileResource(self._ag, system, file_path)
         resp = f.mkdir(dir_name)
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, file_path)},
-                                            queue='indexing')
+        ReindexQueue().request(system, file_path)
         return resp
 
+    @staticmethod
+    def _move_documents(system, file_path, dest_path, link=None):
+        """Moves the documents of a file which was moved in Agave.
+
+        The file is already moved when this is called, a failure to move
+        its documents must not fail the request. It is logged and the
+        whole destination is queued for a reindex instead. The documents
+        left under `file_path` are removed when its parent is reindexed.
+
+        :param str system: system id
+        :param str file_path: path the file was moved from
+        :param str dest_path: path the file was moved to
+        :param link: celery signature to run once the descendants are moved
+
+        :returns: the task moving the descendants, see
+            :meth:`~designsafe.apps.data.managers.elasticsearch.FileManager.move`
+        """
+        try:
+            return ESFileManager('ds_admin').move(system, file_path, dest_path,
+                                                  link=link)
+        except Exception:
+            logger.exception(u'Could not move the documents of %s/%s to %s',
+                             system, file_path, dest_path)
+            ReindexQueue().request(system, dest_path, levels=0)
+            return None
+
     def move(self, system, file_path, dest_path, dest_name=None):
         f = BaseFileResource.listing(self._ag, system, file_path)
         resp = f.move(dest_path, dest_name)
+        moved_path = os.path.join(dest_path, resp.name)
+        # A folder is reindexed once its descendants' documents are moved.
+        task = self._move_documents(
+            system, file_path, moved_path,
+            link=ReindexQueue.signature(system, moved_path, levels=1))
         parent_path = '/'.join(file_path.strip('/').split('/')[:-1])
         parent_path = parent_path.strip('/') or '/'
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, parent_path),
-                                            'levels': 1},
-                                            queue='indexing')
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, os.path.join(dest_path, resp.name)),
-                                            'levels': 1},
-                                            queue='indexing')
+        ReindexQueue().request(system, parent_path, levels=1)
+        if task is None:
+            ReindexQueue().request(system, moved_path, levels=1)
         return resp
 
     def rename(self, system, file_path, rename_to):
         f = BaseFileResource.listing(self._ag, system, file_path)
         resp = f.rename(rename_to)
         parent_path = '/'.join(file_path.strip('/').split('/')[:-1])
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, parent_path),
-                                            'levels': 1},
-                                            queue='indexing')
+        self._move_documents(system, file_path,
+                             os.path.join(parent_path, rename_to))
+        ReindexQueue().request(system, parent_path, levels=1)
         return resp
 
     def share(self, system, file_path, username, permission):
@@ -150,9 +206,7 @@ class AgaveFileManager(BaseFileManager):
         pem.username = username
         pem.permission_bit = permission
         resp = pem.save()
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, file_path)},
-                                            queue='indexing')
+        ReindexQueue().request(system, file_path)
         return resp
 
     def trash(self, system, file_path, trash_path):
@@ -177,23 +231,15 @@ class AgaveFileManager(BaseFileManager):
                 raise
 
         resp = f.move(trash_path, name)
+        self._move_documents(system, file_path, os.path.join(trash_path, name))
         parent_path = '/'.join(file_path.strip('/').split('/')[:-1])
         parent_path = parent_path.strip('/') or '/'
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, trash_path),
-                                            'levels': 1},
-                                            queue='indexing')
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, parent_path),
-                                            'levels': 1},
-                                            queue='indexing')
+        ReindexQueue().request(system, trash_path, levels=1)
+        ReindexQueue().request(system, parent_path, levels=1)
         return resp
 
     def upload(self, system, file_path, upload_file):
         f = BaseFileResource(self._ag, system, file_path)
         resp = f.upload(upload_file)
-        reindex_agave.apply_async(kwargs = {'username': 'ds_admin',
-                                            'file_id': '{}/{}'.format(system, file_path),
-                                            'levels': 1},
-                                            queue='indexing')
+        ReindexQueue().request(system, file_path, levels=1)
         return resp
@@ -13,6 +13,7 @@ import os
 import re
 import datetime
 import itertools
+import six
 from django.conf import settings
 from elasticsearch import TransportError, ConnectionTimeout
 from elasticsearch_dsl import Search, DocType
@@ -20,11 +21,32 @@ from elasticsearch_dsl.query import Q
 from elasticsearch_dsl.connections import connections
 from .base import BaseFileManager
 from designsafe.apps.api.agave.filemanager.agave import  AgaveFileManager
+from designsafe.libs.elasticsearch.cache import SearchCache, bump_generation
+from designsafe.libs.elasticsearch.cursor import paginate
+from designsafe.libs.elasticsearch.projections import (apply_projection,
+                                                       source_filter,
+                                                       merge_filters,
+                                                       LISTING, SEARCH, DETAIL)
 
 logger = logging.getLogger(__name__)
 
 
+#: Fields of a publication read by :meth:`Publication.to_file`.
+PUBLICATION_FILE_FIELDS = ['created', 'projectId', 'status', 'users',
+                           'project.value.pi', 'project.value.projectId',
+                           'project.value.projectType', 'project.value.title']
+
+
 class PublicationIndexed(DocType):
+    #: `_source` projections, the experiment and project trees are
+    #: only fetched by `detail`.
+    SOURCE_PRESETS = {
+        LISTING: {'include': PUBLICATION_FILE_FIELDS},
+        SEARCH: {'include': PUBLICATION_FILE_FIELDS +
+                            ['doi', 'project.value.description']},
+        DETAIL: None
+    }
+
     class Meta:
         index = settings.ES_INDICES['publications']['name']
         doc_type = settings.ES_INDICES['publications']['documents'][0]['name']
@@ -84,10 +106,15 @@ class Publication(object):
             self._wrap = PublicationIndexed()
 
     @classmethod
-    def listing(cls, status='published'):
-        list_search = PublicSearchManager(cls,
-                                          PublicationIndexed.search(),
-                                          page_size=100)
+    def listing(cls, status='published', projection=None):
+        """Returns the publications with a status, newest first.
+
+        :param str projection: one of :attr:`PublicationIndexed.SOURCE_PRESETS`
+        :raises ValueError: if `projection` is not valid
+        """
+        search = apply_projection(PublicationIndexed.search(),
+                                  PublicationIndexed.SOURCE_PRESETS, projection)
+        list_search = PublicSearchManager(cls, search, page_size=100)
         list_search._search.query = Q(
             "bool",
             must=[
@@ -104,6 +131,7 @@ class Publication(object):
 
     def save(self, **kwargs):
         self._wrap.save(**kwargs)
+        bump_generation(self._wrap._doc_type.index)
         return self
 
     def to_dict(self):
@@ -172,11 +200,81 @@ class Publication(object):
         else:
             raise AttributeError('\'Publication\' has no attribute \'{}\''.format(name))
 
+#: Fields of a NEES publication read by :meth:`LegacyPublication.to_file`.
+LEGACY_PUBLICATION_FILE_FIELDS = ['deleted', 'description', 'endDate',
+                                  'experiments', 'facility', 'name',
+                                  'organization', 'path', 'pis', 'project',
+                                  'projectPath', 'publications', 'sponsor',
+                                  'startDate', 'system', 'title']
+
+
 class LegacyPublicationIndexed(DocType):
+   SOURCE_PRESETS = {
+       LISTING: {'include': LEGACY_PUBLICATION_FILE_FIELDS},
+       SEARCH: {'include': ['description', 'endDate', 'name', 'path', 'project',
+                            'startDate', 'system', 'title']},
+       DETAIL: None
+   }
+
    class Meta:
         index = settings.ES_INDICES['publications_legacy']['name']
         doc_type = settings.ES_INDICES['publications_legacy']['documents'][0]['name'] 
 
+#: Publication indices searched together, by source name.
+PUBLICATION_SOURCES = {
+    'designsafe': PublicationIndexed,
+    'nees': LegacyPublicationIndexed
+}
+
+
+def _publication_hit(hit):
+    for doc_class in PUBLICATION_SOURCES.values():
+        if hit['_index'] == doc_class._doc_type.index:
+            return doc_class.from_es(hit)
+    return LegacyPublicationIndexed.from_es(hit)
+
+
+def publication_search(query_string, projection=None):
+    """Returns one search over the DesignSafe and NEES publications.
+
+    Both indices are queried in the same request so ES merges the hits by
+    score. Hits are :class:`PublicationIndexed` or
+    :class:`LegacyPublicationIndexed` depending on their index, and
+    the `sources` aggregation counts the hits of every index.
+
+    :param str query_string: user's query
+    :param str projection: preset of both indices' `SOURCE_PRESETS`,
+        the fields of both presets are fetched
+
+    :raises ValueError: if `projection` is not valid
+    """
+    doc_types = dict((doc_class._doc_type.name, _publication_hit)
+                     for doc_class in PUBLICATION_SOURCES.values())
+    search = Search(index=[doc_class._doc_type.index
+                           for doc_class in PUBLICATION_SOURCES.values()])\
+        .doc_type(**doc_types)\
+        .query(Q('bool', must=[Q('query_string', query=query_string)]))
+    search.aggs.bucket('sources', 'terms', field='_index',
+                       size=len(PUBLICATION_SOURCES))
+    _filter = merge_filters(*[source_filter(doc_class.SOURCE_PRESETS, projection)
+                              for doc_class in PUBLICATION_SOURCES.values()])
+    if _filter is not None:
+        search = search.source(**_filter)
+    return search
+
+
+def publication_totals(res):
+    """Returns the number of hits of every source of a
+    :func:`publication_search` response.
+
+    :rtype: dict
+    """
+    counts = dict((bucket.key, bucket.doc_count)
+                  for bucket in res.aggregations.sources.buckets)
+    return dict((source, counts.get(doc_class._doc_type.index, 0))
+                for source, doc_class in six.iteritems(PUBLICATION_SOURCES))
+
+
 class LegacyPublication(object):
     def __init__(self, wrap=None, project_id=None, *args, **kwargs):
         if wrap is not None:
@@ -184,11 +282,23 @@ class LegacyPublication(object):
                 self._wrap = wrap
 
     @classmethod
-    def listing(cls, offset, limit):
-        list_search = PublicSearchManager(cls, LegacyPublicationIndexed.search(), page_size=limit)
+    def listing(cls, offset, limit, cursor=None, projection=None):
+        """Returns a page of NEES publications.
+
+        :param str projection: one of
+            :attr:`LegacyPublicationIndexed.SOURCE_PRESETS`
+
+        :returns: `(publications, next_cursor)`
+        :raises ValueError: if `cursor` or `projection` is not valid
+        """
+        search = apply_projection(LegacyPublicationIndexed.search(),
+                                  LegacyPublicationIndexed.SOURCE_PRESETS,
+                                  projection)
+        list_search = PublicSearchManager(cls, search, page_size=limit)
         # list_search._search.query = Q(None)
         list_search.sort({'project._exact': 'asc'})
-        return list_search.results(offset)
+        publications = list_search.results(offset, cursor=cursor)
+        return publications, list_search.cursor
 
     def to_file(self):
         publication_dict = self._wrap.to_dict()
@@ -270,6 +380,9 @@ class PublicSearchManager(object):
         self._doc_class = doc_class
         self._search = search
         self._page_size = page_size
+        self._sort = []
+        #: Cursor of the page after the last one returned by :meth:`results`
+        self.cursor = None
 
     def count(self):
         return self._search.count()
@@ -283,51 +396,59 @@ class PublicSearchManager(object):
         return self._search
 
     def sort(self, *keys):
+        self._sort = list(keys)
         self._search = self._search.sort(*keys)
         return self
 
+    def _page(self, cursor=None):
+        """Returns `(search, next_cursor)` of a page sorted on the
+        manager's sort keys and `_uid`, see
+        :func:`~designsafe.libs.elasticsearch.cursor.paginate`."""
+        return paginate(self._search, self._sort + ['_uid'], self._page_size, cursor)
+
     def execute(self):
+        cache = SearchCache('public_listing')
         try:
-            res = self._search.execute()
+            res = cache.execute(self._search)
         except (TransportError, ConnectionTimeout) as err:
             if getattr(err, 'status_code', 500) == 404:
                 raise
-            res = self._search.execute()
+            res = cache.execute(self._search)
 
         return res
 
     def all(self):
-        res = self._search.execute()
-        if res.success() and res.hits.total:
-            res_offset = 0
-            page_size = len(res)
-            res_limit = page_size
-            while res_limit <= res.hits.total:
-                for doc in self._search[res_offset:res_limit]:
-                    yield self._doc_class(doc)
-
-                res_limit += page_size
-                res_offset += page_size
-
-            res_limit = res.hits.total - ((res.hits.total / page_size) * page_size)
-            if res_limit > 0:
-                res_offset -= page_size
-                res_limit += res_offset
-                for doc in self._search[res_offset:res_limit]:
-                    yield self._doc_class(doc)
-
-    def results(self, offset):
-        res = self._search.execute()
-        limit = offset + self._page_size
-        if res.hits.total < limit:
-            limit = res.hits.total
-
-        if offset > limit:
-            offset = 0
-            limit = 0
-
-        for doc in self._search[offset:limit]:
-            yield self._doc_class(doc)
+        """Yields every document, one page at a time.
+
+        Pages are read with `search_after` so every page costs one request
+        and reading is not limited by `index.max_result_window`.
+        """
+        cursor = None
+        while True:
+            search, next_cursor = self._page(cursor)
+            res = search.execute()
+            for doc in res:
+                yield self._doc_class(doc)
+            cursor = next_cursor(res)
+            if cursor is None:
+                break
+
+    def results(self, offset, cursor=None):
+        """Returns a page of documents.
+
+        The cursor of the next page is set on :attr:`cursor`.
+
+        :param int offset: offset of the first document, without `cursor`
+        :param str cursor: cursor of the previous page
+
+        :raises ValueError: if `cursor` is not valid
+        """
+        search, next_cursor = self._page(cursor)
+        if offset and not cursor:
+            search = search.extra(**{'from': offset})
+        res = SearchCache('public_listing').execute(search)
+        self.cursor = next_cursor(res)
+        return (self._doc_class(doc) for doc in res)
 
     def __iter__(self):
         for doc in self._search.execute():
@@ -351,10 +472,11 @@ class PublicSearchManager(object):
 
 
 class PublicDocumentListing(object):
-    def __init__(self, listing_iterator, system, path):
+    def __init__(self, listing_iterator, system, path, cursor=None):
         self._listing_iterator = listing_iterator
         self.system = system
         self.path = path
+        self.cursor = cursor
 
     def to_dict(self):
         # logger.debug(self._doc.to_dict())
@@ -362,6 +484,7 @@ class PublicDocumentListing(object):
         obj_dict['system'] = self.system
         obj_dict['path'] = self.path
         obj_dict['children'] = [doc.to_file() for doc in self._listing_iterator]
+        obj_dict['cursor'] = self.cursor
         return dict(obj_dict)
 
 
@@ -376,21 +499,32 @@ class PublicElasticFileManager(BaseFileManager):
         self._ag = ag
         super(PublicElasticFileManager, self).__init__()
 
-    def listing(self, system, file_path, offset=0, limit=100, status='published'):
+    def listing(self, system, file_path, offset=0, limit=100, status='published',
+                cursor=None, projection=LISTING):
+        """Lists published projects, or a project's files.
+
+        NEES publications are paged with `search_after` when `cursor` is
+        given, the cursor of the next page is returned in the listing.
+
+        :param str projection: `_source` preset of the publications
+        :raises ValueError: if `cursor` or `projection` is not valid
+        """
         file_path = file_path or '/'
         logger.debug('file_path: %s', file_path)
         if file_path == '/':
             # listing = PublicObject.listing(system, file_path,
             #                                offset=offset, limit=limit)
-            publications = Publication.listing(status)
-            legacy_publications = LegacyPublication.listing(offset, limit)
+            legacy_publications, next_cursor = LegacyPublication.listing(
+                offset, limit, cursor=cursor, projection=projection)
 
             # show new publications on top; don't re-display when scrolling down
-            if offset == 0: 
+            if offset == 0 and not cursor:
+                publications = Publication.listing(status, projection=projection)
                 listing_iterator = itertools.chain(publications, legacy_publications)
             else:
                 listing_iterator = legacy_publications
-            listing = PublicDocumentListing(listing_iterator, system, file_path)
+            listing = PublicDocumentListing(listing_iterator, system, file_path,
+                                            cursor=next_cursor)
         else:
             fmgr = AgaveFileManager(self._ag)
             listing = fmgr.listing(system, file_path, offset, limit, status=status)
@@ -410,30 +544,38 @@ class PublicElasticFileManager(BaseFileManager):
         return listing
 
     def search(self, system, query_string,
-               file_path=None, offset=0, limit=100, sort=None, status='published'):
-        files_limit = limit
-        files_offset = offset
-        projects_limit = limit
-        projects_offset = offset
-
-
-        nees_published_query = Q('bool', must=[Q('query_string', query=query_string)])
-        nees_published_search = LegacyPublicationIndexed.search()\
-            .query(nees_published_query)\
-            .extra(from_=offset, size=limit)
-        des_published_query = Q('bool', must=[Q('query_string', query=query_string)])
-        des_published_search = PublicationIndexed.search()\
-            .query(des_published_query)\
-            .extra(from_=offset, size=limit)
-
-        nees_published_res = nees_published_search.execute()
-        des_published_res = des_published_search.execute()
-
-        logger.debug(nees_published_res.hits.total)
-
-        children = [Publication(res).to_file() for res in des_published_res]
-        children += [LegacyPublication(res).to_file() for res in nees_published_res]
-        
+               file_path=None, offset=0, limit=100, sort=None, status='published',
+               cursor=None):
+        """Searches DesignSafe and NEES publications.
+
+        Hits of both sources are merged by score, see
+        :func:`publication_search`. Pages are read with `search_after`
+        when `cursor` is given, `offset` is only used without a cursor.
+        Hits are rendered as listing entries, so only the fields of the
+        `listing` projection are fetched.
+
+        :param str system: system id
+        :param str query_string: user's query
+        :param int offset: offset of the first hit, without `cursor`
+        :param int limit: page size
+        :param str cursor: cursor returned with the previous page
+
+        :raises ValueError: if `cursor` is not valid
+        """
+        search, next_cursor = paginate(publication_search(query_string, LISTING),
+                                       ['_score', {'_uid': 'asc'}],
+                                       limit, cursor)
+        if not cursor and offset:
+            search = search.extra(from_=offset)
+
+        res = SearchCache('public_search').execute(search)
+        children = []
+        for hit in res:
+            if isinstance(hit, PublicationIndexed):
+                children.append(Publication(hit).to_file())
+            else:
+                children.append(LegacyPublication(hit).to_file())
+
         result = {
             'trail': [{'name': '$SEARCH', 'path': '/$SEARCH'}],
             'name': '$SEARCH',
@@ -441,7 +583,10 @@ class PublicElasticFileManager(BaseFileManager):
             'system': system,
             'type': 'dir',
             'children': children,
-            'permissions': 'READ'
+            'permissions': 'READ',
+            'total': res.hits.total,
+            'totals': publication_totals(res),
+            'cursor': next_cursor(res)
         }
         return result
 
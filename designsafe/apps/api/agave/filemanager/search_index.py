@@ -1,8 +1,6 @@
 import logging
 import os
-import six
 import json
-from itertools import takewhile
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from designsafe.apps.api.projects.models import Project
@@ -11,65 +9,160 @@ from elasticsearch_dsl.query import Q
 from elasticsearch_dsl import Search, DocType
 from elasticsearch_dsl.connections import connections
 from .base import BaseFileManager
+from designsafe.libs.elasticsearch.queries import substring_query
+from designsafe.libs.elasticsearch.cache import SearchCache
+from designsafe.libs.elasticsearch.docs import readers_filter, routed
+from designsafe.libs.elasticsearch.projections import (apply_projection,
+                                                       source_filter,
+                                                       LISTING, SEARCH)
+from designsafe.apps.data.models.elasticsearch import FILE_SOURCE_PRESETS
 
 
 logger = logging.getLogger(__name__)
 
-def merge_file_paths(system, user_context, file_path, s):
-    def _names_equal(name):
-        return all(n == name[0] for n in name[1:])
-
-    def _common_prefix(paths):
-        levels = zip(*[os.path.join(p.path.strip('/'), p.name).split('/') for p in paths])
-        return '/'.join(x[0] for x in takewhile(_names_equal, levels))
+#: Key of the shared root a file is listed under, i.e. the first
+#: `params.depth` components of the file's full path.
+SHARE_ROOT_SCRIPT = (
+    "String path = doc['path._exact'].value;"
+    "String full = path == '/' ? doc['name._exact'].value :"
+    "    path + '/' + doc['name._exact'].value;"
+    "if (full.startsWith('/')) { full = full.substring(1); }"
+    "int end = -1;"
+    "for (int i = 0; i < params.depth; ++i) {"
+    "  end = full.indexOf('/', end + 1);"
+    "  if (end < 0) { return full; }"
+    "}"
+    "return full.substring(0, end);"
+)
+
+#: Full path of a file followed by a `/`. Sorting on it puts the files
+#: with the longest common path next to each other.
+FULL_PATH_SCRIPT = (
+    "String path = doc['path._exact'].value;"
+    "String full = path == '/' ? doc['name._exact'].value :"
+    "    path + '/' + doc['name._exact'].value;"
+    "return full + '/';"
+)
+
+
+def _full_path_sort(order):
+    return {'_script': {'type': 'string', 'order': order,
+                        'script': {'lang': 'painless', 'inline': FULL_PATH_SCRIPT}}}
+
+
+def _full_path(source):
+    return os.path.join(source['path'], source['name']).strip('/')
+
+
+def _common_path(first, last):
+    """Returns the longest path shared by every file of a root bucket.
+
+    Files are sorted on :data:`FULL_PATH_SCRIPT`, so the common path
+    of the first and the last file is the common path of all of them.
+    """
+    first, last = first + '/', last + '/'
+    size = 0
+    while size < min(len(first), len(last)) and first[size] == last[size]:
+        size += 1
+    return first[:first.rfind('/', 0, size + 1)].strip('/')
+
+
+def share_roots(system, search, file_path, offset=0, limit=100, source=None,
+                user_context=None):
+    """Returns the shared roots to list under a path.
+
+    Files matching `search` are grouped by their first components, one
+    group per child of `file_path`, with a terms aggregation. Every group
+    is listed as the deepest folder holding all of its files, so users
+    navigate straight to what was shared with them instead of through
+    empty folders. Only the first and last file of every group are
+    fetched, paths shared by several files are read with one more search.
+    Common folders `user_context` cannot read are left out of the listing.
+
+    :param str system: system id
+    :param search: :class:`elasticsearch_dsl.Search` of the shared files
+    :param str file_path: path being listed, `/` for `$SHARE`
+    :param int offset: offset of the first root
+    :param int limit: number of roots
+    :param dict source: `_source` filter of the roots, see
+        :func:`~designsafe.libs.elasticsearch.projections.source_filter`
+    :param str user_context: username the common folders must be readable
+        by, `None` to skip the permission check
+
+    :returns: list of :class:`Object`
+    """
+    file_path = file_path.strip('/')
+    depth = len(file_path.split('/')) + 1 if file_path else 1
+
+    search = search.extra(size=0)
+    roots = search.aggs.bucket(
+        'roots', 'terms',
+        script={'lang': 'painless', 'inline': SHARE_ROOT_SCRIPT,
+                'params': {'depth': depth}},
+        order={'_term': 'asc'}, size=offset + limit)
+    first_hits = {'size': 1, 'sort': [_full_path_sort('asc')]}
+    if source is not None:
+        first_hits['_source'] = source
+    roots.metric('first', 'top_hits', **first_hits)
+    roots.metric('last', 'top_hits', size=1, _source=['path', 'name'],
+                 sort=[_full_path_sort('desc')])
+    try:
+        res = search.execute()
+    except (TransportError, ConnectionTimeout) as e:
+        if getattr(e, 'status_code', 500) == 404:
+            raise
+        res = search.execute()
 
     listing = []
-    if not s.count():
-        return []
-
-    file_path_comps = file_path.strip('/').split('/')
-    if file_path == '/' or file_path == '':
-        lfp = 1
-    else:
-        lfp = len(file_path_comps) + 1
-
-    common_paths = {}
-    for doc in s.scan():
-        owner = os.path.join(doc.path, doc.name).strip('/').split('/')[0]
-        full_path = os.path.join(doc.path, doc.name)
-        if owner == user_context or full_path.strip('/') == file_path:
-            continue
-
-
-        common_path = '/'.join(full_path.split('/')[:lfp])
-        if common_path not in common_paths:
-            common_paths[common_path] = [doc]
+    missing = []
+    for bucket in res.aggregations.roots.buckets[offset:offset + limit]:
+        first = bucket.first.hits.hits[0]
+        last = bucket.last.hits.hits[0]
+        common_path = _common_path(_full_path(first['_source']),
+                                   _full_path(last['_source']))
+        if common_path == _full_path(first['_source']):
+            listing.append(Object(wrap=IndexedFile.from_es(first.to_dict())))
         else:
-            common_paths[common_path].append(doc)
-
-    for key, val in six.iteritems(common_paths):
-        #If only one children on the common path key
-        #then it's supposed to show on the listing
-        if len(val) == 1:
-            listing += [Object(wrap=indexed) for indexed in val]
-            continue
-
-        common_prefix = _common_prefix(val)
-        #If they don't have a common prefix or the level of the common_prefix is the same
-        #as the file_path being listed then they're all on the same level
-        #and are children of the listing
-        if not common_prefix:
-            listing += [Object(wrap=indexed) for indexed in val]
-            continue
-        #Add the common_prefix document to the listing.
-        #As long as it's valid.
-        d = Object(system, common_prefix.split('/')[0], common_prefix)
-        if d._wrap:
-            listing.append(d)
+            listing.append(common_path)
+            missing.append(common_path)
+
+    if missing:
+        docs = dict((_full_path(doc), doc)
+                    for doc in _files_by_path(system, missing, source=source,
+                                              user_context=user_context))
+        listing = [Object(wrap=docs[item]) if item in docs else item
+                   for item in listing]
+    listing = [item for item in listing if isinstance(item, Object)]
     logger.debug('length: %d', len(listing))
     return listing
 
+
+def _files_by_path(system, full_paths, source=None, user_context=None):
+    """Returns the documents of several files with one search
+
+    :param str system: system id
+    :param list full_paths: full paths of the files
+    :param dict source: `_source` filter of the documents
+    :param str user_context: only return the files readable by this
+        username or `WORLD`, `None` to return every file
+    """
+    paths = []
+    for full_path in full_paths:
+        path, name = os.path.split(full_path)
+        paths.append(Q('bool', must=[Q('term', **{'path._exact': path or '/'}),
+                                     Q('term', **{'name._exact': name})]))
+    filters = [Q('term', **{'system._exact': system})]
+    if user_context is not None:
+        filters.append(Q(readers_filter(user_context, 'WORLD')))
+    search = IndexedFile.search()\
+        .query(Q('bool', filter=filters, should=paths, minimum_should_match=1))\
+        .extra(size=len(full_paths) * 2)
+    if source is not None:
+        search = search.source(**source)
+    return search.execute()
+
 class IndexedFile(DocType):
+    SOURCE_PRESETS = FILE_SOURCE_PRESETS
 
     class Meta:
         index = 'des-files'
@@ -94,18 +187,7 @@ class Object(object):
                 system_q
             ]
             # pems filter
-            user_pem_q = Q('term', **{'permissions.username': user_context})
-            world_pem_q = Q('term', **{'permissions.username': 'WORLD'})
-            bool_filter = Q('bool')
-            bool_filter.should = [
-                user_pem_q,
-                world_pem_q
-            ]
-            nested_filter = Q('nested')
-            nested_filter.path = 'permissions'
-            nested_filter.query = bool_filter
-            # set filter
-            query.filter = nested_filter
+            query.filter = Q(readers_filter(user_context, 'WORLD'))
             s = s.query(query)
             logger.debug('serach query: %s', json.dumps(s.to_dict(), indent=4))
             try:
@@ -226,7 +308,23 @@ class ElasticFileManager(BaseFileManager):
         return None
 
     @staticmethod
-    def listing(system, file_path, user_context):
+    def listing(system, file_path, user_context, offset=0, limit=100,
+                projection=LISTING):
+        """Lists the files shared with a user under a path.
+
+        Files are grouped into shared roots server side, see
+        :func:`share_roots`, and paged over roots.
+
+        :param str system: system id
+        :param str file_path: path to list, `$SHARE` for the top level
+        :param str user_context: username making the request
+        :param int offset: offset of the first root
+        :param int limit: number of roots
+        :param str projection: one of :attr:`IndexedFile.SOURCE_PRESETS`
+
+        :raises ValueError: if `projection` is not valid
+        """
+        source = source_filter(IndexedFile.SOURCE_PRESETS, projection)
         file_path = file_path or '/'
         file_path = file_path.strip('/')
         if file_path.strip('/').split('/')[0] != user_context:
@@ -251,33 +349,27 @@ class ElasticFileManager(BaseFileManager):
                    ]
                   )
         if user_context is not None:
-            username_q = Q('term', **{'permissions.username': user_context})
-            world_q = Q('term', **{'permissions.username': 'WORLD'})
-            pems_filter = Q('bool')
-            pems_filter.should = [username_q, world_q]
-            nested_filter = Q('nested')
-            nested_filter.path = 'permissions'
-            nested_filter.query = pems_filter
+            pems_filter = Q(readers_filter(user_context, 'WORLD'))
 
+        # Neither the user's own files nor the listed folder are listed
+        exclude = [Q('term', **{'path._path': user_context}),
+                   Q('bool', must=[Q('term', **{'path._exact': '/'}),
+                                   Q('term', **{'name._exact': user_context})])]
         if file_path == '$SHARE':
             file_path = '/'
-            home_filter = Q('bool', must_not=Q('term', **{'path._path': user_context}))
-            query = Q('bool', must=q, filter=[nested_filter, home_filter])
+            query = Q('bool', must=q, filter=[pems_filter], must_not=exclude)
         else:
-            query = Q('bool', must=q)
+            parent, name = os.path.split(file_path)
+            exclude.append(Q('bool', must=[Q('term', **{'path._exact': parent or '/'}),
+                                           Q('term', **{'name._exact': name})]))
+            query = Q('bool', must=q, must_not=exclude)
     
         search = IndexedFile.search()
         search.query = query
-        search = search.sort('path._exact', 'name._exact')
-
-        try:
-            res = search.execute()
-        except (TransportError, ConnectionTimeout) as e:
-            if getattr(e, 'status_code', 500) == 404:
-                raise
-            res = search.execute()
 
-        listing = merge_file_paths(system, user_context, file_path, search)
+        listing = share_roots(system, search, file_path,
+                              offset=int(offset), limit=int(limit), source=source,
+                              user_context=user_context)
         logger.debug(file_path)
         if file_path == '/':
             result = {
@@ -314,7 +406,7 @@ class ElasticFileManager(BaseFileManager):
         return result
 
     def search(self, system, username, query_string,
-               file_path=None, offset=0, limit=100):
+               file_path=None, offset=0, limit=100, projection=SEARCH):
         """
         Executes a search in for files belonging to the logged-in user and 
         returns a result dict to be passed to the front-end.
@@ -325,26 +417,22 @@ class ElasticFileManager(BaseFileManager):
         :param file_path: unused here
         :param offset: elasticsearch offset
         :param limit: number of search hits to return
+        :param projection: one of :attr:`IndexedFile.SOURCE_PRESETS`
 
+        Terms are matched as substrings of the file's name and keywords
+        with :func:`~designsafe.libs.elasticsearch.queries.substring_query`.
         """
-        split_query = query_string.split(" ")
-        for i, c in enumerate(split_query):
-            if c.upper() not in ["AND", "OR", "NOT"]:
-                split_query[i] = "*" + c + "*"
-        
-        query_string = " ".join(split_query)
-
         search = IndexedFile.search()
-        search = search.filter("nested", path="permissions", query=Q("term", permissions__username=username))
+        search = search.filter(readers_filter(username))
         
         search = search.query(Q('bool', must=[Q({'prefix': {'path._exact': username}})]))
         search = search.filter("term", system=system)
         search = search.query(Q('bool', must_not=[Q({'prefix': {'path._exact': '{}/.Trash'.format(username)}})]))
-        search = search.query("query_string", query=query_string, fields=["name", "name._exact", "keywords"])
-        res = search.execute()
-        children = []
-        if res.hits.total:
-            children = [Object(wrap=o).to_dict() for o in search[offset:limit]]
+        search = search.query(substring_query(query_string, ['name', 'keywords']))
+        search = routed(search, system, username)
+        search = apply_projection(search, IndexedFile.SOURCE_PRESETS, projection)
+        res = SearchCache('files_search').execute(search[offset:limit], scope=username)
+        children = [Object(wrap=o).to_dict() for o in res]
 
         result = {
             'trail': [{'name': '$SEARCH', 'path': '/$SEARCH'}],
@@ -358,7 +446,7 @@ class ElasticFileManager(BaseFileManager):
         return result
 
     def search_community(self, system, query_string,
-               file_path=None, offset=0, limit=100):
+               file_path=None, offset=0, limit=100, projection=SEARCH):
         """
         Executes a search in community data and returns a dict with the results
         and information needed by the front-end for formatting.
@@ -369,6 +457,7 @@ class ElasticFileManager(BaseFileManager):
         :param file_path: unused here
         :param offset: elasticsearch offset
         :param limit: number of search hits to return
+        :param projection: one of :attr:`IndexedFile.SOURCE_PRESETS`
         """
         
         split_query = query_string.split(" ")
@@ -386,13 +475,12 @@ class ElasticFileManager(BaseFileManager):
             .filter(filters)\
             .extra(from_=offset, size=limit)
             #.filter("term", type="file")\
+        search = apply_projection(search, IndexedFile.SOURCE_PRESETS, projection)
            
 
 
-        res = search.execute()
-        children = []
-        if res.hits.total:
-            children = [Object(wrap=o).to_dict() for o in search[offset:limit]]
+        res = SearchCache('files_search').execute(search[offset:limit], scope=None)
+        children = [Object(wrap=o).to_dict() for o in res]
 
         result = {
             'trail': [{'name': '$SEARCH', 'path': '/$SEARCH'}],
@@ -405,7 +493,8 @@ class ElasticFileManager(BaseFileManager):
         }
         return result
 
-    def search_in_project(self, system, query_string, file_path=None, offset=0, limit=100):
+    def search_in_project(self, system, query_string, file_path=None, offset=0, limit=100,
+                          projection=SEARCH):
         """
         Performs a search for files within a specific project.
         """
@@ -425,10 +514,10 @@ class ElasticFileManager(BaseFileManager):
         search = search.filter(Q({'term': {'system._exact': system}}))
         # search = search.query(Q('bool', must_not=[Q({'prefix': {'path._exact': '{}/.Trash'.format(username)}})]))
         search = search.query("query_string", query=query_string, fields=["name", "name._exact", "keywords"])
-        res = search.execute()
-        children = []
-        if res.hits.total:
-            children = [Object(wrap=o).to_dict() for o in search[offset:limit]]
+        search = routed(search, system, '/')
+        search = apply_projection(search, IndexedFile.SOURCE_PRESETS, projection)
+        res = SearchCache('files_search').execute(search[offset:limit], scope=None)
+        children = [Object(wrap=o).to_dict() for o in res]
 
         result = {
             'trail': [{'name': '$SEARCH', 'path': '/$SEARCH'}],
@@ -483,7 +572,7 @@ class ElasticFileManager(BaseFileManager):
         return result
 
     def search_shared(self, system, username, query_string,
-               file_path=None, offset=0, limit=100):
+               file_path=None, offset=0, limit=100, projection=SEARCH):
         """
         search = IndexedFile.search()
         query = Q('bool',
@@ -507,12 +596,13 @@ class ElasticFileManager(BaseFileManager):
         query_string = " ".join(split_query)
 
         search = IndexedFile.search()
-        search = search.filter("nested", path="permissions", query=Q("term", permissions__username=username))
+        search = search.filter(readers_filter(username))
         search = search.query("query_string", query=query_string, fields=["name", "name._exact", "keywords"])
         
         search = search.query(Q('bool', must_not=[Q({'prefix': {'path._exact': username}})]))
         search = search.filter("term", system=system)
         search = search.query(Q('bool', must_not=[Q({'prefix': {'path._exact': '{}/.Trash'.format(username)}})]))
+        search = apply_projection(search, IndexedFile.SOURCE_PRESETS, projection)
         res = search.execute()
 
         res = search.execute()
@@ -0,0 +1,40 @@
+from django.test import TestCase
+from elasticsearch import ConnectionError
+import mock
+from designsafe.apps.api.agave.filemanager.agave import AgaveFileManager
+
+
+class MoveDocumentsTests(TestCase):
+    """Tests for the index updates of :class:`AgaveFileManager` moves"""
+
+    def setUp(self):
+        patcher = mock.patch(
+            'designsafe.apps.api.agave.filemanager.agave.BaseFileResource')
+        self.mock_resource = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.api.agave.filemanager.agave.ESFileManager')
+        self.mock_es_fm = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.api.agave.filemanager.agave.ReindexQueue')
+        self.mock_queue = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rename(self):
+        fm = AgaveFileManager(mock.Mock())
+        fm.rename('sys', 'ds_user/a/file.txt', 'renamed.txt')
+
+        self.mock_es_fm.return_value.move.assert_called_once_with(
+            'sys', 'ds_user/a/file.txt', 'ds_user/a/renamed.txt', link=None)
+        self.mock_queue.return_value.request.assert_called_once_with(
+            'sys', 'ds_user/a', levels=1)
+
+    def test_move_falls_back_to_reindex(self):
+        self.mock_resource.listing.return_value.move.return_value.name = 'a'
+        self.mock_es_fm.return_value.move.side_effect = ConnectionError('N/A', 'down', None)
+        fm = AgaveFileManager(mock.Mock())
+
+        fm.move('sys', 'ds_user/a', 'ds_user/b')
+
+        requests = self.mock_queue.return_value.request.call_args_list
+        self.assertIn(mock.call('sys', 'ds_user/b/a', levels=0), requests)
+        self.assertIn(mock.call('sys', 'ds_user', levels=1), requests)
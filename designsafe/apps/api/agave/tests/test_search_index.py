@@ -0,0 +1,93 @@
+from django.test import TestCase
+from elasticsearch_dsl.utils import AttrDict
+import mock
+from designsafe.apps.api.agave.filemanager import search_index
+from designsafe.apps.api.agave.filemanager.search_index import (_common_path,
+                                                                _files_by_path,
+                                                                share_roots)
+
+
+class ShareRootsTests(TestCase):
+
+    def test_common_path(self):
+        # test cases, first is expected output, second is the first and
+        # last full paths of a root bucket
+        cases = (
+            ('owner/a', ('owner/a/b.txt', 'owner/a/c.txt')),
+            ('owner/a', ('owner/a', 'owner/a/b/c.txt')),
+            ('owner', ('owner/a-b/c.txt', 'owner/a/c.txt')),
+            ('owner/file.txt', ('owner/file.txt', 'owner/file.txt')),
+        )
+
+        for case in cases:
+            self.assertEqual(case[0], _common_path(*case[1]))
+
+    @staticmethod
+    def _hit(path, name):
+        return {'_index': 'des-files', '_type': 'file', '_id': name,
+                '_source': {'system': 'designsafe.storage.default',
+                            'path': path, 'name': name}}
+
+    def _bucket(self, key, first, last):
+        return {'key': key,
+                'first': {'hits': {'hits': [self._hit(*first)]}},
+                'last': {'hits': {'hits': [self._hit(*last)]}}}
+
+    def _search(self, *buckets):
+        search = mock.MagicMock()
+        search.extra.return_value.execute.return_value = AttrDict(
+            {'aggregations': {'roots': {'buckets': list(buckets)}}})
+        return search
+
+    @mock.patch.object(search_index, '_files_by_path')
+    def test_buckets_listed_as_common_folder(self, mock_files_by_path):
+        search = self._search(
+            self._bucket('owner', ('owner/a', 'b.txt'), ('owner/a/c', 'd.txt')),
+            self._bucket('other', ('/', 'other'), ('other/e', 'f.txt')),
+            self._bucket('third', ('third', 'g.txt'), ('third', 'g.txt')))
+        mock_files_by_path.return_value = [AttrDict({'path': 'owner', 'name': 'a'})]
+
+        listing = share_roots('designsafe.storage.default', search, '/',
+                              user_context='ds_user')
+
+        mock_files_by_path.assert_called_once_with(
+            'designsafe.storage.default', ['owner/a'], source=None,
+            user_context='ds_user')
+        self.assertEqual([item._wrap.name for item in listing],
+                         ['a', 'other', 'g.txt'])
+
+    @mock.patch.object(search_index, '_files_by_path')
+    def test_unreadable_common_folder_dropped(self, mock_files_by_path):
+        search = self._search(
+            self._bucket('owner', ('owner/a', 'b.txt'), ('owner/a', 'c.txt')))
+        mock_files_by_path.return_value = []
+
+        listing = share_roots('designsafe.storage.default', search, '/',
+                              user_context='ds_user')
+
+        self.assertEqual(listing, [])
+
+    @mock.patch.object(search_index, '_files_by_path')
+    def test_offset_limit(self, mock_files_by_path):
+        search = self._search(*[self._bucket(name, ('/', name), ('/', name))
+                                for name in ('a', 'b', 'c', 'd')])
+
+        listing = share_roots('designsafe.storage.default', search, '/',
+                              offset=1, limit=2)
+
+        roots = search.extra.return_value.aggs.bucket
+        self.assertEqual(roots.call_args[1]['size'], 3)
+        self.assertEqual([item._wrap.name for item in listing], ['b', 'c'])
+        mock_files_by_path.assert_not_called()
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_files_by_path_readers_filter(self, mock_execute):
+        _files_by_path('designsafe.storage.default', ['owner/a'],
+                       user_context='ds_user')
+
+        query = mock_execute.call_args[0][0].to_dict()['query']['bool']
+        self.assertIn({'terms': {'readers': ['ds_user', 'WORLD']}},
+                      query['filter'])
+        self.assertEqual(query['should'], [{'bool': {'must': [
+            {'term': {'path._exact': 'owner'}},
+            {'term': {'name._exact': 'a'}}]}}])
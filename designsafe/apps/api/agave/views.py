@@ -23,6 +23,7 @@ from designsafe.apps.api.notifications.models import Notification
 from designsafe.apps.api.tasks import external_resource_upload
 from designsafe.apps.api.views import BaseApiView
 from designsafe.libs.common.decorators import profile as profile_fn
+from designsafe.libs.elasticsearch.projections import LISTING, SEARCH
 from requests import HTTPError
 
 
@@ -64,26 +65,41 @@ class FileListingView(BaseApiView):
                 (file_path.strip('/') == '$SHARE' or
                  file_path.strip('/').split('/')[0] != request.user.username):
 
-                listing = ElasticFileManager.listing(system=system_id,
-                                                     file_path=file_path,
-                                                     user_context=request.user.username)
+                try:
+                    listing = ElasticFileManager.listing(
+                        system=system_id,
+                        file_path=file_path,
+                        user_context=request.user.username,
+                        offset=int(request.GET.get('offset', 0)),
+                        limit=int(request.GET.get('limit', 100)),
+                        projection=request.GET.get('projection', LISTING))
+                except ValueError:
+                    return HttpResponseBadRequest('Invalid projection')
                 return JsonResponse(listing)
             else:
                 query_string = request.GET.get('query_string') 
     
                 offset = int(request.GET.get('offset', 0))
                 limit = int(request.GET.get('limit', 100))
+                sort = request.GET.get('sort', 'name')
+                if sort not in ('name', 'size'):
+                    return HttpResponseBadRequest('Invalid sort')
                 if (not query_string) or (query_string==""):
                     listing = fm.listing(system=system_id, file_path=file_path,
-                                        offset=offset, limit=limit)
+                                        offset=offset, limit=limit, sort=sort,
+                                        username=request.user.username)
                 else:
                     query_string = request.GET.get('query_string')
                     # Performing an Agave listing here prevents a race condition.
                     listing = fm.listing(system=system_id, file_path='/',
                                         offset=offset, limit=limit) 
                     efmgr = ElasticFileManager()
-                    listing = efmgr.search_in_project(system_id, query_string,
-                                offset=offset, limit=limit)
+                    try:
+                        listing = efmgr.search_in_project(
+                            system_id, query_string, offset=offset, limit=limit,
+                            projection=request.GET.get('projection', SEARCH))
+                    except ValueError:
+                        return HttpResponseBadRequest('Invalid projection')
                 return JsonResponse(listing,
                                     encoder=AgaveJSONEncoder,
                                     safe=False)
@@ -568,6 +584,7 @@ class FileSearchView(View):
         offset = int(request.GET.get('offset', 0))
         limit = int(request.GET.get('limit', 100))
         query_string = request.GET.get('query_string')
+        projection = request.GET.get('projection', SEARCH)
         
         if file_mgr_name != ElasticFileManager.NAME or not query_string:
             return HttpResponseBadRequest()
@@ -576,15 +593,19 @@ class FileSearchView(View):
             system_id = ElasticFileManager.DEFAULT_SYSTEM_ID
 
         fmgr = ElasticFileManager()
-        if not (request.GET.get('shared', False) or request.GET.get('projects', False)):
-            listing = fmgr.search(system_id, request.user.username, query_string,
-                                offset=offset, limit=limit)
-        elif request.GET.get('shared', False):
-            listing = fmgr.search_shared(system_id, request.user.username, query_string,
-                                         offset=offset, limit=limit)
-        elif request.GET.get('projects', False):
-            listing = fmgr.search_projects(request.user.username, query_string,
-                                offset=offset, limit=limit)
+        try:
+            if not (request.GET.get('shared', False) or request.GET.get('projects', False)):
+                listing = fmgr.search(system_id, request.user.username, query_string,
+                                      offset=offset, limit=limit, projection=projection)
+            elif request.GET.get('shared', False):
+                listing = fmgr.search_shared(system_id, request.user.username, query_string,
+                                             offset=offset, limit=limit,
+                                             projection=projection)
+            elif request.GET.get('projects', False):
+                listing = fmgr.search_projects(request.user.username, query_string,
+                                               offset=offset, limit=limit)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid projection')
 
         return JsonResponse(listing)
 
@@ -1,10 +1,16 @@
 from django.conf import settings
 from elasticsearch_dsl.query import Q
 from elasticsearch import TransportError, ConnectionTimeout
-from elasticsearch_dsl import Search, DocType
+from elasticsearch_dsl import Search, MultiSearch, DocType, Keyword
 from elasticsearch_dsl.connections import connections
 from designsafe.apps.api.data.agave.file import AgaveFile
 from designsafe.apps.api.data.agave.elasticsearch import utils as query_utils
+from designsafe.libs.elasticsearch.docs import new_file_doc_id
+from designsafe.libs.elasticsearch import docs as DocsManager
+from designsafe.libs.elasticsearch.cache import bump_generation
+from designsafe.libs.elasticsearch.cursor import paginate
+from designsafe.libs.elasticsearch.projections import (apply_projection,
+                                                       LISTING, SEARCH, DETAIL)
 from itertools import takewhile
 import dateutil.parser
 import itertools
@@ -68,6 +74,29 @@ class PaginationMixin(object):
             limit = 0
         return offset, limit
 
+    @staticmethod
+    def paginate_listing(s, sort, offset=0, limit=100, cursor=None, **kwargs):
+        """Returns one page of a listing.
+
+        Pages are read with `search_after` when `cursor` is given, so
+        listing deep into a large folder is not limited by
+        `index.max_result_window`. `offset` is only used without a cursor.
+
+        :param s: search to paginate
+        :param list sort: sort keys, the last one must be unique
+        :param int offset: offset of the first hit, without `cursor`
+        :param int limit: page size
+        :param str cursor: cursor returned with the previous page
+
+        :returns: `(search, next_cursor)`, see
+            :func:`~designsafe.libs.elasticsearch.cursor.paginate`
+        :raises ValueError: if `cursor` is not valid
+        """
+        offset = int(offset)
+        if offset and not cursor:
+            s = s.extra(**{'from': offset})
+        return paginate(s, sort, int(limit), cursor)
+
 def _names_equal(name):
     return all(n==name[0] for n in name[1:])
 
@@ -154,6 +183,11 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
     .. todo:: create a wrapper to try/except `Unable to sniff hosts` error.
     """
     source = 'agave'
+    readers = Keyword(multi=True)
+    writers = Keyword(multi=True)
+
+    #: Sort keys of one level listings, see :meth:`listing_page`.
+    LISTING_SORT = ['name._exact', '_uid']
 
     @classmethod
     def listing(cls, system, username, file_path, **kwargs):
@@ -163,8 +197,28 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         :param str username: username making the request
         :param str file_path: file path to list
 
-        :returns: list of :class:`Object`
-        :rtype: list
+        :returns: `(res, search)` the response and the executed search
+        :rtype: tuple
+        """
+        s, _ = cls.listing_page(system, username, file_path, **kwargs)
+        return cls._execute_search(s)
+
+    @classmethod
+    def listing_page(cls, system, username, file_path, projection=None, **kwargs):
+        """Returns one page of a one level listing.
+
+        Children are sorted on `(name._exact, _uid)`. Takes the `offset`,
+        `limit` and `cursor` arguments of :meth:`paginate_listing`.
+
+        :param str system: system id
+        :param str username: username making the request
+        :param str file_path: file path to list
+        :param str projection: one of :attr:`SOURCE_PRESETS`, `None` to
+            fetch the whole `_source`
+
+        :returns: `(search, next_cursor)`, see
+            :func:`~designsafe.libs.elasticsearch.cursor.paginate`
+        :raises ValueError: if `cursor` or `projection` is not valid
         """
         q = Q('bool',
               must = Q({'term': {'path._exact': file_path}}),
@@ -172,12 +226,8 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
              )
         s = cls.search()
         s.query = q
-        s = s.sort({'name._exact': 'asc'})
-
-        res, s = cls._execute_search(s)
-        offset, limit = cls.get_paginate_limits(res, **kwargs)
-
-        return res, s[offset:limit]
+        s = apply_projection(s, cls.SOURCE_PRESETS, projection)
+        return cls.paginate_listing(s, cls.LISTING_SORT, **kwargs)
 
     @classmethod
     def from_file_path(cls, system, username, file_path):
@@ -366,7 +416,7 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
                 )
             if get_pems:
                 logger.debug('file_obj pems: {}'.format(file_obj.permissions))
-                o.update(permissions = file_obj.permissions)
+                o.update(**DocsManager.pems_fields(file_obj.permissions))
             return o
 
         o = cls(
@@ -385,7 +435,6 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
             link = file_obj._links['self']['href'],
             type = file_obj.type
         )
-        o.save()
         if get_pems:
             pems = file_obj.permissions
         else:
@@ -401,7 +450,7 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
                 }
             }]
 
-        o.update(permissions = pems)
+        o.permissions = pems
         o.save()
         return o
 
@@ -442,6 +491,54 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         #logger.debug('limit: %s. offset: %s' % (limit, offset))
         return res, s[offset:limit]
 
+    #: Fields read by :meth:`to_file_dict`.
+    FILE_DICT_FIELDS = ['format', 'lastModified', 'length', 'mimeType', 'name',
+                        'path', 'permissions', 'systemId', 'type', 'keywords',
+                        'systemTags']
+
+    #: `_source` projections, see
+    #: :func:`~designsafe.libs.elasticsearch.projections.apply_projection`.
+    SOURCE_PRESETS = {
+        LISTING: {'include': FILE_DICT_FIELDS},
+        SEARCH: {'include': FILE_DICT_FIELDS},
+        DETAIL: None
+    }
+
+    @classmethod
+    def search_page(cls, username, q, fields=None, limit=100, cursor=None,
+                    projection=SEARCH):
+        """Returns one page of a user's search.
+
+        Same query as :meth:`search_query` but files in the user's
+        `.Trash` are filtered out by ES, only the fields of `projection`
+        are fetched and pages are read with `search_after` on
+        `(path._exact, name._exact, _uid)`.
+
+        :param str username: username making the request
+        :param str q: string to query the ES index
+        :param list fields: extra fields to search
+        :param int limit: page size
+        :param str cursor: cursor of the previous page
+        :param str projection: one of :attr:`SOURCE_PRESETS`
+
+        :returns: `(search, next_cursor)`, see
+            :func:`~designsafe.libs.elasticsearch.cursor.paginate`
+        :raises ValueError: if `cursor` or `projection` is not valid
+        """
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+
+        search_fields = ['name', 'name._exact', 'keywords'] + list(fields or [])
+        sq = Q('bool',
+               must=query_utils.files_wildcard_query(q, search_fields),
+               filter=query_utils.files_access_filter(
+                   username, system=settings.AGAVE_STORAGE_SYSTEM),
+               must_not=[Q({'prefix': {'path._exact': u'{}/.Trash'.format(username)}})])
+        s = cls.search()
+        s.query = sq
+        s = apply_projection(s, cls.SOURCE_PRESETS, projection)
+        return paginate(s, ['path._exact', 'name._exact', '_uid'], int(limit), cursor)
+
 
     def copy(self, username, target_file_path):
         """Copy a document.
@@ -473,18 +570,14 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
             target_path = self.path
 
         if self.type == 'dir':
-            res, s = self.__class__.listing_recursive(self.systemId, username, os.path.join(self.path, self.name))
-            for o in s.scan():
-                d = o.to_dict()
-                regex = r'^{}'.format(os.path.join(self.path, self.name))
-                logger.debug(u'd[path]: {}'.format(d['path']))
-                d['path'] = re.sub(regex,
-                                os.path.join(target_path, target_name),
-                                d['path'], count = 1)
-                logger.debug(u'changed d[path]: {}'.format(d['path']))
-                d['agavePath'] = u'agave://{}/{}'.format(self.systemId, os.path.join(d['path'], d['name']))
-                doc = Object(**d)
-                doc.save()
+            from designsafe.apps.api.tasks import copy_path_prefix
+            task = copy_path_prefix.apply_async(
+                args=[self._doc_type.index, 'systemId', self.systemId,
+                      self.full_path, os.path.join(target_path, target_name)],
+                kwargs={'agave_path': True},
+                queue='indexing')
+            logger.debug(u'Copying children of %s. Task: %s',
+                         self.full_path, task.id)
         d = self.to_dict()
         d['path'] = target_path
         d['name'] = target_name
@@ -494,6 +587,15 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         self.save()
         return doc
 
+    def _bump_on_completion(self, task_id):
+        """Invalidates the cached searches of this index once a
+        background ES task completes."""
+        if task_id is None:
+            return
+        from designsafe.apps.api.tasks import bump_generation_on_completion
+        bump_generation_on_completion.apply_async(
+            args=[task_id, self._doc_type.index], queue='indexing')
+
     def delete_recursive(self, username):
         """Delete a file recursively.
 
@@ -501,15 +603,20 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         If the document represents a folder then it will
         recursively delete any childre documents.
 
+        Children documents are deleted in the background with
+        `delete_by_query`, see
+        :func:`~designsafe.libs.elasticsearch.docs.delete_path_prefix`.
+
         :returns: count of how many documents were deleted
         :rtype: int
         """
         cnt = 0
         if self.type == 'dir':
-            res, s = self.__class__.listing_recursive(self.systemId, username, os.path.join(self.path, self.name))
-            for o in s.scan():
-                o.delete()
-                cnt += 1
+            task_id, cnt = DocsManager.delete_path_prefix(
+                self._doc_type.index, 'systemId', self.systemId, self.full_path)
+            logger.debug(u'Deleting %d children of %s. Task: %s',
+                         cnt, self.full_path, task_id)
+            self._bump_on_completion(task_id)
 
         self.delete()
         cnt += 1
@@ -557,18 +664,12 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         :returns: an instance of this class
         :rtype: :class:`Object`
         """
-        if self.type == 'dir':
-            res, s = self.__class__.listing_recursive(self.systemId, username, os.path.join(self.path, self.name))
-            for o in s.scan():
-                regex = ur'^{}'.format(os.path.join(self.path, self.name))
-                o.update(path = re.sub(regex, os.path.join(path, self.name),
-                                o.path, count = 1),
-                         agavePath = u'agave://{}/{}'.format(self.systemId,
-                                os.path.join(self.path, self.name)))
-                o.save()
         tail, head = os.path.split(path)
-        self.update(path = tail, agavePath = u'agave://{}/{}'.format(self.systemId,
-                                                os.path.join(tail, self.name)))
+        if self.type == 'dir':
+            self.rewrite_children_path(os.path.join(tail, self.name))
+        self.path = tail
+        self.agavePath = u'agave://{}/{}'.format(self.systemId,
+                                                 os.path.join(tail, self.name))
         logger.debug(u'Moved: {}'.format(self.full_path))
         self.save()
         return self
@@ -590,30 +691,53 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         if tail == '':
             head = path
         if self.type == 'dir':
-            res, s = self.__class__.listing_recursive(self.systemId, username, os.path.join(self.path, self.name))
-            for o in s.scan():
-                regex = ur'^{}'.format(os.path.join(self.path, self.name))
-                target_path = re.sub(regex, os.path.join(self.path, head), o.path, count = 1)
-                o.update(path =  target_path,
-                         agavePath = u'agave://{}/{}'.format(self.systemId,
-                                            os.path.join(target_path, o.name)))
-                o.save()
-        self.update(name = head,
-                    agavePath = u'agave://{}/{}'.format(self.systemId,
-                                      os.path.join(self.path, head)))
+            self.rewrite_children_path(os.path.join(self.path, head))
+        self.name = head
+        self.agavePath = u'agave://{}/{}'.format(self.systemId,
+                                                 os.path.join(self.path, head))
         self.save()
         return self
 
+    def rewrite_children_path(self, dest_path):
+        """Moves every descendant document of a folder under `dest_path`.
+
+        The path prefix of the descendants (and their `agavePath`) is
+        rewritten server side by a single `update_by_query`, run by the
+        :func:`~designsafe.apps.api.tasks.update_path_prefix` celery task.
+
+        :param str dest_path: new full path of this folder
+
+        :returns: the task's `AsyncResult`, its `PROGRESS` state reports
+            how many documents have been updated
+        """
+        from designsafe.apps.api.tasks import update_path_prefix
+        task = update_path_prefix.apply_async(
+            args=[self._doc_type.index, 'systemId', self.systemId,
+                  self.full_path, dest_path],
+            kwargs={'agave_path': True},
+            queue='indexing')
+        logger.debug(u'Moving children of %s to %s. Task: %s',
+                     self.full_path, dest_path, task.id)
+        return task
+
     def save(self, **kwargs):
         """Overwrite to become save or update
+
+        New documents are saved with an id derived from `systemId` and the
+        file's full path (see
+        :func:`~designsafe.libs.elasticsearch.docs.new_file_doc_id`) so
+        saving is an idempotent upsert. Existing documents keep their id,
+        even when they are moved or renamed.
         """
-        doc = Object.from_file_path(self.systemId, self.full_path.split('/')[0], self.full_path)
-        if doc:
-            setattr(self.meta, 'index', doc.meta.index)
-            setattr(self.meta, 'id', doc.meta.id)
-            setattr(self.meta, 'doc_type', doc.meta.doc_type)
-            doc.update(**self.to_dict())
-        return super(Object, self).save(**kwargs)
+        if not getattr(self.meta, 'id', None):
+            self.meta.id = new_file_doc_id(self._doc_type.index,
+                                           self._doc_type.name,
+                                           self.systemId, self.full_path)
+        self.readers, self.writers = DocsManager.pems_principals(
+            getattr(self, 'permissions', None))
+        res = super(Object, self).save(**kwargs)
+        bump_generation(self._doc_type.index)
+        return res
 
     def share(self, username, permissions, update_parent_path = True, recursive = True):
         """Update permissions on a document recursively.
@@ -624,17 +748,29 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
             [READ | WRITE | EXECUTE | READ_WRITE | READ_EXECUTE | WRITE_EXECUTE | ALL | NONE]
         :param bool update_parent_path: if set it will update the permission on all the parent folders.
         :param bool recursive: if set it will update the permissions recursively.
+
+        Children documents are updated with one `update_by_query`, see
+        :func:`~designsafe.libs.elasticsearch.docs.update_path_prefix_pems`.
+        Only the children `username` can read are updated. The document is
+        flagged with `explicitPems` for
+        :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`.
         """
         if recursive and self.type == 'dir':
-            res, s = self.__class__.listing_recursive(self.systemId, username, os.path.join(self.path, self.name))
-            for o in s.scan():
-                o.update_pems(permissions)
+            pems_to_add, pems_usernames = self._pems_args_to_update(permissions)
+            task_id, total = DocsManager.update_path_prefix_pems(
+                self._doc_type.index, 'systemId', self.systemId, self.full_path,
+                pems_to_add, usernames=pems_usernames,
+                filters=[DocsManager.readers_filter(username)])
+            logger.debug(u'Updating permissions of %d children of %s. Task: %s',
+                         total, self.full_path, task_id)
+            self._bump_on_completion(task_id)
 
         #Commenting out to try new pems model
         #if update_parent_path:
         #    self._update_pems_on_parent_path(permissions)
 
         self.update_pems(permissions)
+        self.explicitPems = True
         self.save()
         return self
 
@@ -654,7 +790,7 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
 
         keywords = list(set(meta_obj['keywords']))
         keywords = [kw.strip() for kw in keywords]
-        self.update(keywords = keywords)
+        self.keywords = keywords
         self.save()
         logger.debug(self.keywords)
         return self
@@ -674,6 +810,14 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
             pems.append(d)
         return pems
 
+    def _pems_args_to_update(self, permissions):
+        """Returns the permissions to add and the usernames to replace"""
+        pems_translated = self._pems_args_to_es_pems_list(permissions)
+        pems_usernames = [o['username'] for o in pems_translated]
+
+        pems_to_add = filter(lambda x: not (x['permission']['read'] == False and x['permission']['write'] == False and x['permission']['execute'] == False), pems_translated)
+        return pems_to_add, pems_usernames
+
     @property
     def owner(self):
         if self.path == '/':
@@ -765,10 +909,7 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
             [READ | WRITE | EXECUTE | READ_WRITE | READ_EXECUTE | WRITE_EXECUTE | ALL | NONE]
         """
         pems = getattr(self, 'permissions', [])
-        pems_translated = self._pems_args_to_es_pems_list(permissions)
-        pems_usernames = [o['username'] for o in pems_translated]
-
-        pems_to_add = filter(lambda x: not (x['permission']['read'] == False and x['permission']['write'] == False and x['permission']['execute'] == False), pems_translated)
+        pems_to_add, pems_usernames = self._pems_args_to_update(permissions)
 
         #pems_to_remove = filter(lambda x: x['permission']['read'] == False and x['permission']['write'] == False and x['permission']['execute'] == False, pems_translated)
 
@@ -777,7 +918,7 @@ class Object(ExecuteSearchMixin, PaginationMixin, DocType):
         pems_to_persist += pems_to_add
         #logger.debug('updating permissions on {} with {}'.format(self.meta.id, user_pems))
         logger.debug('updating permissions: file: {} , pems: {}'.format(self.full_path, pems_to_add))
-        self.update(permissions = pems_to_persist)
+        self.permissions = pems_to_persist
         self.save()
         return self
 
@@ -956,7 +1097,91 @@ class Experiment(ExecuteSearchMixin, PaginationMixin, DocType):
         index = 'nees'
         doc_type = 'experiment'
 
+
+class PublicMetadata(object):
+    """Per request memo of the NEES projects and experiments referenced by
+    :class:`PublicObject` documents.
+
+    :meth:`prefetch` resolves every project of a listing, and all of their
+    experiments, with one `_msearch` request. Projects and experiments are
+    then read from memory, including the ones which do not exist, so
+    serializing a listing does not search once per object or per
+    trail segment.
+
+    >>> metadata = PublicMetadata()
+    >>> metadata.prefetch([o.project for o in listing])
+    >>> children = [o.to_dict(metadata=metadata) for o in listing]
+    """
+    #: Max number of projects or experiments read by one search.
+    MAX_HITS = 10000
+
+    def __init__(self):
+        self._projects = {}
+        self._experiments = {}
+
+    @staticmethod
+    def _name(project):
+        return re.sub(r'\.groups$', '', project)
+
+    def prefetch(self, projects):
+        """Fetches projects not read yet, and their experiments.
+
+        :param list projects: project names
+        """
+        names = sorted(set(self._name(project) for project in projects if project)
+                       - set(self._projects))
+        if not names:
+            return
+
+        ms = MultiSearch()
+        ms = ms.add(Project.search()
+                    .filter(Q({'terms': {'name._exact': names}}))
+                    .extra(size=self.MAX_HITS))
+        ms = ms.add(Experiment.search()
+                    .filter(Q({'terms': {'project._exact': names}}))
+                    .sort('name._exact')
+                    .extra(size=self.MAX_HITS))
+        try:
+            projects_res, experiments_res = ms.execute()
+        except (TransportError, ConnectionTimeout) as e:
+            if getattr(e, 'status_code', 500) == 404:
+                raise
+            projects_res, experiments_res = ms.execute()
+
+        for name in names:
+            self._projects[name] = None
+            self._experiments[name] = []
+        for project in projects_res:
+            if self._projects.get(project.name) is None:
+                self._projects[project.name] = project
+        for experiment in experiments_res:
+            self._experiments.setdefault(experiment.project, []).append(experiment)
+
+    def project(self, name):
+        """Returns a project's document, `None` if it does not exist"""
+        name = self._name(name)
+        self.prefetch([name])
+        return self._projects[name]
+
+    def experiments(self, project):
+        """Returns every experiment of a project, sorted by name"""
+        project = self._name(project)
+        self.prefetch([project])
+        return self._experiments[project]
+
+    def experiment(self, project, name):
+        """Returns an experiment's document, `None` if it does not exist"""
+        for experiment in self.experiments(project):
+            if experiment.name == name:
+                return experiment
+        return None
+
+
 class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
+    #: :class:`PublicMetadata` used instead of one search per lookup.
+    #: Declared on the class so it is not stored in the document.
+    metadata_ = None
+
     def __init__(self, *args, **kwargs):
         super(PublicObject, self).__init__(*args, **kwargs)
         self.project_ = None
@@ -992,21 +1217,49 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
         else:
             return None
 
+    #: Sort keys of one level listings, see :meth:`listing_page`.
+    LISTING_SORT = ['project._exact', 'name._exact', '_uid']
+
+    #: Fields read by :meth:`to_dict` and :attr:`trail`.
+    FILE_DICT_FIELDS = ['format', 'lastModified', 'length', 'mimeType', 'name',
+                        'path', 'project', 'systemId', 'type']
+
+    #: `_source` projections, see
+    #: :func:`~designsafe.libs.elasticsearch.projections.apply_projection`.
+    SOURCE_PRESETS = {
+        LISTING: {'include': FILE_DICT_FIELDS},
+        SEARCH: {'include': FILE_DICT_FIELDS},
+        DETAIL: None
+    }
+
     @classmethod
     def listing(cls, system_id, path, **kwargs):
+        s, _ = cls.listing_page(system_id, path, **kwargs)
+        return cls._execute_search(s)
+
+    @classmethod
+    def listing_page(cls, system_id, path, projection=None, **kwargs):
+        """Returns one page of a one level listing.
+
+        Takes the `offset`, `limit` and `cursor` arguments of
+        :meth:`~PaginationMixin.paginate_listing`.
+
+        :param str projection: one of :attr:`SOURCE_PRESETS`, `None` to
+            fetch the whole `_source`
+
+        :returns: `(search, next_cursor)`
+        :raises ValueError: if `cursor` or `projection` is not valid
+        """
         path = path or '/'
         q = Q('bool',
                must = [Q({'term': {'path._exact': path}}),
                        Q({'term': {'systemId': system_id}})]
                )
         s = cls.search()
-        s = s.sort({'project._exact': 'asc'})
         s.query = q
+        s = apply_projection(s, cls.SOURCE_PRESETS, projection)
         logger.debug('public listing queyr: {}'.format(s.to_dict()))
-        res, s = cls._execute_search(s)
-        offset, limit = cls.get_paginate_limits(res, **kwargs)
-        logger.debug('offset: {}, limit: {}'.format(offset, limit))
-        return res, s[offset:limit]
+        return cls.paginate_listing(s, cls.LISTING_SORT, **kwargs)
 
     @classmethod
     def search_query_with_projects(cls, system_id, username, q, fields = [], **kwargs):
@@ -1053,6 +1306,7 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
 
         s = cls.search()
         s.query = query_utils.files_wildcard_query(q, query_fields)
+        s = apply_projection(s, cls.SOURCE_PRESETS, kwargs.pop('projection', None))
 
         s = s.sort('type', 'path._exact', 'name._exact')
 
@@ -1068,7 +1322,10 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
         if self.project_:
             return self.project_
 
-        p = Project.from_name(self.project)
+        if self.metadata_ is not None:
+            p = self.metadata_.project(self.project)
+        else:
+            p = Project.from_name(self.project)
         self.project_ = p
         return self.project_
 
@@ -1078,7 +1335,10 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
             return self.experiment_
 
         experiment_name = self.full_path.split('/')[1]
-        e = Experiment.from_name_and_project(self.project, experiment_name)
+        if self.metadata_ is not None:
+            e = self.metadata_.experiment(self.project, experiment_name)
+        else:
+            e = Experiment.from_name_and_project(self.project, experiment_name)
         self.experiment_ = e
         return self.experiment_
 
@@ -1088,6 +1348,10 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
             if self.all_experiments_:
                 return self.all_experiments_
 
+            if self.metadata_ is not None:
+                self.all_experiments_ = self.metadata_.experiments(self.project)
+                return self.all_experiments_
+
             res, s = Experiment.list_by_project(self.project)
             self.all_experiments_ = s
 
@@ -1151,7 +1415,19 @@ class PublicObject(ExecuteSearchMixin, PaginationMixin, DocType):
         }
         return d
 
-    def to_dict(self, get_id = False, def_pems = None, with_meta = True, *args, **kwargs):
+    def to_dict(self, get_id = False, def_pems = None, with_meta = True,
+                metadata = None, *args, **kwargs):
+        """Returns the dict representation of a file.
+
+        :param bool with_meta: include the project and experiments metadata
+        :param metadata: :class:`PublicMetadata` shared by every object of
+            a listing. Without it the object reads its own project and
+            experiments with one request.
+        """
+        if metadata is not None:
+            self.metadata_ = metadata
+        elif self.metadata_ is None:
+            self.metadata_ = PublicMetadata()
         d = super(PublicObject, self).to_dict(*args, **kwargs)
         d['ext'] = self.ext
         d['id'] = self.file_id
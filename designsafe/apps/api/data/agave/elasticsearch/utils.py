@@ -1,4 +1,5 @@
 from elasticsearch_dsl.query import Q
+from designsafe.libs.elasticsearch.docs import readers_filter
 import os
 import re
 import logging
@@ -31,7 +32,7 @@ def files_access_filter(username, system = None, deleted = False):
             Q({'term': {'deleted': deleted}})
           ]
     if not system.startswith('project-'):
-        must_queries.append(Q({'term': {'permissions.username': username}}))
+        must_queries.append(Q(readers_filter(username)))
 
     if system is not None:
         must_queries.append(Q({'term': {'systemId': system}}))
@@ -7,6 +7,9 @@ from designsafe.apps.api.data.agave.elasticsearch.documents import Object
 from designsafe.apps.api.notifications.models import Notification, Broadcast
 from designsafe.apps.api.data.abstract.filemanager import AbstractFileManager
 from designsafe.apps.data.managers.indexer import AgaveIndexer as AgaveFileIndexer
+from designsafe.libs.elasticsearch.pems import PermissionsPropagator
+from designsafe.libs.elasticsearch.cursor import decode_cursor
+from designsafe.libs.elasticsearch.projections import source_filter, LISTING, SEARCH
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
@@ -54,7 +57,9 @@ class FileManager(AbstractFileManager, AgaveObject):
         self.agave_client = user_obj.agave_oauth.client
         self.username = username
         self._user = user_obj
-        self.indexer = AgaveFileIndexer(agave_client=self.agave_client)
+        self.indexer = AgaveFileIndexer(
+            agave_client=self.agave_client,
+            client_factory=lambda: user_obj.agave_oauth.client)
 
     def is_shared(self, file_id):
         """Checks if the `file_id` is shared for the file manager's user.
@@ -149,8 +154,13 @@ class FileManager(AbstractFileManager, AgaveObject):
         """
         listing_owner = file_path.strip('/').split('/')[0]
         is_shared = listing_owner != username
+        projection = kwargs.pop('projection', LISTING)
+        cursor = None
         if file_path != '/' and not is_shared:
-            res, listing = Object.listing(system, username, file_path, **kwargs)
+            s, next_cursor = Object.listing_page(system, username, file_path,
+                                                 projection=projection, **kwargs)
+            res, listing = Object._execute_search(s)
+            cursor = next_cursor(res)
         else:
             res, listing = Object.listing_recursive(system, username, file_path, **kwargs)
 
@@ -178,6 +188,7 @@ class FileManager(AbstractFileManager, AgaveObject):
                 list_data = root_listing.to_file_dict()
                 list_data['children'] = [o.to_file_dict() for o in listing]
                 list_data['shared'] = is_shared
+                list_data['cursor'] = cursor
             else:
                 list_data = None
 
@@ -235,6 +246,9 @@ class FileManager(AbstractFileManager, AgaveObject):
 
         :param str file_id: id representing the file. Format:
         <filesystem id>[/ | /<username> [/ | /<file_path>] ]
+        :param str projection: `_source` preset of the children, see
+            :attr:`~designsafe.apps.api.data.agave.elasticsearch.documents.Object.SOURCE_PRESETS`.
+            Default: `listing`
 
         :returns:listing dict. A dict with the properties of the
         parent path file object plus a `childrens` key with a list
@@ -270,6 +284,16 @@ class FileManager(AbstractFileManager, AgaveObject):
         system, file_user, file_path = self.parse_file_id(file_id)
         reindex = kwargs.get('reindex', None) == 'true'
         index_pems = kwargs.get('pems', None) == 'true'
+        cursor = kwargs.get('cursor')
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError:
+                raise ApiException('Invalid cursor', status=400)
+        try:
+            source_filter(Object.SOURCE_PRESETS, kwargs.get('projection', LISTING))
+        except ValueError:
+            raise ApiException('Invalid projection', status=400)
 
         if file_path.lower() == '$share':
             file_path = '/'
@@ -288,6 +312,7 @@ class FileManager(AbstractFileManager, AgaveObject):
             listing = None
 
         fallback = listing is None or (
+            not cursor and
             listing['type'] == 'folder' and
             listing['id'] != '$share' and
             len(listing['children']) == 0)
@@ -677,11 +702,20 @@ class FileManager(AbstractFileManager, AgaveObject):
     def search(self, **kwargs):
         """Searches a file using the Elasticsearch index
 
+        Returns one page of hits and the `cursor` of the next page,
+        `None` on the last page.
+
         :param str q: query string to search
         :param str q_{field_name}: query string to search in a specific field
+        :param int limit: page size
+        :param str cursor: cursor returned with the previous page
+        :param str projection: `_source` preset, see
+            :attr:`~designsafe.apps.api.data.agave.elasticsearch.documents.Object.SOURCE_PRESETS`.
+            Default: `search`
 
         """
-        res, s = Object.search_query(self.username, **kwargs)
+        s, next_cursor = self._search_page(**kwargs)
+        res = s.execute()
         search_data = {
             'source': self.resource,
             'system': settings.AGAVE_STORAGE_SYSTEM,
@@ -693,12 +727,49 @@ class FileManager(AbstractFileManager, AgaveObject):
             'size': None,
             'lastModified': None,
             'query': {'q': kwargs.get('q'), 'fields': kwargs.get('fields', [])},
-            'children': [o.to_file_dict() for o in s.scan() if not o.path.startswith('%s/.Trash' % self.username)],
+            'children': [o.to_file_dict() for o in res],
+            'total': res.hits.total,
+            'cursor': next_cursor(res),
             '_trail': [],
             '_pems': [{'username': self.username, 'permission': {'read': True}}],
         }
         return search_data
 
+    def search_stream(self, **kwargs):
+        """Yields every hit of a search, one page at a time.
+
+        Takes the same arguments as :meth:`search`. Used to stream
+        search results as NDJSON.
+        """
+        cursor = kwargs.pop('cursor', None)
+        while True:
+            s, next_cursor = self._search_page(cursor=cursor, **kwargs)
+            res = s.execute()
+            for o in res:
+                yield o.to_file_dict()
+            cursor = next_cursor(res)
+            if cursor is None:
+                break
+
+    def _search_page(self, q=None, fields=None, limit=100, cursor=None,
+                     projection=SEARCH, **kwargs):
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise ApiException('Invalid limit, must be an integer', status=400)
+        if limit < 1:
+            raise ApiException('Invalid limit, must be positive', status=400)
+        try:
+            source_filter(Object.SOURCE_PRESETS, projection)
+        except ValueError:
+            raise ApiException('Invalid projection', status=400)
+        try:
+            return Object.search_page(self.username, q, fields=fields,
+                                      limit=limit, cursor=cursor,
+                                      projection=projection)
+        except ValueError:
+            raise ApiException('Invalid cursor', status=400)
+
     def share(self, file_id, permissions, recursive = True, **kwargs):
         """Update permissions for a file
 
@@ -1210,53 +1281,37 @@ class AgaveIndexer(AgaveObject):
                 path_comp.pop()
         return docs_indexed, docs_deleted
 
-    def index_permissions(self, system_id, path, username, bottom_up = True, levels = 0):
+    def index_permissions(self, system_id, path, username):
         """Indexes the permissions
 
-        This method works from the indexed documents. It searches for all the
-        Elasticsearch (ES) documents that are children of the given `path` and updates
-        the permissions doing a `files.listPermissions` call to agave. This means that
-        this method does not creates ES documents or do any deduping.
+        This method works from the indexed documents. It does a
+        `files.listPermissions` call to agave for the given `path` and sets
+        those permissions on every Elasticsearch (ES) document under it with
+        one `update_by_query`. Agave is only called again for the documents
+        flagged with `explicitPems`, i.e. shared on their own, see
+        :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`.
+        This method does not creates ES documents or do any deduping.
+        The whole subtree is always updated.
 
         :param str system_id: system id
         :param str path: path to walk
         :param str username: username who is making the request
-        :param bool bottom_up: if `True` iterate through the ES documents from the bottom
-            to the top based on path length
-        :param int levels: number of levels to iterate through. If `bottom_up` is set
-            to `True` this does not do anything.
 
         :returns: count of documents updated
         :rtype: int
-
-        Notes
-        -----
-
-            In order to get all the documents that are children of the given path
-            we use a search that searches on `path._path` property of the document
-            this is set with a hierarchy tokenizer.
-
-            This means that with one search we can get all the children documents
-            of a given path in one call, but they are not necessarily going
-            to be sorted. In order to sort the files we sort them by the length
-            of their paths. This is not necessarily correct but it is good enough
-            for updating permissions.
         """
         import urllib
-        cnt = 0
-        r, s = Object.listing_recursive(system_id, username, path)
-        objs = sorted(s.scan(), key = lambda x: len(x.path.split('/')), reverse=bottom_up)
-        if levels:
-            objs = filter(lambda x: len(x.path.split('/')) <= levels, objs)
-        p, n = os.path.split(path)
-        if p == '':
-            p = '/'
-        objs.append(Object.from_file_path(system_id, username, os.path.join(p, n)))
-        for o in objs:
-            if len(o.path.split('/')) == 1 and o.name == 'Shared with me':
-                continue
-            pems = self.call_operation('files.listPermissions', filePath = urllib.quote(os.path.join(o.path, o.name)), systemId = system_id)
-            o.update(permissions = pems)
-            cnt += 1
 
+        def _list_pems(system, file_path):
+            return self.call_operation('files.listPermissions',
+                                       filePath = urllib.quote(file_path.strip('/')),
+                                       systemId = system)
+
+        owner = path.strip('/').split('/')[0]
+        propagator = PermissionsPropagator(
+            Object._doc_type.index, 'systemId', _list_pems,
+            exclude=[{'bool': {'filter': [
+                {'term': {'path._exact': owner}},
+                {'term': {'name._exact': 'Shared with me'}}]}}])
+        cnt, pems_calls = propagator.propagate(system_id, path)
         return cnt
@@ -3,7 +3,10 @@ from agavepy.async import AgaveAsyncResponse, TimeoutError, Error
 from designsafe.apps.api.exceptions import ApiException
 from designsafe.apps.api.data.agave.agave_object import AgaveObject
 from designsafe.apps.api.data.agave.file import AgaveFile
-from designsafe.apps.api.data.agave.elasticsearch.documents import Object, PublicObject
+from designsafe.apps.api.data.agave.elasticsearch.documents import (Object, PublicObject,
+                                                                     PublicMetadata)
+from designsafe.libs.elasticsearch.cursor import decode_cursor
+from designsafe.libs.elasticsearch.projections import source_filter, LISTING, SEARCH
 from django.conf import settings
 from django.core.urlresolvers import reverse
 import urllib
@@ -99,15 +102,20 @@ class FileManager(AgaveObject):
             for more information.
         """
         file_path = file_path or '/'
-        res, listing  = PublicObject.listing(system, file_path, **kwargs)
+        kwargs.setdefault('projection', LISTING)
+        s, next_cursor = PublicObject.listing_page(system, file_path, **kwargs)
+        res, listing = PublicObject._execute_search(s)
 
         default_pems = [{'username': self.username,
                          'permission': {'read': True,
                                         'write': False,
                                         'execute': True},
                          'recursive': True}]
+        # Projects and experiments of every listed object, read at once
+        metadata = PublicMetadata()
 
         if file_path == '/':
+            metadata.prefetch([getattr(o, 'project', None) for o in listing])
             list_data = {
                 'source': self.resource,
                 'system': 'nees.public',
@@ -118,15 +126,23 @@ class FileManager(AgaveObject):
                 'ext': '',
                 'size': None,
                 'lastModified': None,
-                'children': [o.to_dict(def_pems = default_pems, with_meta = True) for o in listing],
+                'children': [o.to_dict(def_pems = default_pems, with_meta = True,
+                                       metadata = metadata) for o in listing],
+                'cursor': next_cursor(res),
                 '_trail': [],
                 '_pems': default_pems
             }
         else:
             root_listing = PublicObject.from_file_path(system, file_path)
             if root_listing:
-                list_data = root_listing.to_dict(def_pems = default_pems)
-                list_data['children'] = [o.to_dict(def_pems = default_pems) for o in listing]
+                metadata.prefetch([getattr(root_listing, 'project', None)] +
+                                  [getattr(o, 'project', None) for o in listing])
+                list_data = root_listing.to_dict(def_pems = default_pems,
+                                                 metadata = metadata)
+                list_data['children'] = [o.to_dict(def_pems = default_pems,
+                                                   metadata = metadata)
+                                         for o in listing]
+                list_data['cursor'] = next_cursor(res)
             else:
                 list_data = None
 
@@ -187,6 +203,9 @@ class FileManager(AgaveObject):
 
         :param str file_id: id representing the file. Format:
         <filesystem id>[/ | /<username> [/ | /<file_path>] ]
+        :param str projection: `_source` preset of the children, see
+            :attr:`~designsafe.apps.api.data.agave.elasticsearch.documents.PublicObject.SOURCE_PRESETS`.
+            Default: `listing`
 
         :returns:listing dict. A dict with the properties of the
         parent path file object plus a `children` key with a list
@@ -226,12 +245,23 @@ class FileManager(AgaveObject):
 
         """
         system, file_path = self.parse_file_id(file_id)
+        cursor = kwargs.get('cursor')
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError:
+                raise ApiException('Invalid cursor', status=400)
+        try:
+            source_filter(PublicObject.SOURCE_PRESETS, kwargs.get('projection', LISTING))
+        except ValueError:
+            raise ApiException('Invalid projection', status=400)
         listing = None
         try:
             listing = self._es_listing(system, self.username, file_path, **kwargs)
         except Exception as e:
             logger.debug('Error listing using Es. Falling back to Aagave', exc_info=True)
         fallback = listing is None or(
+            not cursor and
             listing['type'] == 'folder' and
             len(listing['children']) == 0)
 
@@ -337,7 +367,17 @@ class FileManager(AgaveObject):
             return None
 
     def search(self, **kwargs):
+        kwargs.setdefault('projection', SEARCH)
+        try:
+            source_filter(PublicObject.SOURCE_PRESETS, kwargs['projection'])
+        except ValueError:
+            raise ApiException('Invalid projection', status=400)
         res, s = PublicObject.search_query_with_projects(self.system_id, self.username, **kwargs)
+        hits = [o for o in s if not o.path.startswith('%s/.Trash' % self.username)]
+        # Hits are projects when the query matches more projects than a page
+        metadata = PublicMetadata()
+        metadata.prefetch([getattr(o, 'project', None) for o in hits
+                           if isinstance(o, PublicObject)])
         search_data = {
             'source': self.resource,
             'system': 'nees.public',
@@ -349,7 +389,8 @@ class FileManager(AgaveObject):
             'size': None,
             'lastModified': None,
             'query': {'q': kwargs.get('q'), 'fields': kwargs.get('fields', [])},
-            'children': [o.to_dict() for o in s if not o.path.startswith('%s/.Trash' % self.username)],
+            'children': [o.to_dict(metadata=metadata) if isinstance(o, PublicObject)
+                         else o.to_dict() for o in hits],
             '_trail': [],
             '_pems': [{'username': self.username, 'permission': {'read': True}}],
         }
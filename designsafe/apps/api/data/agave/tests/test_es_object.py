@@ -4,9 +4,13 @@ from django.conf import settings
 from designsafe.apps.api.exceptions import ApiException
 from designsafe.apps.api.data.agave.file import AgaveFile
 from designsafe.apps.api.data.agave.agave_object import AgaveObject
-from designsafe.apps.api.data.agave.elasticsearch.documents import Object
+from designsafe.apps.api.data.agave.elasticsearch.documents import Object, PublicMetadata
+from designsafe.libs.elasticsearch.cursor import encode_cursor
+from designsafe.libs.elasticsearch.docs import file_doc_id
+from designsafe.libs.elasticsearch.projections import LISTING, DETAIL
 from designsafe.apps.auth.models import AgaveOAuthToken
 from agavepy.agave import Agave
+from elasticsearch_dsl import DocType
 import dateutil.parser
 import mock
 import json
@@ -49,6 +53,34 @@ class FileBaseTestCase(TestCase):
         self.afile_json = afile_json[0]
         self.apems_json = apems_json
 
+    def patch_upsert(self):
+        """Patches the ES calls done by :meth:`Object.save`.
+
+        The upserted document is the first argument of
+        `self.mock_es_save`'s call.
+        """
+        patcher = mock.patch.object(DocType, 'save', autospec=True)
+        self.mock_es_save = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            'designsafe.apps.api.data.agave.elasticsearch.documents.connections')
+        self.mock_conn = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            'designsafe.apps.api.data.agave.elasticsearch.documents.bump_generation')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            'designsafe.apps.api.data.agave.elasticsearch.documents.new_file_doc_id',
+            side_effect=lambda index, doc_type, system, path: file_doc_id(system, path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upserted(self):
+        """Returns the document written by the last :meth:`Object.save`"""
+        self.assertEqual(self.mock_es_save.call_count, 1)
+        return self.mock_es_save.call_args[0][0]
+
     def get_mock_agave_file(self):
         ac = mock.Mock()
         wrap = self.afile_json.copy()
@@ -128,58 +160,37 @@ class FileCopyTestCase(FileBaseTestCase):
         self.assertEqual(doc_copy.name, target_name)
         mock_listing_recursive.assert_not_called()
 
-    @mock.patch.object(Object, 'save')
-    @mock.patch.object(Object, 'listing_recursive') 
-    def test_copy_folder_is_creating_correct_objects(self, 
-                        mock_listing_recursive, mock_save):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
-        doc = self.get_mock_object_folder()
-        doc.path, doc.name = os.path.split(listing_json[0]['path'])
-
-        target_path = doc.path + '/another folder'
-        target_name = 'folder_copy'
-
-        with mock.patch('designsafe.apps.api.data.agave.elasticsearch.documents.Object', spce = Object) as mock_obj_class:
-            mock_obj_class.save.return_value = None
-            doc_copy = doc.copy(self.user.username, os.path.join(target_path, target_name))
-            #print 'Obj class was called: %d times' % mock_obj_class.call_count
-            obj_class_calls = mock_obj_class.call_args_list
-
-        for i, d in enumerate(listing_json):
-            args, d_call = obj_class_calls[i]
-            regex = r'^{}'.format(os.path.join(doc.path, doc.name))
-            self.assertEqual(d_call['path'], re.sub(regex, 
-                                os.path.join(target_path, target_name),
-                                d['path']))
+    @mock.patch.object(Object, 'listing_recursive')
+    def test_copy_file_id(self, mock_listing_recursive):
+        self.patch_upsert()
+        doc = self.get_mock_object_file()
+        target_name = 'file_copy.txt'
+        doc_copy = doc.copy(self.user.username, target_name)
 
-        mock_listing_recursive.assert_called_with(doc.systemId, 
-                self.user.username, os.path.join(doc.path, doc.name))
+        self.assertEqual(doc_copy.meta.id, file_doc_id(
+            self.afile_json['system'], os.path.join(doc.path, target_name)))
 
+    @mock.patch('designsafe.apps.api.tasks.copy_path_prefix')
     @mock.patch.object(Object, 'save')
     @mock.patch.object(Object, 'listing_recursive') 
-    def test_copy_folder_is_saving_objects(self, 
-                        mock_listing_recursive, mock_save):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
+    def test_copy_folder_reindexes_children(self, 
+                        mock_listing_recursive, mock_save, mock_copy_path_prefix):
         doc = self.get_mock_object_folder()
 
+        target_path = doc.path + '/another folder'
         target_name = 'folder_copy'
-        
-        doc_copy = doc.copy(self.user.username, target_name)
-        self.assertEqual(mock_save.call_count, len(listing_json) + 2)
-        mock_listing_recursive.assert_called_with(doc.systemId, 
-                self.user.username, os.path.join(doc.path, doc.name))
+        doc_copy = doc.copy(self.user.username, os.path.join(target_path, target_name))
+
+        mock_copy_path_prefix.apply_async.assert_called_with(
+            args=[Object._doc_type.index, 'systemId', doc.systemId,
+                  os.path.join(doc.path, doc.name),
+                  os.path.join(target_path, target_name)],
+            kwargs={'agave_path': True},
+            queue='indexing')
+        self.assertEqual(doc_copy.path, target_path)
+        self.assertEqual(doc_copy.name, target_name)
+        self.assertEqual(mock_save.call_count, 2)
+        mock_listing_recursive.assert_not_called()
  
      
 class FileDeleteTestCase(FileBaseTestCase):
@@ -194,120 +205,110 @@ class FileDeleteTestCase(FileBaseTestCase):
         self.assertTrue(mock_delete.called)
         mock_listing_recursive.assert_not_called()
 
+    @mock.patch('designsafe.apps.api.tasks.bump_generation_on_completion.apply_async')
+    @mock.patch('designsafe.libs.elasticsearch.docs.delete_path_prefix')
     @mock.patch.object(Object, 'delete')
     @mock.patch.object(Object, 'listing_recursive')
-    def test_delete_folder(self, mock_listing_recursive, mock_delete):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
+    def test_delete_folder(self, mock_listing_recursive, mock_delete,
+                           mock_delete_path_prefix, mock_bump):
+        mock_delete_path_prefix.return_value = ('node:1', 3)
         doc = self.get_mock_object_folder()
 
         cnt = doc.delete_recursive(self.user.username)
 
-        mock_listing_recursive.assert_called_with(self.afolder_json['system'],
-                    self.user.username, self.afolder_json['path'])
-        self.assertEqual(mock_delete.call_count, len(listing_json) + 1)
+        mock_delete_path_prefix.assert_called_with(
+            Object._doc_type.index, 'systemId', self.afolder_json['system'],
+            doc.full_path)
+        self.assertEqual(cnt, 4)
+        self.assertEqual(mock_delete.call_count, 1)
+        mock_listing_recursive.assert_not_called()
+        mock_bump.assert_called_once_with(args=['node:1', Object._doc_type.index],
+                                          queue='indexing')
 
 class FileMoveTestCase(FileBaseTestCase):
-    @mock.patch.object(Object, 'save')
     @mock.patch.object(Object, 'update')
     @mock.patch.object(Object, 'listing_recursive')
-    def test_move_file(self, mock_listing_recursive, mock_update, mock_save):
+    def test_move_file(self, mock_listing_recursive, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
-        mock_listing_recursive.return_value = None
         target_path = 'path/to/new folder'
 
         doc.move(self.user.username, '%s/%s' % (target_path, doc.name))
-        
-        mock_update.assert_called_with(path = target_path,
-                    agavePath = 'agave://{}/{}'.format(self.afile_json['system'],
-                        os.path.join(target_path, self.afile_json['name'])))
-        self.assertTrue(mock_save.called)
+
+        upserted = self.upserted()
+        self.assertEqual(upserted.path, target_path)
+        self.assertEqual(upserted.agavePath, 'agave://{}/{}'.format(
+            self.afile_json['system'], os.path.join(target_path, self.afile_json['name'])))
+        self.assertEqual(upserted.meta.id, '__mock__')
+        self.mock_conn.get_connection.return_value.delete.assert_not_called()
+        mock_update.assert_not_called()
         mock_listing_recursive.assert_not_called()
 
-    @mock.patch.object(Object, 'save')
+    @mock.patch('designsafe.apps.api.tasks.update_path_prefix')
     @mock.patch.object(Object, 'update')
     @mock.patch.object(Object, 'listing_recursive')
-    def test_move_folder(self, mock_listing_recursive, mock_update, mock_save):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
+    def test_move_folder(self, mock_listing_recursive, mock_update,
+                         mock_update_path_prefix):
+        self.patch_upsert()
         doc = self.get_mock_object_folder()
+        setattr(doc.meta, 'id', '__mock__')
+        origin_path = doc.full_path
         target_path = 'path/to/new folder'
         doc.move(self.user.username, '%s/%s' % (target_path, doc.name))
-        update_calls = mock_update.call_args_list
-
-        for i, d in enumerate(listing_json):
-            args, d_call = update_calls[i]
-            regex = r'^{}'.format(self.afolder_json['path'])
-            self.assertEqual(d_call['path'], 
-                             re.sub(regex, 
-                                os.path.join(target_path, self.afolder_json['name']),
-                                d['path']))
-
-        args, d_call = update_calls[-1]
-        self.assertEqual(d_call['path'], target_path)
-        self.assertEqual(mock_save.call_count, len(listing_json) + 1)
-        mock_listing_recursive.assert_called_with(self.afolder_json['system'],
-                self.user.username, self.afolder_json['path'])
-                                                        
+
+        mock_update_path_prefix.apply_async.assert_called_with(
+            args=[Object._doc_type.index, 'systemId', self.afolder_json['system'],
+                  origin_path, os.path.join(target_path, doc.name)],
+            kwargs={'agave_path': True},
+            queue='indexing')
+        upserted = self.upserted()
+        self.assertEqual(upserted.path, target_path)
+        self.assertEqual(upserted.meta.id, '__mock__')
+        mock_update.assert_not_called()
+        mock_listing_recursive.assert_not_called()
+
 class FileRenameTestcase(FileBaseTestCase):
-    @mock.patch.object(Object, 'save')
     @mock.patch.object(Object, 'update')
     @mock.patch.object(Object, 'listing_recursive')
-    def test_rename_file(self, mock_listing_recursive, mock_update, mock_save):
+    def test_rename_file(self, mock_listing_recursive, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
-        mock_listing_recursive.return_value = None
         target_name = 'rename_file.txt'
 
         doc.rename(self.user.username, target_name)
-        
-        origin_path = os.path.split(self.afile_json['path'])[0]
 
-        mock_update.assert_called_with(name = target_name,
-                    agavePath = 'agave://{}/{}'.format(self.afile_json['system'],
-                        os.path.join(origin_path, target_name)))
-        self.assertTrue(mock_save.called)
+        origin_path = os.path.split(self.afile_json['path'])[0]
+        upserted = self.upserted()
+        self.assertEqual(upserted.name, target_name)
+        self.assertEqual(upserted.agavePath, 'agave://{}/{}'.format(
+            self.afile_json['system'], os.path.join(origin_path, target_name)))
+        self.assertEqual(upserted.meta.id, '__mock__')
+        self.mock_conn.get_connection.return_value.delete.assert_not_called()
+        mock_update.assert_not_called()
         mock_listing_recursive.assert_not_called()
 
-    @mock.patch.object(Object, 'save')
+    @mock.patch('designsafe.apps.api.tasks.update_path_prefix')
     @mock.patch.object(Object, 'update')
     @mock.patch.object(Object, 'listing_recursive')
-    def test_rename_folder(self, mock_listing_recursive, mock_update, mock_save):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
+    def test_rename_folder(self, mock_listing_recursive, mock_update,
+                           mock_update_path_prefix):
+        self.patch_upsert()
         doc = self.get_mock_object_folder()
+        setattr(doc.meta, 'id', '__mock__')
+        origin_path = doc.full_path
         target_name = 'renamed folder'
         doc.rename(self.user.username, target_name)
-        update_calls = mock_update.call_args_list
 
-        origin_path = os.path.split(self.afolder_json['path'])[0]
-        for i, d in enumerate(listing_json):
-            args, d_call = update_calls[i]
-            regex = r'^{}'.format(self.afolder_json['path'])
-            self.assertEqual(d_call['path'], 
-                             re.sub(regex, 
-                                os.path.join(origin_path, target_name),
-                                d['path']))
-
-        args, d_call = update_calls[-1]
-        self.assertEqual(d_call['name'], target_name)
-        self.assertEqual(mock_save.call_count, len(listing_json) + 1)
-        mock_listing_recursive.assert_called_with(self.afolder_json['system'],
-                self.user.username, self.afolder_json['path'])
+        mock_update_path_prefix.apply_async.assert_called_with(
+            args=[Object._doc_type.index, 'systemId', self.afolder_json['system'],
+                  origin_path, os.path.join(doc.path, target_name)],
+            kwargs={'agave_path': True},
+            queue='indexing')
+        upserted = self.upserted()
+        self.assertEqual(upserted.name, target_name)
+        self.assertEqual(upserted.meta.id, '__mock__')
+        mock_update.assert_not_called()
+        mock_listing_recursive.assert_not_called()
 
 
 class FileShareTestCase(FileBaseTestCase):
@@ -348,56 +349,45 @@ class FileShareTestCase(FileBaseTestCase):
         mock_listing_recursive.assert_not_called()
         self.assertTrue(mock_save.called)
 
+    @mock.patch('designsafe.apps.api.tasks.bump_generation_on_completion.apply_async')
+    @mock.patch('designsafe.libs.elasticsearch.docs.update_path_prefix_pems')
     @mock.patch.object(Object, 'listing_recursive')
     @mock.patch.object(Object, 'save')
     @mock.patch.object(Object, 'update_pems')
     @mock.patch('designsafe.apps.api.data.agave.elasticsearch.documents.Object.from_file_path')
     def test_share_file(self, mock_obj_from_file_path, mock_update_pems, 
-                                mock_save, mock_listing_recursive):
-        lp = 'designsafe/apps/api/fixtures/object_listing_recursive.json'
-        with open(lp) as f:
-            listing_json = json.load(f)
-
-        s = MockListingRecursive()
-        mock_listing_recursive.return_value = (None, s)
-
+                                mock_save, mock_listing_recursive,
+                                mock_update_path_prefix_pems, mock_bump):
+        mock_update_path_prefix_pems.return_value = ('node:1', 3)
         doc = self.get_mock_object_folder()
 
-        mock_obj = mock.Mock(spec = Object, autospec=True)
-        mock_obj_from_file_path.return_value = mock_obj
-
-        file_path = os.path.split(self.afolder_json['path'])[0]
-        file_path_comps = file_path.split('/')
-
         pems = 'READ_WRITE'
         user_to_share = 'share_user'
         doc.share(self.user.username, [{'user_to_share': user_to_share, 'permission': pems}])
 
-        from_file_path_calls = mock_obj_from_file_path.call_args_list
-        for call in from_file_path_calls:
-            args, kwargs = call
-            self.assertEqual(args[0], self.afolder_json['system'])
-            self.assertEqual(args[1], self.user.username)
-            self.assertEqual(args[2], '/'.join(file_path_comps))
-            file_path_comps.pop()
-
-        update_pems_calls = mock_update_pems.call_args_list
-        for call in update_pems_calls:
-            args, kwrgs = call
-            self.assertEqual(args[0][0]['user_to_share'], user_to_share)
-            self.assertEqual(args[0][0]['permission'], pems)
-
-        self.assertEqual(mock_update_pems.call_count, len(listing_json) + 1)
-        # we are not updating parent directory anymore.
-        #self.assertEqual(mock_obj().save.call_count, len(file_path_comps))
-        mock_listing_recursive.assert_called_with(self.afolder_json['system'],
-                        self.user.username, self.afolder_json['path'])
+        args, kwargs = mock_update_path_prefix_pems.call_args
+        self.assertEqual(args[:4], (Object._doc_type.index, 'systemId',
+                                    self.afolder_json['system'], doc.full_path))
+        self.assertEqual(args[4][0]['username'], user_to_share)
+        self.assertTrue(args[4][0]['permission']['read'])
+        self.assertTrue(args[4][0]['permission']['write'])
+        self.assertEqual(kwargs['usernames'], [user_to_share])
+        self.assertEqual(kwargs['filters'],
+                         [{'terms': {'readers': [self.user.username]}}])
+        mock_bump.assert_called_once_with(args=['node:1', Object._doc_type.index],
+                                          queue='indexing')
+
+        args, kwargs = mock_update_pems.call_args
+        self.assertEqual(args[0][0]['user_to_share'], user_to_share)
+        self.assertEqual(args[0][0]['permission'], pems)
+        self.assertEqual(mock_update_pems.call_count, 1)
+        mock_listing_recursive.assert_not_called()
         self.assertTrue(mock_save.called)
 
 class FileUpdatePemsTestCase(FileBaseTestCase):
-    @mock.patch.object(Object, 'update')        
-    @mock.patch.object(Object, 'save')
-    def test_update_pems_update_read(self, mock_save, mock_update):
+    @mock.patch.object(Object, 'update')
+    def test_update_pems_update_read(self, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
         user_to_share = 'user_to_share'
 
@@ -416,19 +406,21 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
 
         doc.update_pems([{'user_to_share': user_to_share, 'permission': 'READ'}])
 
-        _, kwargs = mock_update.call_args
-        updated_pems = kwargs['permissions']
+        upserted = self.upserted()
+        updated_pems = upserted.permissions
+        self.assertIn(user_to_share, upserted.readers)
 
         self.assertEqual(len(updated_pems), len(origin_pems))
         self.assertTrue(updated_pems[0]['permission']['read'])
         self.assertFalse(updated_pems[0]['permission']['write'])
         self.assertFalse(updated_pems[0]['permission']['execute'])
         self.assertEqual(updated_pems[0]['username'], user_to_share)
-        self.assertTrue(mock_save.called)
+        self.assertEqual(upserted.meta.id, '__mock__')
+        mock_update.assert_not_called()
 
-    @mock.patch.object(Object, 'update')        
-    @mock.patch.object(Object, 'save')
-    def test_update_pems_update_write(self, mock_save, mock_update):
+    @mock.patch.object(Object, 'update')
+    def test_update_pems_update_write(self, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
         user_to_share = 'user_to_share'
 
@@ -447,19 +439,20 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
 
         doc.update_pems([{'user_to_share': user_to_share, 'permission': 'WRITE'}])
 
-        _, kwargs = mock_update.call_args
-        updated_pems = kwargs['permissions']
+        upserted = self.upserted()
+        updated_pems = upserted.permissions
 
         self.assertEqual(len(updated_pems), len(origin_pems))
         self.assertFalse(updated_pems[0]['permission']['read'])
         self.assertTrue(updated_pems[0]['permission']['write'])
         self.assertFalse(updated_pems[0]['permission']['execute'])
         self.assertEqual(updated_pems[0]['username'], user_to_share)
-        self.assertTrue(mock_save.called)
+        self.assertEqual(upserted.meta.id, '__mock__')
+        mock_update.assert_not_called()
 
-    @mock.patch.object(Object, 'update')        
-    @mock.patch.object(Object, 'save')
-    def test_update_pems_add_read(self, mock_save, mock_update):
+    @mock.patch.object(Object, 'update')
+    def test_update_pems_add_read(self, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
         new_user_to_share = 'new_user_to_share'
 
@@ -478,8 +471,8 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
 
         doc.update_pems([{'user_to_share': new_user_to_share, 'permission': 'READ'}])
 
-        _, kwargs = mock_update.call_args
-        updated_pems = kwargs['permissions']
+        upserted = self.upserted()
+        updated_pems = upserted.permissions
 
         for pems in updated_pems:
             if pems['username'] == 'user_to_share':
@@ -492,11 +485,11 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
                 self.assertFalse(pems['permission']['execute'])
 
         self.assertEqual(len(updated_pems), len(origin_pems) + 1)
-        self.assertTrue(mock_save.called)
+        mock_update.assert_not_called()
 
-    @mock.patch.object(Object, 'update')        
-    @mock.patch.object(Object, 'save')
-    def test_update_pems_add_write(self, mock_save, mock_update):
+    @mock.patch.object(Object, 'update')
+    def test_update_pems_add_write(self, mock_update):
+        self.patch_upsert()
         doc = self.get_mock_object_file()
         new_user_to_share = 'new_user_to_share'
 
@@ -515,8 +508,8 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
 
         doc.update_pems([{'user_to_share': new_user_to_share, 'permission': 'WRITE'}])
 
-        _, kwargs = mock_update.call_args
-        updated_pems = kwargs['permissions']
+        upserted = self.upserted()
+        updated_pems = upserted.permissions
 
         for pems in updated_pems:
             if pems['username'] == 'user_to_share':
@@ -529,4 +522,67 @@ class FileUpdatePemsTestCase(FileBaseTestCase):
                 self.assertFalse(pems['permission']['execute'])
 
         self.assertEqual(len(updated_pems), len(origin_pems) + 1)
-        self.assertTrue(mock_save.called)
+        mock_update.assert_not_called()
+
+class FileSearchPageTestCase(TestCase):
+    def test_search_page_filters_trash_and_projects_source(self):
+        s, _ = Object.search_page('ds_user', 'test', limit=50)
+        body = s.to_dict()
+        self.assertEqual(body['size'], 50)
+        self.assertEqual(body['sort'], ['path._exact', 'name._exact', '_uid'])
+        self.assertEqual(body['query']['bool']['must_not'],
+                         [{'prefix': {'path._exact': 'ds_user/.Trash'}}])
+        self.assertEqual(body['_source']['include'], Object.FILE_DICT_FIELDS)
+
+    def test_search_page_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            Object.search_page('ds_user', 'test', cursor='not a cursor')
+
+
+class ListingPageTestCase(TestCase):
+    def test_listing_page_offset(self):
+        s, _ = Object.listing_page('designsafe.storage.default', 'ds_user',
+                                   'ds_user/folder', offset='100', limit='50')
+        body = s.to_dict()
+        self.assertEqual(body['sort'], ['name._exact', '_uid'])
+        self.assertEqual(body['from'], 100)
+        self.assertEqual(body['size'], 50)
+        self.assertNotIn('search_after', body)
+
+    def test_listing_page_cursor(self):
+        cursor = encode_cursor(['file.txt', 'objects#1234'])
+        s, _ = Object.listing_page('designsafe.storage.default', 'ds_user',
+                                   'ds_user/folder', offset=100, cursor=cursor)
+        body = s.to_dict()
+        self.assertEqual(body['search_after'], ['file.txt', 'objects#1234'])
+        self.assertNotIn('from', body)
+
+    def test_listing_page_projection(self):
+        s, _ = Object.listing_page('designsafe.storage.default', 'ds_user',
+                                   'ds_user/folder', projection=LISTING)
+        self.assertEqual(s.to_dict()['_source']['include'], Object.FILE_DICT_FIELDS)
+        s, _ = Object.listing_page('designsafe.storage.default', 'ds_user',
+                                   'ds_user/folder', projection=DETAIL)
+        self.assertNotIn('_source', s.to_dict())
+        with self.assertRaises(ValueError):
+            Object.listing_page('designsafe.storage.default', 'ds_user',
+                                'ds_user/folder', projection='everything')
+
+
+class PublicMetadataTestCase(TestCase):
+    @mock.patch('designsafe.apps.api.data.agave.elasticsearch.documents.MultiSearch.execute')
+    def test_prefetch_reads_projects_once(self, mock_execute):
+        project = mock.Mock()
+        project.name = 'NEES-1'
+        experiment = mock.Mock(project='NEES-1')
+        experiment.name = 'Experiment-1'
+        mock_execute.return_value = [[project], [experiment]]
+
+        metadata = PublicMetadata()
+        metadata.prefetch(['NEES-1.groups', 'NEES-2', None])
+        self.assertEqual(metadata.project('NEES-1'), project)
+        self.assertIsNone(metadata.project('NEES-2'))
+        self.assertEqual(metadata.experiment('NEES-1', 'Experiment-1'), experiment)
+        self.assertIsNone(metadata.experiment('NEES-1', 'Experiment-2'))
+        self.assertEqual(metadata.experiments('NEES-2'), [])
+        self.assertEqual(mock_execute.call_count, 1)
@@ -715,3 +715,28 @@ import json
 #        mock_share_task.assert_called_with(
 #            args=(self.user.username, file_id, permissions, True), queue='indexing')
 #
+
+
+class FileManagerSearchTestCase(TestCase):
+    """Tests for the validation of search parameters"""
+
+    def setUp(self):
+        self.fm = FileManager.__new__(FileManager)
+        self.fm.username = 'ds_user'
+
+    @mock.patch.object(Object, 'search_page')
+    def test_invalid_limit(self, mock_search_page):
+        for limit in ('ten', None, '0'):
+            with self.assertRaises(ApiException) as cm:
+                self.fm._search_page(q='test', limit=limit)
+            self.assertEqual(cm.exception.response.status_code, 400)
+            self.assertIn('limit', cm.exception.message)
+        mock_search_page.assert_not_called()
+
+    @mock.patch.object(Object, 'search_page')
+    def test_invalid_cursor(self, mock_search_page):
+        mock_search_page.side_effect = ValueError('Invalid cursor')
+        with self.assertRaises(ApiException) as cm:
+            self.fm._search_page(q='test', limit='20', cursor='not a cursor')
+        self.assertEqual(cm.exception.message, 'Invalid cursor')
+        self.assertEqual(mock_search_page.call_args[1]['limit'], 20)
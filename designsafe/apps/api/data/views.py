@@ -1,6 +1,7 @@
-from django.http.response import HttpResponseBadRequest
+from django.http.response import HttpResponseBadRequest, StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.shortcuts import render, redirect
+from django.core.serializers.json import DjangoJSONEncoder
 
 from designsafe.apps.api.views import BaseApiView
 from designsafe.apps.api.mixins import JSONResponseMixin, SecureMixin
@@ -9,6 +10,7 @@ from designsafe.apps.api.data import lookup_file_manager
 from designsafe.apps.api.data.sources import SourcesApi
 from designsafe.apps.api.notifications.models import Notification, Broadcast
 from designsafe.libs.common.decorators import profile
+from designsafe.libs.elasticsearch.cursor import decode_cursor
 
 import logging
 import json
@@ -181,8 +183,26 @@ class DataSearchView(BaseDataView):
     It will pass all the keyword arguments as well as the
     Query String parameters as a dictionary on to the `search`
     method of the file manager class.
+
+    With `format=ndjson` every hit is streamed as one JSON document
+    per line, for file managers implementing `search_stream`.
     """
     def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'ndjson':
+            fm = self._get_file_manager(request, **kwargs)
+            if not hasattr(fm, 'search_stream'):
+                return HttpResponseBadRequest('Streaming is not supported')
+            d = dict(kwargs)
+            d.update(request.GET.dict())
+            if d.get('cursor'):
+                try:
+                    decode_cursor(d['cursor'])
+                except ValueError:
+                    return HttpResponseBadRequest('Invalid cursor')
+            lines = (json.dumps(f, cls=DjangoJSONEncoder) + '\n'
+                     for f in fm.search_stream(**d))
+            return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
         resp = self._execute_operation(request, 'search', **kwargs)
         return self.render_to_json_response(resp)
 
@@ -181,7 +181,8 @@ def index_job_outputs(user, job):
     mgr = AgaveFileManager(user)
     mgr.indexer.index(system_id, archive_path, user.username,
                       full_indexing = True, pems_indexing = True,
-                      index_full_path = True)
+                      index_full_path = True, bulk = True,
+                      concurrent_walk = True, incremental = True)
 
 
 class FilesWebhookView(SecureMixin, JSONResponseMixin, BaseApiView):
@@ -17,6 +17,7 @@ from designsafe.apps.api.projects.views import (ProjectListingView,
                                                 ProjectCollaboratorsView,
                                                 ProjectInstanceView,
                                                 ProjectMetaView,
+                                                ProjectUsageView,
                                                 PublicationView)
 from designsafe.apps.api.projects.managers.yamz import YamzBaseView
 
@@ -55,6 +56,9 @@ urlpatterns = [
     url(r'^(?P<project_id>[a-z0-9\-]+)/collaborators/$',
         ProjectCollaboratorsView.as_view(), name='project_collaborators'),
 
+    url(r'^(?P<project_id>[a-z0-9\-]+)/usage/$',
+        ProjectUsageView.as_view(), name='project_usage'),
+
     url(r'^(?P<project_id>[a-z0-9\-]+)/data/$',
         ProjectDataView.as_view(), name='project_data'),
 
@@ -31,6 +31,9 @@ from designsafe.apps.projects.models.agave.experimental import (
 from designsafe.apps.projects.models.agave import simulation, hybrid_simulation
 from designsafe.apps.api.agave.filemanager.public_search_index import (PublicationManager,
                                                                        Publication)
+from designsafe.apps.projects.models.elasticsearch import IndexedProject
+from designsafe.apps.data.managers.usage import UsageRollup, PROJECT
+from elasticsearch_dsl.query import Q
 logger = logging.getLogger(__name__)
 metrics = logging.getLogger('metrics.{name}'.format(name=__name__))
 
@@ -400,6 +403,37 @@ class ProjectCollaboratorsView(SecureMixin, BaseApiView):
         return JsonResponse({'status': 'ok'})
 
 
+class ProjectUsageView(SecureMixin, BaseApiView):
+
+    @profile_fn
+    def get(self, request, project_id):
+        """Storage used by a project, for its members.
+
+        Served from the project's usage rollup, see
+        :class:`~designsafe.apps.data.managers.usage.UsageRollup`.
+        Files changed in storage are counted once they are indexed
+        again, `updated` is when the rollup last changed.
+
+        :rtype: JsonResponse
+        """
+        username = request.user.username
+        member = Q('nested', path='value', query=Q('bool', should=[
+            Q('term', **{'value.teamMembers._exact': username}),
+            Q('term', **{'value.coPis._exact': username}),
+            Q('term', **{'value.pi._exact': username})
+        ]))
+        search = IndexedProject.search()\
+            .filter('term', **{'uuid._exact': project_id})\
+            .filter(member)
+        if not search.count():
+            return HttpResponseForbidden()
+
+        usage = UsageRollup().get(PROJECT, project_id)
+        return JsonResponse({'total_storage_bytes': usage.totalBytes,
+                             'file_count': usage.fileCount,
+                             'updated': usage.updated})
+
+
 class ProjectDataView(SecureMixin, BaseApiView):
 
     @profile_fn
@@ -34,6 +34,7 @@ from designsafe.apps.api.agave.filemanager.search_index import ElasticFileManage
 from designsafe.apps.api.agave.filemanager.community import CommunityFileManager
 from designsafe.apps.api.agave.filemanager.published import PublishedFileManager
 from designsafe.apps.api.agave.views import FileMediaView
+from designsafe.libs.elasticsearch.projections import LISTING, SEARCH
 
 logger = logging.getLogger(__name__)
 
@@ -75,8 +76,15 @@ class PublicDataListView(BaseApiView):
         offset = int(request.GET.get('offset', 0))
         limit = int(request.GET.get('limit', 100))
         status = request.GET.get('status', 'published')
-        listing = file_mgr.listing(system_id, file_path,
-                                   offset=offset, limit=limit, status=status)
+        kwargs = {}
+        if file_mgr_name == PublicElasticFileManager.NAME:
+            kwargs['cursor'] = request.GET.get('cursor')
+            kwargs['projection'] = request.GET.get('projection', LISTING)
+        try:
+            listing = file_mgr.listing(system_id, file_path, offset=offset,
+                                       limit=limit, status=status, **kwargs)
+        except ValueError as err:
+            return HttpResponseBadRequest(str(err))
         # logger.debug(listing.to_dict()['children'][0])
         return JsonResponse(listing.to_dict())
 
@@ -114,6 +122,7 @@ class PublicSearchView(BaseApiView):
         offset = int(request.GET.get('offset', 0))
         limit = int(request.GET.get('limit', 100))
         query_string = request.GET.get('query_string')
+        cursor = request.GET.get('cursor')
         logger.debug('offset: %s, limit: %s, query_string: %s' % (str(offset), str(limit), query_string))
         if file_mgr_name != PublicElasticFileManager.NAME or not query_string:
             return HttpResponseBadRequest()
@@ -129,13 +138,22 @@ class PublicSearchView(BaseApiView):
 
         if system_id == "nees.public" or system_id == "designsafe.storage.published":
             file_mgr = PublicElasticFileManager(ag)
-            listing = file_mgr.search(system_id, query_string,
-                                    offset=offset, limit=limit)
+            try:
+                listing = file_mgr.search(system_id, query_string,
+                                          offset=offset, limit=limit,
+                                          cursor=cursor)
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
 
         elif system_id == "designsafe.storage.community":
             file_mgr = ElasticFileManager()
-            listing = file_mgr.search_community('designsafe.storage.community', query_string,
-                                    offset=offset, limit=limit) 
+            try:
+                listing = file_mgr.search_community(
+                    'designsafe.storage.community', query_string,
+                    offset=offset, limit=limit,
+                    projection=request.GET.get('projection', SEARCH))
+            except ValueError:
+                return HttpResponseBadRequest('Invalid projection')
         # logger.info(listing)
         return JsonResponse(listing)
 
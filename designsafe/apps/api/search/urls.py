@@ -1,8 +1,9 @@
 from django.conf.urls import url
-from designsafe.apps.api.search.views import SearchView
+from designsafe.apps.api.search.views import SearchView, SuggestView
 
 """
 """
 urlpatterns = [
     url(r'^/?$', SearchView.as_view(), name='search'),
+    url(r'^suggest/?$', SuggestView.as_view(), name='suggest'),
 ]
@@ -5,21 +5,43 @@
    access.
 """
 import logging
-from elasticsearch_dsl import Q, Search
+from elasticsearch_dsl import Q, Search, MultiSearch
 from elasticsearch import TransportError, ConnectionTimeout
 from django.http import (HttpResponseBadRequest,
                          JsonResponse)
 
 from designsafe.apps.api.views import BaseApiView
 from designsafe.apps.api.agave.filemanager.public_search_index import (
-    PublicElasticFileManager)
+    PublicElasticFileManager, publication_search, publication_totals)
 from designsafe.apps.api.agave.filemanager.search_index import ElasticFileManager
+from designsafe.apps.data.managers.elasticsearch import FileManager as ESFileManager
+from designsafe.libs.elasticsearch.queries import substring_query, substring_term_query
+from designsafe.libs.elasticsearch.analyzers import NGRAM_MIN
+from designsafe.libs.elasticsearch.cache import SearchCache
+from designsafe.libs.elasticsearch.docs import readers_filter, routed
+from designsafe.libs.elasticsearch.projections import apply_projection, SEARCH
+from designsafe.apps.data.models.elasticsearch import FILE_SOURCE_PRESETS
 
 logger = logging.getLogger(__name__)
 
+#: Fields searched by substring in the files index
+SUBSTRING_FIELDS = ['name', 'keywords']
+
 
 class SearchView(BaseApiView):
-    """Main view to handle sitewise search requests"""
+    """Main view to handle sitewise search requests
+
+    The active tab's hits and the total of every tab are retrieved with
+    a single `_msearch` request. Use the `counts` query parameter
+    (comma separated list of tabs) to only count some of the tabs,
+    e.g. `counts=cms,published`. Every tab is counted by default.
+
+    Files and publications are fetched with their `search` projection,
+    only the fields rendered by the results page are returned.
+    """
+    #: Tabs the client can search and count.
+    TABS = ('public_files', 'published', 'cms', 'private_files')
+
     def get(self, request):
         """GET handler."""
         q = request.GET.get('q')
@@ -29,28 +51,41 @@ class SearchView(BaseApiView):
         if (limit > 500):
             return HttpResponseBadRequest("limit must not exceed 500")
         type_filter = request.GET.get('type_filter', 'cms')
+        counts = request.GET.get('counts')
+        if counts is None:
+            count_tabs = list(self.TABS)
+        else:
+            count_tabs = [tab for tab in counts.split(',') if tab in self.TABS]
+        if not request.user.is_authenticated:
+            count_tabs = [tab for tab in count_tabs if tab != 'private_files']
 
-        if type_filter == 'public_files':
-            es_query = self.search_public_files(q, offset, limit)
-        elif type_filter == 'published':
-            es_query = self.search_published(q, offset, limit)
-        elif type_filter == 'cms':
-            es_query = self.search_cms_content(q, offset, limit)
-        elif type_filter == 'private_files':
-            es_query = self.search_my_data(self.request.user.username, q, offset, limit)
+        tabs = []
+        searches = []
+        if type_filter in self.TABS:
+            tabs.append(type_filter)
+            searches.append(self.tab_search(type_filter, q, offset, limit))
+        for tab in count_tabs:
+            if tab == type_filter:
+                continue
+            tabs.append(tab)
+            searches.append(self.tab_search(tab, q, 0, 0))
+        scopes = [request.user.username if tab == 'private_files' else None
+                  for tab in tabs]
 
+        cache = SearchCache('search')
         try:
-            res = es_query.execute()
+            responses = cache.execute_many(searches, scope=scopes)
         except (TransportError, ConnectionTimeout) as err:
             if getattr(err, 'status_code', 500) == 404:
                 raise
-            res = es_query.execute()
+            responses = cache.execute_many(searches, scope=scopes)
+        responses = dict(zip(tabs, responses))
 
-        results = [r for r in res]
         out = {}
         hits = []
-        if (type_filter != 'publications'):
-            for r in results:
+        res = responses.get(type_filter)
+        if res is not None:
+            for r in res:
                 d = r.to_dict()
                 d["doc_type"] = r.meta.doc_type
                 if hasattr(r.meta, 'highlight'):
@@ -58,17 +93,35 @@ class SearchView(BaseApiView):
                     d["highlight"] = highlight
                 hits.append(d)
 
-        out['total_hits'] = res.hits.total
+        out['total_hits'] = res.hits.total if res is not None else 0
         out['hits'] = hits
-        out['public_files_total'] = self.search_public_files(q, offset, limit).count()
-        out['published_total'] = self.search_published(q, offset, limit).count()
-        out['cms_total'] = self.search_cms_content(q, offset, limit).count()
-        out['private_files_total'] = 0
-        if request.user.is_authenticated:
-            out['private_files_total'] = self.search_my_data(self.request.user.username, q, offset, limit).count()
+        for tab in tabs:
+            out['{}_total'.format(tab)] = responses[tab].hits.total
+        if 'published' in responses:
+            out['published_totals'] = publication_totals(responses['published'])
+        if not request.user.is_authenticated:
+            out['private_files_total'] = 0
 
         return JsonResponse(out, safe=False)
 
+    def tab_search(self, tab, q, offset, limit):
+        """Returns the search of a tab.
+
+        :param str tab: one of :attr:`TABS`
+        :param str q: query string
+        :param int offset: offset
+        :param int limit: limit, `0` to only count the hits
+        """
+        if tab == 'public_files':
+            return self.search_public_files(q, offset, limit)
+        elif tab == 'published':
+            return self.search_published(q, offset, limit)
+        elif tab == 'cms':
+            return self.search_cms_content(q, offset, limit)
+        elif tab == 'private_files':
+            return self.search_my_data(self.request.user.username, q, offset, limit)
+        raise ValueError('Unknown tab: {}'.format(tab))
+
     def search_cms_content(self, q, offset, limit):
         """search cms content """
         search = Search(index="cms").query(
@@ -86,49 +139,138 @@ class SearchView(BaseApiView):
         return search
 
     def search_public_files(self, q, offset, limit):
+        """Public files containing every term of `q` in their name or
+        keywords.
 
-        split_query = q.split(" ")
-        for i, c in enumerate(split_query):
-            if c.upper() not in ["AND", "OR", "NOT"]:
-                split_query[i] = "*" + c + "*"
-        
-        q = " ".join(split_query)
-
+        Only :data:`SUBSTRING_FIELDS` are searched, through their `_ngram`
+        subfields. Other fields, e.g. `path` or `mimeType`, are not
+        searched anymore: a `*term*` wildcard over `_all` scans the
+        whole term dictionary of the index.
+        """
         filters = Q('term', system="nees.public") | \
                   Q('term', system="designsafe.storage.published") | \
                   Q('term', system="designsafe.storage.community")
         search = Search(index="des-files")\
-            .query("query_string", query=q, default_operator="and")\
+            .query(substring_query(q, SUBSTRING_FIELDS, default_operator="and"))\
             .filter(filters)\
             .filter("term", type="file")\
             .extra(from_=offset, size=limit)
+        search = apply_projection(search, FILE_SOURCE_PRESETS, SEARCH)
         logger.info(search.to_dict())
         return search
 
 
     def search_published(self, q, offset, limit):
-        query = Q('bool', must=[Q('query_string', query=q)])
-
-        search = Search(index="des-publications_legacy,des-publications")\
-            .query(query)\
-            .extra(from_=offset, size=limit)
-        return search
+        return publication_search(q, SEARCH).extra(from_=offset, size=limit)
 
     def search_my_data(self, username, q, offset, limit):
 
-        split_query = q.split(" ")
-        for i, c in enumerate(split_query):
-            if c.upper() not in ["AND", "OR", "NOT"]:
-                split_query[i] = "*" + c + "*"
-        
-        q = " ".join(split_query)
-
         search = Search(index='des-files')
-        search = search.filter("nested", path="permissions", query=Q("term", permissions__username=username))
-        search = search.query("query_string", query=q, fields=["name", "name._exact", "keywords"])
+        search = search.filter(readers_filter(username))
+        search = search.query(substring_query(q, SUBSTRING_FIELDS))
         search = search.query(Q('bool', must=[Q({'prefix': {'path._exact': username}})]))
         search = search.filter("term", system='designsafe.storage.default')
         search = search.query(Q('bool', must_not=[Q({'prefix': {'path._exact': '{}/.Trash'.format(username)}})]))
         search = search.extra(from_=offset, size=limit)
+        search = routed(search, 'designsafe.storage.default', username)
+        search = apply_projection(search, FILE_SOURCE_PRESETS, SEARCH)
         logger.info(search.to_dict())
         return search
+
+
+class SuggestView(BaseApiView):
+    """Search-as-you-type suggestions. api/search/suggest/?q=<partial>
+
+    Returns a few file names, project titles and publication titles
+    matching the partial query, retrieved with a single `_msearch`.
+    Only the fields needed to render a suggestion are returned.
+
+    File names are matched on the `name._ngram` subfield and filtered with
+    the same permissions filter as
+    :meth:`~designsafe.apps.data.managers.elasticsearch.FileManager._pems_filter`.
+    Titles are matched as phrase prefixes. Projects are only suggested
+    to their team members.
+
+    Query parameters:
+
+        * `q`: partial query
+        * `limit`: max number of suggestions of every type
+        * `types`: comma separated list of :attr:`TYPES` to suggest
+    """
+    TYPES = ('files', 'projects', 'publications')
+    DEFAULT_LIMIT = 5
+    MAX_LIMIT = 20
+    #: Stop collecting matches on a shard after this many documents
+    TERMINATE_AFTER = 1000
+
+    def get(self, request):
+        """GET handler."""
+        q = (request.GET.get('q') or '').strip()
+        try:
+            limit = int(request.GET.get('limit', self.DEFAULT_LIMIT))
+        except ValueError:
+            return HttpResponseBadRequest("limit must be an integer")
+        if limit < 0:
+            return HttpResponseBadRequest("limit must not be negative")
+        limit = min(limit, self.MAX_LIMIT)
+        types = request.GET.get('types')
+        if types is None:
+            types = list(self.TYPES)
+        else:
+            types = [_type for _type in types.split(',') if _type in self.TYPES]
+        username = request.user.username if request.user.is_authenticated else None
+
+        out = dict((_type, []) for _type in types)
+        searches = []
+        for _type in types:
+            search = getattr(self, 'suggest_{}'.format(_type))(q, username)
+            if search is not None:
+                searches.append((_type, search.extra(size=limit,
+                                                     terminate_after=self.TERMINATE_AFTER)))
+        if not searches:
+            return JsonResponse(out)
+
+        msearch = MultiSearch()
+        for _, search in searches:
+            msearch = msearch.add(search)
+        for (_type, _), res in zip(searches, msearch.execute()):
+            out[_type] = [hit.to_dict() for hit in res]
+        return JsonResponse(out)
+
+    def suggest_files(self, q, username):
+        """File names containing `q`."""
+        if len(q) < NGRAM_MIN:
+            return None
+        pems_filter = ESFileManager(username or 'WORLD')._pems_filter()
+        return Search(index='des-files')\
+            .query(substring_term_query(q, ['name']))\
+            .filter(pems_filter)\
+            .source(['name', 'path', 'system', 'format'])
+
+    def suggest_projects(self, q, username):
+        """Titles starting with `q` of the projects the user is a member of."""
+        if username is None or not q:
+            return None
+        member = Q('bool', should=[
+            Q('term', **{'value.teamMembers._exact': username}),
+            Q('term', **{'value.coPis._exact': username}),
+            Q('term', **{'value.pi._exact': username})
+        ])
+        query = Q('nested', path='value', query=Q(
+            'bool',
+            must=[Q('match_phrase_prefix', **{'value.title': q})],
+            filter=[member]))
+        return Search(index='des-projects')\
+            .query(query)\
+            .source(['uuid', 'value.title', 'value.projectId'])
+
+    def suggest_publications(self, q, username):
+        """Titles starting with `q` of published projects."""
+        if not q:
+            return None
+        query = Q('nested', path='project', query=Q(
+            'nested', path='project.value', query=Q(
+                'match_phrase_prefix', **{'project.value.title': q})))
+        return Search(index='des-publications')\
+            .query(query)\
+            .source(['projectId', 'project.value.title'])
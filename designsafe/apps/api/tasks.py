@@ -21,18 +21,23 @@ logger = logging.getLogger(__name__)
 
 @shared_task(bind=True, max_retries=None)
 def reindex_agave(self, username, file_id, full_indexing=True,
-                  levels=1, pems_indexing=True, index_full_path=True):
+                  levels=1, pems_indexing=True, index_full_path=True,
+                  bulk=True, concurrent_walk=True, incremental=False,
+                  mounted=False):
     user = get_user_model().objects.get(username=username)
     #levels=1
     
     from designsafe.apps.api.data import AgaveFileManager
     from designsafe.apps.data.managers.indexer import AgaveIndexer as AgaveFileIndexer
+    from designsafe.apps.data.managers.mounted_indexer import MountedIndexer
     agave_fm = AgaveFileManager(user)
     
     if settings.DEBUG and username == 'ds_admin':
         service_client = get_service_account_client()
         agave_fm.agave_client = service_client
-        agave_fm.indexer = AgaveFileIndexer(agave_client=service_client)
+        agave_fm.indexer = AgaveFileIndexer(
+            agave_client=service_client,
+            client_factory=get_service_account_client)
 
     system_id, file_user, file_path = agave_fm.parse_file_id(file_id)
     if system_id != settings.AGAVE_STORAGE_SYSTEM:
@@ -44,11 +49,19 @@ def reindex_agave(self, username, file_id, full_indexing=True,
         else:
             file_path = '/'
 
-    agave_fm.indexer.index(system_id, file_path, file_user,
-                           full_indexing = full_indexing,
-                           pems_indexing = pems_indexing,
-                           index_full_path = index_full_path,
-                           levels = levels)
+    indexer = agave_fm.indexer
+    if mounted:
+        indexer = MountedIndexer(agave_client=agave_fm.indexer.ag,
+                                 client_factory=agave_fm.indexer.client_factory)
+
+    indexer.index(system_id, file_path, file_user,
+                  full_indexing = full_indexing,
+                  pems_indexing = pems_indexing,
+                  index_full_path = index_full_path,
+                  levels = levels,
+                  bulk = bulk,
+                  concurrent_walk = concurrent_walk,
+                  incremental = incremental)
     #parent_path_comps = file_path.strip('/').split('/')
     #if len(parent_path_comps) > 0:
     #    parent_path = os.path.join(*file_path.strip('/').split('/')[:-1])
@@ -56,6 +69,176 @@ def reindex_agave(self, username, file_id, full_indexing=True,
     #                           levels = 1)
 
 
+def _reroutes(system, path, dest_path, routed):
+    """Returns `True` if the documents under `path` get another routing
+    key under `dest_path`."""
+    from designsafe.libs.elasticsearch.docs import file_routing
+    return routed and file_routing(system, path) != file_routing(system, dest_path)
+
+@shared_task(bind=True, max_retries=None)
+def update_path_prefix(self, index, system_field, system, path, dest_path,
+                       agave_path=False, routed=False):
+    """Moves every indexed document under `path` to `dest_path`.
+
+    Runs one `update_by_query` with
+    :data:`~designsafe.libs.elasticsearch.docs.PATH_PREFIX_SCRIPT` and
+    reports its progress as the `PROGRESS` state of this task. Documents
+    which hit a version conflict are retried up to
+    ``settings.ES_TRACKED_TASKS['conflict_retries']`` times, the index is
+    refreshed before every retry. Moved documents keep their ids, they are
+    only rerouted when the move changes their routing key, see
+    :func:`~designsafe.libs.elasticsearch.docs.reroute_path_prefix`.
+
+    :param str index: index (or alias) to update
+    :param str system_field: field holding the system id,
+        `system._exact` for IndexedFile and `systemId` for Object
+    :param str system: system id
+    :param str path: current path of the folder
+    :param str dest_path: new path of the folder
+    :param bool agave_path: rebuild `agavePath`
+    :param bool routed: route the moved documents with
+        :func:`~designsafe.libs.elasticsearch.docs.file_routing`
+
+    :returns: `total`, `updated`, `version_conflicts` and `rerouted` counts
+    :rtype: dict
+    """
+    from elasticsearch_dsl.connections import connections
+    from designsafe.libs.elasticsearch import docs as DocsManager
+    from designsafe.libs.elasticsearch.cache import bump_generation
+    client = connections.get_connection()
+    body = DocsManager.path_prefix_update_body(system_field, system, path,
+                                               dest_path, agave_path=agave_path)
+    retries = getattr(settings, 'ES_TRACKED_TASKS', {}).get('conflict_retries', 3)
+    totals = {'total': 0, 'updated': 0, 'version_conflicts': 0, 'rerouted': 0}
+
+    def _progress(status):
+        self.update_state(state='PROGRESS', meta={
+            'path': path,
+            'dest_path': dest_path,
+            'total': status.get('total', 0),
+            'updated': totals['updated'] + status.get('updated', 0),
+        })
+
+    for attempt in range(retries + 1):
+        if attempt:
+            client.indices.refresh(index=index)
+        resp = client.update_by_query(index=index, body=body, conflicts='proceed',
+                                      wait_for_completion=False)
+        result = DocsManager.wait_for_task(resp['task'], progress=_progress)
+        totals['total'] = max(totals['total'], result.get('total', 0))
+        totals['updated'] += result.get('updated', 0)
+        totals['version_conflicts'] = result.get('version_conflicts', 0)
+        if not totals['version_conflicts']:
+            break
+        logger.debug('%d version conflicts moving %s/%s, attempt %d',
+                     totals['version_conflicts'], system, path, attempt + 1)
+
+    if totals['version_conflicts']:
+        logger.error('Could not move %d documents from %s/%s to %s',
+                     totals['version_conflicts'], system, path, dest_path)
+    if _reroutes(system, path, dest_path, routed):
+        totals['rerouted'] = DocsManager.reroute_path_prefix(
+            index, system_field, system, dest_path)
+    bump_generation(index)
+    return totals
+
+@shared_task(bind=True, max_retries=None)
+def copy_path_prefix(self, index, system_field, system, path, dest_path,
+                     agave_path=False, routed=False):
+    """Copies every indexed document under `path` to `dest_path`.
+
+    Sends the `_reindex` of
+    :func:`~designsafe.libs.elasticsearch.docs.copy_path_prefix` and reports
+    its progress as the `PROGRESS` state of this task. The copies are
+    written once, with their final ids and routing.
+
+    Parameters are the same as :func:`update_path_prefix`.
+
+    :returns: `total` and `created` counts
+    :rtype: dict
+    """
+    from designsafe.libs.elasticsearch import docs as DocsManager
+    from designsafe.libs.elasticsearch.cache import bump_generation
+    totals = {'total': 0, 'created': 0}
+    task_id, totals['total'] = DocsManager.copy_path_prefix(
+        index, system_field, system, path, dest_path, agave_path=agave_path,
+        routed=routed)
+    if task_id is None:
+        return totals
+
+    def _progress(status):
+        self.update_state(state='PROGRESS', meta={
+            'path': path,
+            'dest_path': dest_path,
+            'total': status.get('total', 0),
+            'created': status.get('created', 0),
+        })
+
+    result = DocsManager.wait_for_task(task_id, progress=_progress)
+    totals['created'] = result.get('created', 0)
+    bump_generation(index)
+    return totals
+
+@shared_task(bind=True, max_retries=None)
+def bump_generation_on_completion(self, task_id, index):
+    """Waits for an ES task writing to `index` and then invalidates the
+    index's cached searches.
+
+    Used by callers sending `_by_query` tasks without waiting for them,
+    see :func:`~designsafe.libs.elasticsearch.cache.bump_generation`.
+
+    :param str task_id: ES task id
+    :param str index: index (or alias) the task writes to
+
+    :returns: the ES task's response
+    :rtype: dict
+    """
+    from designsafe.libs.elasticsearch import docs as DocsManager
+    return DocsManager.wait_for_task(task_id, index=index)
+
+@shared_task(bind=True)
+def dispatch_reindex_queue(self):
+    """Sends the reindex requests which have been quiet for long enough.
+
+    See :class:`~designsafe.apps.data.managers.reindex_queue.ReindexQueue`
+    """
+    from designsafe.apps.data.managers.reindex_queue import ReindexQueue
+    queue = ReindexQueue()
+    dispatched = queue.dispatch()
+    stats = queue.stats()
+    if dispatched:
+        logger.info('Dispatched %d reindex tasks. Queue stats: %s', dispatched, stats)
+    return stats
+
+@shared_task(bind=True)
+def reconcile_usage(self):
+    """Recomputes every storage usage rollup from the files index.
+
+    See :class:`~designsafe.apps.data.managers.usage.UsageRollup`
+    """
+    from designsafe.apps.data.managers.usage import UsageRollup
+    written = UsageRollup().reconcile()
+    logger.info('Reconciled %d usage rollups', written)
+    return written
+
+@shared_task(bind=True)
+def repair_folder_rollups(self, system=None):
+    """Recomputes the `totalLength`, `descendantCount` and `size` of indexed
+    folders.
+
+    See :meth:`~designsafe.apps.data.managers.usage.UsageRollup.repair_folders`
+
+    :param str system: system id, every indexed system if `None`
+    """
+    from designsafe.apps.data.managers.usage import UsageRollup
+    rollup = UsageRollup()
+    systems = [system] if system else rollup.systems()
+    repaired = 0
+    for system_id in systems:
+        repaired += rollup.repair_folders(system_id)
+    logger.info('Repaired %d folder rollups', repaired)
+    return repaired
+
 @shared_task(bind=True)
 def share_agave(self, username, file_id, permissions, recursive):
     try:
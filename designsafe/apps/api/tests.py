@@ -68,3 +68,239 @@ class InitFileModel(ProjectDataModelsTestCase):
         #file_meta.modelconfiguration_set()
         #logger.debug('file meta dict: %s',
         #             json.dumps(file_meta.to_body_dict(), indent=4))
+
+
+class SearchViewTestCase(TestCase):
+    """Tests for the sitewide search, hits and tab counts in one msearch"""
+
+    def setUp(self):
+        from django.contrib.auth.models import AnonymousUser
+        self.factory = RequestFactory()
+        self.anonymous = AnonymousUser()
+        self.user = get_user_model()(username='ds_user')
+        patcher = self.settings(ES_SEARCH_CACHE={'enabled': False})
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        patcher = mock.patch('designsafe.apps.api.search.views.publication_totals',
+                             return_value={'designsafe': 2, 'nees': 1})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _response(total, hits=None):
+        res = mock.MagicMock()
+        res.hits.total = total
+        res.__iter__.return_value = iter(hits or [])
+        return res
+
+    @staticmethod
+    def _hit(name):
+        hit = mock.MagicMock()
+        hit.to_dict.return_value = {'name': name}
+        hit.meta = mock.Mock(spec=['doc_type'], doc_type='file')
+        return hit
+
+    def _get(self, user, **params):
+        from designsafe.apps.api.search.views import SearchView
+        request = self.factory.get('/api/search/', params)
+        request.user = user
+        return SearchView.as_view()(request)
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_anonymous_counts_public_tabs(self, mock_execute):
+        mock_execute.return_value = [self._response(1, [self._hit('a.txt')]),
+                                     self._response(5), self._response(3)]
+
+        resp = self._get(self.anonymous, q='test', type_filter='public_files')
+
+        self.assertEqual(mock_execute.call_count, 1)
+        searches = mock_execute.call_args[0][0]._searches
+        self.assertEqual(len(searches), 3)
+        self.assertEqual(searches[0].to_dict()['size'], 10)
+        self.assertEqual([s.to_dict()['size'] for s in searches[1:]], [0, 0])
+        out = json.loads(resp.content)
+        self.assertEqual(out['hits'], [{'name': 'a.txt', 'doc_type': 'file'}])
+        self.assertEqual(out['total_hits'], 1)
+        self.assertEqual(out['public_files_total'], 1)
+        self.assertEqual(out['published_total'], 5)
+        self.assertEqual(out['cms_total'], 3)
+        self.assertEqual(out['published_totals'], {'designsafe': 2, 'nees': 1})
+        self.assertEqual(out['private_files_total'], 0)
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_counts_parameter(self, mock_execute):
+        mock_execute.return_value = [self._response(2), self._response(7)]
+
+        resp = self._get(self.user, q='test', type_filter='private_files',
+                         counts='cms,unknown')
+
+        searches = mock_execute.call_args[0][0]._searches
+        self.assertEqual(len(searches), 2)
+        self.assertEqual(searches[0]._index, ['des-files'])
+        self.assertIn({'terms': {'readers': ['ds_user']}},
+                      searches[0].to_dict()['query']['bool']['filter'])
+        self.assertEqual(searches[1]._index, ['cms'])
+        out = json.loads(resp.content)
+        self.assertEqual(out['private_files_total'], 2)
+        self.assertEqual(out['cms_total'], 7)
+        self.assertNotIn('published_total', out)
+        self.assertNotIn('published_totals', out)
+
+    def test_limit_too_large(self):
+        resp = self._get(self.anonymous, q='test', limit=501)
+        self.assertEqual(resp.status_code, 400)
+
+
+class SuggestViewTestCase(TestCase):
+    """Tests for the search-as-you-type suggestions"""
+
+    def setUp(self):
+        from django.contrib.auth.models import AnonymousUser
+        self.factory = RequestFactory()
+        self.anonymous = AnonymousUser()
+        self.user = get_user_model()(username='ds_user')
+
+    @staticmethod
+    def _response(hits=None):
+        res = mock.MagicMock()
+        res.__iter__.return_value = iter(hits or [])
+        return res
+
+    def _get(self, user, **params):
+        from designsafe.apps.api.search.views import SuggestView
+        request = self.factory.get('/api/search/suggest/', params)
+        request.user = user
+        return SuggestView.as_view()(request)
+
+    def test_limit_not_a_number(self):
+        resp = self._get(self.user, q='shake', limit='ten')
+        self.assertEqual(resp.status_code, 400)
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_files_filtered_by_readers(self, mock_execute):
+        mock_execute.return_value = [self._response()]
+
+        self._get(self.user, q='shake', types='files', limit=50)
+
+        searches = mock_execute.call_args[0][0]._searches
+        self.assertEqual(len(searches), 1)
+        body = searches[0].to_dict()
+        self.assertEqual(body['size'], 20)
+        self.assertIn({'terms': {'readers': ['ds_user', 'WORLD']}},
+                      body['query']['bool']['filter'])
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_anonymous_files_only_world_readable(self, mock_execute):
+        mock_execute.return_value = [self._response()]
+
+        self._get(self.anonymous, q='shake', types='files')
+
+        body = mock_execute.call_args[0][0]._searches[0].to_dict()
+        self.assertIn({'terms': {'readers': ['WORLD', 'WORLD']}},
+                      body['query']['bool']['filter'])
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_projects_only_for_members(self, mock_execute):
+        mock_execute.return_value = [self._response()]
+
+        self._get(self.user, q='shake', types='projects')
+
+        search = mock_execute.call_args[0][0]._searches[0]
+        self.assertEqual(search._index, ['des-projects'])
+        nested = search.to_dict()['query']['nested']['query']['bool']
+        self.assertEqual(nested['filter'], [{'bool': {'should': [
+            {'term': {'value.teamMembers._exact': 'ds_user'}},
+            {'term': {'value.coPis._exact': 'ds_user'}},
+            {'term': {'value.pi._exact': 'ds_user'}}]}}])
+
+    @mock.patch('elasticsearch_dsl.MultiSearch.execute', autospec=True)
+    def test_no_project_suggestions_for_anonymous(self, mock_execute):
+        resp = self._get(self.anonymous, q='shake', types='projects')
+
+        self.assertFalse(mock_execute.called)
+        self.assertEqual(json.loads(resp.content), {'projects': []})
+
+
+class PublicationSearchTestCase(TestCase):
+    """Tests for the merged search of DesignSafe and NEES publications"""
+
+    def _hit(self, doc_class, _id):
+        return {'_index': doc_class._doc_type.index,
+                '_type': doc_class._doc_type.name,
+                '_id': _id, '_score': 1.0, '_source': {}}
+
+    def test_publication_search_body(self):
+        from designsafe.apps.api.agave.filemanager.public_search_index import (
+            publication_search, PublicationIndexed, LegacyPublicationIndexed,
+            PUBLICATION_FILE_FIELDS, LEGACY_PUBLICATION_FILE_FIELDS)
+        from designsafe.libs.elasticsearch.projections import LISTING
+        search = publication_search('shake', LISTING)
+
+        self.assertEqual(sorted(search._index),
+                         sorted([PublicationIndexed._doc_type.index,
+                                 LegacyPublicationIndexed._doc_type.index]))
+        body = search.to_dict()
+        self.assertEqual(body['aggs']['sources'],
+                         {'terms': {'field': '_index', 'size': 2}})
+        self.assertEqual(body['query'], {'bool': {'must': [
+            {'query_string': {'query': 'shake'}}]}})
+        self.assertEqual(sorted(body['_source']['include']),
+                         sorted(set(PUBLICATION_FILE_FIELDS +
+                                    LEGACY_PUBLICATION_FILE_FIELDS)))
+
+    def test_hits_dispatched_by_index(self):
+        from designsafe.apps.api.agave.filemanager.public_search_index import (
+            _publication_hit, PublicationIndexed, LegacyPublicationIndexed)
+        self.assertIsInstance(_publication_hit(self._hit(PublicationIndexed, '1')),
+                              PublicationIndexed)
+        self.assertIsInstance(_publication_hit(self._hit(LegacyPublicationIndexed, '2')),
+                              LegacyPublicationIndexed)
+
+    def test_publication_totals(self):
+        from designsafe.apps.api.agave.filemanager.public_search_index import (
+            publication_totals, PublicationIndexed)
+        res = mock.MagicMock()
+        res.aggregations.sources.buckets = [
+            mock.Mock(key=PublicationIndexed._doc_type.index, doc_count=3)]
+        self.assertEqual(publication_totals(res), {'designsafe': 3, 'nees': 0})
+
+    @mock.patch('designsafe.apps.api.agave.filemanager.public_search_index.'
+                'LegacyPublication.to_file', return_value={'name': 'legacy'})
+    @mock.patch('designsafe.apps.api.agave.filemanager.public_search_index.'
+                'Publication.to_file', return_value={'name': 'publication'})
+    @mock.patch('designsafe.apps.api.agave.filemanager.public_search_index.SearchCache')
+    def test_search_cursor_round_trip(self, mock_cache, mock_to_file,
+                                      mock_legacy_to_file):
+        from designsafe.apps.api.agave.filemanager.public_search_index import (
+            PublicElasticFileManager, PublicationIndexed, LegacyPublicationIndexed,
+            _publication_hit)
+        hits = [_publication_hit(self._hit(PublicationIndexed, '1')),
+                _publication_hit(self._hit(LegacyPublicationIndexed, '2'))]
+        res = mock.MagicMock()
+        res.__iter__.side_effect = lambda: iter(hits)
+        res.hits.__len__.return_value = 2
+        res.hits.total = 5
+        res.hits.__getitem__.return_value.meta.sort = [1.5, 'publication#PRJ-1']
+        res.aggregations.sources.buckets = []
+        execute = mock_cache.return_value.execute
+        execute.return_value = res
+        manager = PublicElasticFileManager.__new__(PublicElasticFileManager)
+
+        first = manager.search('nees.public', 'shake', offset=4, limit=2)
+
+        body = execute.call_args[0][0].to_dict()
+        self.assertEqual(body['from'], 4)
+        self.assertEqual(body['size'], 2)
+        self.assertNotIn('search_after', body)
+        self.assertEqual([child['name'] for child in first['children']],
+                         ['publication', 'legacy'])
+        self.assertEqual(first['total'], 5)
+        self.assertIsNotNone(first['cursor'])
+
+        manager.search('nees.public', 'shake', offset=4, limit=2,
+                       cursor=first['cursor'])
+
+        body = execute.call_args[0][0].to_dict()
+        self.assertEqual(body['search_after'], [1.5, 'publication#PRJ-1'])
+        self.assertNotIn('from', body)
+        self.assertEqual(body['sort'], ['_score', {'_uid': 'asc'}])
@@ -8,7 +8,7 @@ from django.views.generic.base import View
 from django.core.exceptions import ObjectDoesNotExist
 from pytas.http import TASClient
 
-from elasticsearch_dsl import Q, Search
+from designsafe.apps.data.managers.usage import UsageRollup, USER
 
 logger = logging.getLogger(__name__)
 
@@ -16,14 +16,18 @@ logger = logging.getLogger(__name__)
 class UsageView(SecureMixin, View):
 
     def get(self, request):
+        """Storage used by the user's home folder.
+
+        Served from the user's usage rollup, see
+        :class:`~designsafe.apps.data.managers.usage.UsageRollup`.
+        Files changed in storage are counted once they are indexed
+        again, `updated` is when the rollup last changed.
+        """
         current_user = request.user
-        q = Search(index="designsafe")\
-                .query('bool', must=[Q("match", **{"path._path": current_user.username})])\
-                .extra(size=0)
-        q.aggs.metric('total_storage_bytes', 'sum', field="length")
-        result = q.execute()
-        agg = result.to_dict()["aggregations"]
-        out = {"total_storage_bytes": agg["total_storage_bytes"]["value"]}
+        usage = UsageRollup().get(USER, current_user.username)
+        out = {"total_storage_bytes": usage.totalBytes,
+               "file_count": usage.fileCount,
+               "updated": usage.updated}
         return JsonResponse(out)
 
 class AuthenticatedView(View):
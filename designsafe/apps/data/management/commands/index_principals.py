@@ -0,0 +1,34 @@
+"""Index principals command"""
+import json
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from designsafe.libs.elasticsearch.docs import update_principals, wait_for_task
+
+
+class Command(BaseCommand):
+    """Sets the `readers` and `writers` of file documents from their
+    `permissions`.
+
+    Listings and searches filter on `readers`, documents indexed before
+    the field existed must be updated once. Running it more than once
+    is safe.
+    """
+    help = 'Set readers and writers of file documents from their permissions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', default=settings.ES_INDICES['files']['alias'][0],
+                            help="Index to update. Default: des-files. " \
+                            "Use 'designsafe' for the legacy index")
+        parser.add_argument('--all', action='store_true', default=False,
+                            help="Update every document, not only the ones " \
+                            "without readers")
+
+    def handle(self, *args, **options):
+        index = options.get('index')
+        task_id = update_principals(index, missing_only=not options.get('all'))
+        result = wait_for_task(task_id, index=index)
+        self.stdout.write(json.dumps({
+            'task': task_id,
+            'updated': result.get('updated'),
+            'failures': len(result.get('failures', []))
+        }))
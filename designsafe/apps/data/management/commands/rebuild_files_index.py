@@ -0,0 +1,75 @@
+"""Rebuild files index command"""
+import json
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from elasticsearch_dsl import Index
+from elasticsearch_dsl.connections import connections
+from designsafe.apps.data.models.elasticsearch import IndexedFile
+from designsafe.libs.elasticsearch.cache import bump_generation
+from designsafe.libs.elasticsearch.docs import wait_for_task
+
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """Copies the files index into a new index built with the current mapping.
+
+    Mapping changes which can not be applied to an existing index (e.g. new
+    analyzers such as the `_ngram` subfields) need a new index. This command:
+
+        1. creates `target` with the mapping and analyzers of
+            :class:`~designsafe.apps.data.models.elasticsearch.IndexedFile`
+        2. copies every document from the alias with `_reindex`
+        3. moves the alias to `target`, unless `--no-swap` is given
+
+    Documents keep their ids. Once the alias is moved
+    ``ES_INDICES['files']['name']`` must be set to `target` so new
+    documents are written to it.
+    """
+    help = 'Rebuild the files index with the current IndexedFile mapping'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', help="Name of the new index, e.g. des-files_b")
+        parser.add_argument('--alias', default=settings.ES_INDICES['files']['alias'][0],
+                            help="Alias to copy from and to move. Default: des-files")
+        parser.add_argument('--no-swap', action='store_true', default=False,
+                            help="Do not move the alias to the new index")
+
+    def handle(self, *args, **options):
+        target = options.get('target')
+        alias = options.get('alias')
+        client = connections.get_connection()
+        if client.indices.exists(index=target):
+            raise CommandError('Index {} already exists'.format(target))
+
+        current = list(client.indices.get_alias(name=alias).keys())
+        self.stdout.write('Creating index: %s' % target)
+        index = Index(target)
+        index.doc_type(IndexedFile)
+        index.create()
+
+        self.stdout.write('Copying %s into %s' % (alias, target))
+        resp = client.reindex(body={'source': {'index': alias},
+                                    'dest': {'index': target}},
+                              wait_for_completion=False)
+
+        def _progress(status):
+            self.stdout.write('%d/%d documents' % (status.get('created', 0),
+                                                   status.get('total', 0)))
+
+        result = wait_for_task(resp['task'], progress=_progress)
+        self.stdout.write(json.dumps(result))
+        if result.get('failures'):
+            raise CommandError('Reindex failed, {} is not moved'.format(alias))
+
+        if options.get('no_swap'):
+            return
+
+        actions = [{'remove': {'index': name, 'alias': alias}} for name in current]
+        actions.append({'add': {'index': target, 'alias': alias}})
+        client.indices.update_aliases(body={'actions': actions})
+        bump_generation(alias)
+        self.stdout.write('%s now points to %s. '
+                          "Set ES_INDICES['files']['name'] to '%s'." %
+                          (alias, target, target))
@@ -0,0 +1,14 @@
+"""Reindex queue stats command"""
+import json
+from django.core.management.base import BaseCommand
+from designsafe.apps.data.managers.reindex_queue import ReindexQueue
+
+
+class Command(BaseCommand):
+    """Prints the counters of
+    :class:`~designsafe.apps.data.managers.reindex_queue.ReindexQueue`
+    """
+    help = 'Print the reindex queue counters'
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(ReindexQueue().stats()))
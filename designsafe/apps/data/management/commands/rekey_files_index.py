@@ -0,0 +1,88 @@
+"""Rekey files index command"""
+import json
+import logging
+import os
+import re
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from elasticsearch.helpers import scan
+from elasticsearch_dsl.connections import connections
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+from designsafe.libs.elasticsearch.docs import file_doc_id
+
+
+logger = logging.getLogger(__name__)
+
+#: Ids given by :func:`~designsafe.libs.elasticsearch.docs.file_doc_id`.
+FILE_DOC_ID = re.compile(r'^[0-9a-f]{64}$')
+
+class Command(BaseCommand):
+    """Moves every file document indexed with a random id to its
+    deterministic id.
+
+    Every document whose `_id` was generated by ES is written under
+    :func:`~designsafe.libs.elasticsearch.docs.file_doc_id` of its system and
+    full path and the old document is deleted. Duplicated documents for the
+    same file collapse into one. Documents which already have a
+    deterministic id keep it, even if their file was moved since it was
+    created. Running it more than once is safe.
+    """
+    help = 'Re-key file documents with ids derived from system and full path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', default=settings.ES_INDICES['files']['alias'][0],
+                            help="Index to re-key. Default: des-files")
+        parser.add_argument('--system-field', default='system',
+                            help="Field holding the system id. " \
+                            "Use 'systemId' for the legacy 'designsafe' index")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of actions sent on every bulk request")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only count the documents to re-key")
+
+    def handle(self, *args, **options):
+        index = options.get('index')
+        system_field = options.get('system_field')
+        dry_run = options.get('dry_run')
+        client = connections.get_connection()
+
+        total = 0
+        rekeyed = 0
+        skipped = 0
+        bulk_indexer = BulkIndexer(chunk_size=options.get('chunk_size'))
+        for hit in scan(client, index=index, query={'query': {'match_all': {}}},
+                        size=options.get('chunk_size')):
+            total += 1
+            source = hit['_source']
+            system = source.get(system_field)
+            if not system or 'name' not in source or 'path' not in source:
+                skipped += 1
+                continue
+
+            if FILE_DOC_ID.match(hit['_id']):
+                continue
+
+            doc_id = file_doc_id(system, os.path.join(source['path'], source['name']))
+
+            rekeyed += 1
+            if dry_run:
+                continue
+
+            bulk_indexer.add({'_op_type': 'index',
+                              '_index': hit['_index'],
+                              '_type': hit['_type'],
+                              '_id': doc_id,
+                              '_source': source})
+            bulk_indexer.add({'_op_type': 'delete',
+                              '_index': hit['_index'],
+                              '_type': hit['_type'],
+                              '_id': hit['_id']})
+
+        bulk_indexer.close()
+        self.stdout.write(json.dumps({
+            'total': total,
+            'rekeyed': rekeyed,
+            'skipped': skipped,
+            'errors': len(bulk_indexer.errors),
+            'dry_run': dry_run
+        }))
@@ -0,0 +1,86 @@
+"""Reroute files index command"""
+import json
+import logging
+import os
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from elasticsearch.helpers import scan
+from elasticsearch_dsl.connections import connections
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+from designsafe.libs.elasticsearch.docs import file_routing, routing_meta
+
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """Moves every file document to the shard of its routing key.
+
+    Every document whose `_routing` is not
+    :func:`~designsafe.libs.elasticsearch.docs.file_routing` of its system and
+    full path is deleted and written again, with the same id, under the
+    new routing key. Run it before enabling ``settings.ES_FILES_ROUTING``,
+    or with `--revert` after disabling it. Running it more than once is safe.
+    """
+    help = 'Re-route file documents by home folder owner or project system'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', default=settings.ES_INDICES['files']['alias'][0],
+                            help="Index to re-route. Default: des-files")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of actions sent on every bulk request")
+        parser.add_argument('--revert', action='store_true', default=False,
+                            help="Move every document back to the default routing")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only count the documents to re-route")
+
+    def handle(self, *args, **options):
+        index = options.get('index')
+        enabled = not options.get('revert')
+        dry_run = options.get('dry_run')
+        client = connections.get_connection()
+
+        total = 0
+        rerouted = 0
+        skipped = 0
+        bulk_indexer = BulkIndexer(chunk_size=options.get('chunk_size'))
+        for hit in scan(client, index=index, query={'query': {'match_all': {}}},
+                        size=options.get('chunk_size')):
+            total += 1
+            source = hit['_source']
+            system = source.get('system')
+            if not system or 'name' not in source or 'path' not in source:
+                skipped += 1
+                continue
+
+            routing = file_routing(system, os.path.join(source['path'], source['name']),
+                                   enabled=enabled)
+            if hit.get('_routing') == routing:
+                continue
+
+            rerouted += 1
+            if dry_run:
+                continue
+
+            # Deleted first, both routing keys may land on the same shard.
+            action = {'_op_type': 'delete',
+                      '_index': hit['_index'],
+                      '_type': hit['_type'],
+                      '_id': hit['_id']}
+            action.update(routing_meta(hit.get('_routing')))
+            bulk_indexer.add(action)
+            action = {'_op_type': 'index',
+                      '_index': hit['_index'],
+                      '_type': hit['_type'],
+                      '_id': hit['_id'],
+                      '_source': source}
+            action.update(routing_meta(routing))
+            bulk_indexer.add(action)
+
+        bulk_indexer.close()
+        self.stdout.write(json.dumps({
+            'total': total,
+            'rerouted': rerouted,
+            'skipped': skipped,
+            'errors': len(bulk_indexer.errors),
+            'dry_run': dry_run
+        }))
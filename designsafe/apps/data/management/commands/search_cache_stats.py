@@ -0,0 +1,22 @@
+"""Search cache stats command"""
+import json
+from django.core.management.base import BaseCommand
+from designsafe.libs.elasticsearch.cache import SearchCache
+
+ENDPOINTS = ['search', 'public_listing', 'public_search', 'files_search']
+
+
+class Command(BaseCommand):
+    """Prints the hit and miss counters of
+    :class:`~designsafe.libs.elasticsearch.cache.SearchCache`
+    """
+    help = 'Print the search cache counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS,
+                            help="Endpoint to print. Default: all of them")
+
+    def handle(self, *args, **options):
+        endpoints = options.get('endpoint') or ENDPOINTS
+        self.stdout.write(json.dumps([SearchCache(endpoint).stats()
+                                      for endpoint in endpoints]))
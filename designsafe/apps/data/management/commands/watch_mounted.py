@@ -0,0 +1,38 @@
+"""Watch mounted storage command"""
+import logging
+from django.core.management.base import BaseCommand
+from designsafe.apps.data.managers.watcher import MountedWatcher
+
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """Runs :class:`~designsafe.apps.data.managers.watcher.MountedWatcher`
+    until interrupted.
+    """
+    help = 'Keep the files index up to date with inotify events from the mounted storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--system', action='append', dest='systems',
+                            help="System id to watch. Can be given multiple times. " \
+                            "Default: settings.AGAVE_MOUNT_WATCHER['systems']")
+        parser.add_argument('--all-projects', action='store_true', default=None,
+                            help="Watch every project. " \
+                            "Default: settings.AGAVE_MOUNT_WATCHER['all_projects']")
+        parser.add_argument('--quiet-period', type=int,
+                            help="Seconds without events before writing a batch")
+        parser.add_argument('--max-batch', type=int,
+                            help="Max number of pending paths before writing a batch")
+
+    def handle(self, *args, **options):
+        watcher = MountedWatcher(systems=options.get('systems'),
+                                 all_projects=options.get('all_projects'),
+                                 quiet_period=options.get('quiet_period'),
+                                 max_batch=options.get('max_batch'))
+        for system_id, root in watcher.roots:
+            self.stdout.write('Watching %s: %s' % (system_id, root))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('Stats: %s' % watcher.stats)
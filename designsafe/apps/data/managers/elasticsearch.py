@@ -5,6 +5,13 @@ import os
 # import json
 from elasticsearch_dsl.query import Q
 from designsafe.apps.data.models.elasticsearch import IndexedFile
+from designsafe.apps.data.managers.usage import UsageRollup
+from designsafe.libs.elasticsearch.docs import (file_doc_id, new_file_doc_ids,
+                                                delete_path_prefix,
+                                                pems_fields, readers_filter,
+                                                file_routing, routed, routing_meta)
+from designsafe.libs.elasticsearch.cache import bump_generation
+from designsafe.libs.elasticsearch.pems import explicit_pems
 from designsafe.apps.api.agave import get_service_account_client
 from django.conf import settings
 import magic
@@ -14,6 +21,37 @@ import re
 logger = logging.getLogger(__name__)
 # pylint: enable=invalid-name
 
+SYSTEM_ID_PATHS = [
+    {'regex': r'^designsafe.storage.default$',
+     'path': '/corral-repl/tacc/NHERI/shared'},
+    {'regex': r'^designsafe.storage.community$',
+     'path': '/corral-repl/tacc/NHERI/community'},
+    {'regex': r'^designsafe.storage.published$',
+     'path': '/corral-repl/tacc/NHERI/published'},
+    {'regex': r'^project\-',
+     'path': '/corral-repl/tacc/NHERI/projects'}
+]
+
+#: Sorts files by `size`, largest first.
+SIZE_SORT = {'size': {'order': 'desc', 'missing': '_last'}}
+
+
+def mounted_path(system_id):
+    """Returns the path where a system's storage is mounted.
+
+    :param str system_id: system id
+
+    :returns: absolute path or `None` if the system is not mounted
+    :rtype: str
+    """
+    for mapping in SYSTEM_ID_PATHS:
+        if re.search(mapping['regex'], system_id):
+            base_path = mapping['path']
+            if mapping['regex'] == r'^project\-':
+                base_path += '/' + system_id[8:]
+            return base_path
+    return None
+
 
 class FileManager(object):
     """Elasticsearch File Manager Class"""
@@ -21,26 +59,18 @@ class FileManager(object):
         self.username = username
 
     def _pems_filter(self):
-        term_username_query = Q(
-            'term',
-            **{'permissions.username': self.username}
-        )
-        term_world_query = Q(
-            'term',
-            **{'permissions.username': 'WORLD'}
-        )
-        bool_query = Q('bool')
-        bool_query.should = [term_username_query, term_world_query]
-        nested_query = Q('nested')
-        nested_query.path = 'permissions'
-        nested_query.query = bool_query
-        return nested_query
+        return Q(readers_filter(self.username, 'WORLD'))
 
-    def listing(self, system='designsafe.storage.default', path='/'):
+    def listing(self, system='designsafe.storage.default', path='/',
+                sort='name', offset=0, limit=100):
         """Lists a file
 
         :param str system: System Id. Default: designsafe.storage.default
         :param str path: Path
+        :param str sort: `'name'` or `'size'`, largest first. The size of
+            a folder is the `totalLength` of its descendants.
+        :param int offset: offset of the first child
+        :param int limit: number of children
         """
         logger.debug('listing %s', os.path.join(system, path))
         search = IndexedFile.search()
@@ -52,8 +82,12 @@ class FileManager(object):
         bool_query = Q('bool')
         bool_query.must = [term_system_query, term_path_query]
         bool_query.filter = self._pems_filter()
-        search = search.query(bool_query)
-        search = search.sort({'name._exact': 'asc'})
+        search = routed(search.query(bool_query), system, path)
+        if sort == 'size':
+            search = search.sort(SIZE_SORT, {'name._exact': 'asc'})
+        else:
+            search = search.sort({'name._exact': 'asc'})
+        search = search.extra(from_=offset, size=limit)
         res = search.execute()
         logger.debug('res %s', str(res.hits.total))
         return res, search
@@ -72,7 +106,7 @@ class FileManager(object):
         bool_query = Q('bool')
         bool_query.must = [term_system_query, term_path_query]
         bool_query.filter = self._pems_filter()
-        search = search.query(bool_query)
+        search = routed(search.query(bool_query), system, path)
         search = search.sort({'name._exact': 'asc'})
         res = search.execute()
         return res, search
@@ -93,7 +127,7 @@ class FileManager(object):
             term_username_query
         ]
         bool_query.filter = self._pems_filter()
-        search = search.query(bool_query)
+        search = routed(search.query(bool_query), system, os.path.join(path, name))
         search = search.sort({'name._exact': 'asc'})
         res = search.execute()
         # logger.debug('search :%s', json.dumps(search.to_dict(), indent=2))
@@ -137,22 +171,7 @@ class FileManager(object):
 
         else:
             # In dev/prod, Corral is mounted and we can use the absolute path to get the mimetype.
-            SYSTEM_ID_PATHS = [
-                {'regex': r'^designsafe.storage.default$',
-                'path': '/corral-repl/tacc/NHERI/shared'},
-                {'regex': r'^designsafe.storage.community$',
-                'path': '/corral-repl/tacc/NHERI/community'},
-                {'regex': r'^designsafe.storage.published$',
-                'path': '/corral-repl/tacc/NHERI/published'},
-                {'regex': r'^project\-',
-                'path': '/corral-repl/tacc/NHERI/projects'}
-            ]
-            for mapping in SYSTEM_ID_PATHS:
-                if re.search(mapping['regex'], file_object['system']):
-                    base_path = mapping['path']
-                    if mapping['regex'] == r'^project\-':
-                        base_path += '/' + file_object['system'][8:] 
-                    break
+            base_path = mounted_path(file_object['system'])
 
             filePath = base_path + file_object['path']
             if os.path.isdir(filePath):
@@ -162,44 +181,299 @@ class FileManager(object):
 
             return mimeType
    
-    def index(self, file_object, pems):
-        """Indexes an Agave response file object (json) to an IndexedFile"""
-        res, search = self.get(file_object.system,
-                               os.path.dirname(file_object.path.strip('/')),
-                               os.path.basename(file_object.path.strip('/')))
-        if res.hits.total > 1:
-            for doc in res[1:]:
-                doc.delete(ignore=404)
-        if res.hits.total >= 1:
-            document = res[0]
-            file_object.pop('_links')
-            file_object.pop('permissions')
-            document.update(**file_object)
+    def _default_pems(self):
+        """Returns "optimistic permissions" for a new document"""
+        return [{
+            'username': self.username,
+            'permission': {
+                'read': True,
+                'write': True,
+                'execute': True
+            }
+        }]
+
+    @staticmethod
+    def _clean_pems(pems):
+        """Removes agave specific keys from a `files.listPermissions` response"""
+        for pem in pems or []:
+            pem.pop('_links', None)
+            pem.pop('internalUsername', None)
+        return pems
+
+    @staticmethod
+    def _init_rollups(document):
+        """Starts the `totalLength` and `descendantCount` rollups of a new
+        folder document, see
+        :class:`~designsafe.apps.data.managers.usage.UsageRollup`."""
+        if document.format == 'folder':
+            document.totalLength = 0
+            document.descendantCount = 0
+            document.size = 0
+
+    @staticmethod
+    def _size_fields(fields):
+        """Sets the `size` of a file to its `length`.
+
+        The `size` of a folder is its `totalLength` and is kept by
+        :class:`~designsafe.apps.data.managers.usage.UsageRollup`.
+        """
+        if fields.get('format') != 'folder' and 'length' in fields:
+            fields['size'] = int(fields['length'] or 0)
+        return fields
+
+    @staticmethod
+    def _file_object_fields(file_object):
+        """Maps an Agave response file object to IndexedFile fields"""
+        return {
+            'name': os.path.basename(file_object.path.strip('/')),
+            'path': os.path.dirname(file_object.path.strip('/')) or '/',
+            'lastModified': file_object.lastModified.isoformat(),
+            'length': file_object.length,
+            'format': file_object.format,
+            'type': file_object.type,
+            'system': file_object.system,
+        }
+
+    def index_action(self, file_object, pems=None, document=None,
+                     parent_pems=None, doc_id=None):
+        """Builds a bulk action to index an Agave response file object.
+
+        This is the bulk counterpart of :meth:`index`. No search is done
+        to look for the existing document, the caller is expected to
+        pass it in ``document`` when it exists.
+
+        :param file_object: Agave response file object
+        :param list pems: response from `files.listPermissions`
+        :param IndexedFile document: existing document for this file.
+            If given a partial update action is returned, otherwise
+            an action creating a new document.
+        :param list parent_pems: response from `files.listPermissions`
+            for the parent folder, see :meth:`document_action`
+        :param str doc_id: id of the new document, see :meth:`document_action`
+
+        :returns: bulk action to be used with
+            :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer`
+        :rtype: dict
+        """
+        fields = self._file_object_fields(file_object)
+        if document is None:
+            fields['mimeType'] = FileManager.mimetype_lookup(file_object,
+                                                             settings.DEBUG)
+        return self.document_action(fields, pems=pems, document=document,
+                                    parent_pems=parent_pems, doc_id=doc_id)
+
+    @staticmethod
+    def _explicit(pems, parent_pems):
+        """Returns the `explicitPems` flag of a file, `None` when its
+        parent folder's permissions are not known"""
+        if parent_pems is None:
+            return None
+        return explicit_pems(pems, parent_pems)
+
+    def document_action(self, fields, pems=None, document=None,
+                        parent_pems=None, doc_id=None):
+        """Builds a bulk action from a dict of IndexedFile fields.
+
+        :param dict fields: IndexedFile fields
+        :param list pems: response from `files.listPermissions`
+        :param IndexedFile document: existing document. If given a partial
+            update action is returned, otherwise an upsert of a new document.
+            New documents get "optimistic permissions" when no `pems`
+            are given.
+        :param list parent_pems: response from `files.listPermissions`
+            for the parent folder. When given with `pems` the document is
+            flagged with `explicitPems` if they differ, see
+            :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`.
+        :param str doc_id: id of the new document, from :meth:`new_doc_ids`.
+            Defaults to :func:`~designsafe.libs.elasticsearch.docs.file_doc_id`
+            of the file's path.
+
+        :returns: bulk action
+        :rtype: dict
+        """
+        self._size_fields(fields)
+        pems = self._clean_pems(pems)
+        if pems:
+            fields.update(pems_fields(pems, explicit=self._explicit(pems, parent_pems)))
+        if document is not None:
+            return dict({
+                '_op_type': 'update',
+                '_index': document.meta.index,
+                '_type': document.meta.doc_type,
+                '_id': document.meta.id,
+                'doc': fields
+            }, **routing_meta(getattr(document.meta, 'routing', None)))
+
+        document = IndexedFile(**fields)
+        document.set_permissions(pems or self._default_pems())
+        self._init_rollups(document)
+        action = document.to_dict(include_meta=True)
+        return dict({
+            '_op_type': 'update',
+            '_index': action['_index'],
+            '_type': action['_type'],
+            '_id': doc_id or file_doc_id(fields['system'], document.full_path),
+            'doc': fields,
+            'upsert': action['_source']
+        }, **routing_meta(file_routing(fields['system'], document.full_path)))
+
+    @staticmethod
+    def delete_action(document):
+        """Builds a bulk action to delete a document"""
+        return dict({
+            '_op_type': 'delete',
+            '_index': document.meta.index,
+            '_type': document.meta.doc_type,
+            '_id': document.meta.id
+        }, **routing_meta(getattr(document.meta, 'routing', None)))
+
+    @staticmethod
+    def new_doc_ids(system, full_paths):
+        """Returns the ids to create the documents of new files with.
+
+        See :func:`~designsafe.libs.elasticsearch.docs.new_file_doc_ids`.
+
+        :param str system: system id
+        :param list full_paths: full paths of the new files
+
+        :returns: ids by full path, without leading or trailing slashes
+        :rtype: dict
+        """
+        if not full_paths:
+            return {}
+        return new_file_doc_ids(IndexedFile._doc_type.index,
+                                IndexedFile._doc_type.name,
+                                system, full_paths, routed=True)
+
+    @staticmethod
+    def get_document(system, path):
+        """Gets a file's document without applying the permissions filter.
+
+        The document is looked up by the id it was created with first. Ids
+        are kept when files are moved, so the document is looked up by
+        `path` and `name` if it has been moved there or away from there.
+
+        :param str system: system id
+        :param str path: full path of the file
+
+        :returns: the document or `None`
+        :rtype: :class:`~designsafe.apps.data.models.elasticsearch.IndexedFile`
+        """
+        parent, name = os.path.split(path.strip('/'))
+        document = IndexedFile.get(id=file_doc_id(system, path),
+                                   routing=file_routing(system, path), ignore=404)
+        if (document is not None and document.path == (parent or '/')
+                and document.name == name):
+            return document
+
+        search = IndexedFile.search()
+        search = search.query(Q('bool', must=[
+            Q('term', **{'system._exact': system}),
+            Q('term', **{'path._exact': parent or '/'}),
+            Q('term', **{'name._exact': name})
+        ]))
+        res = routed(search, system, path)[:1].execute()
+        return res[0] if res.hits.total else None
+
+    @staticmethod
+    def delete_descendants(system, path):
+        """Deletes the documents of every file under a folder.
+
+        Uses `delete_by_query`, see
+        :func:`~designsafe.libs.elasticsearch.docs.delete_path_prefix`.
+        Cached searches are invalidated again once the deletion completes.
+        Usage rollups are not updated, callers record the deletion with
+        :meth:`~designsafe.apps.data.managers.usage.UsageRollup.record_subtree_delete`
+        before calling this.
+
+        :param str system: system id
+        :param str path: full path of the folder
+
+        :returns: `(task_id, total)`
+        :rtype: tuple
+        """
+        from designsafe.apps.api.tasks import bump_generation_on_completion
+        index = IndexedFile._doc_type.index
+        task_id, total = delete_path_prefix(index, 'system._exact', system, path)
+        if task_id is not None:
+            bump_generation_on_completion.apply_async(args=[task_id, index],
+                                                      queue='indexing')
+        return task_id, total
+
+    def move(self, system, path, dest_path, link=None):
+        """Moves (or renames) a file's document and its descendants.
+
+        The file's document keeps its id and is updated in place, it is
+        only written again when the move changes its routing key (see
+        :func:`~designsafe.libs.elasticsearch.docs.file_routing`). If the
+        file is a folder, the path of every descendant is rewritten server
+        side by the :func:`~designsafe.apps.api.tasks.update_path_prefix`
+        task. Usage rollups of the old and new ancestors are updated right
+        away.
+
+        :param str system: system id
+        :param str path: current full path of the file
+        :param str dest_path: new full path of the file
+        :param link: celery signature to run once the descendants are moved
+
+        :returns: the task's `AsyncResult` when descendants are moved,
+            `None` otherwise
+        """
+        from designsafe.apps.api.tasks import update_path_prefix
+        document = self.get_document(system, path)
+        if document is None:
+            logger.debug(u'No document for %s/%s, nothing to move', system, path)
+            return None
+
+        rollup = UsageRollup()
+        rollup.record_move(system, path.strip('/'), dest_path.strip('/'), document)
+
+        dest_parent, dest_name = os.path.split(dest_path.strip('/'))
+        routing = file_routing(system, dest_path)
+        if routing == getattr(document.meta, 'routing', None):
+            document.update(path=dest_parent or '/', name=dest_name)
+            bump_generation(IndexedFile._doc_type.index)
         else:
-            document = IndexedFile(
-                name=os.path.basename(file_object.path.strip('/')),
-                path=os.path.dirname(file_object.path.strip('/')) or '/',
-                lastModified=file_object.lastModified.isoformat(),
-                length=file_object.length,
-                format=file_object.format,
-                mimeType=FileManager.mimetype_lookup(file_object, settings.DEBUG),
-                type=file_object.type,
-                system=file_object.system,
-            )
-            if pems is None or not pems:
-                document.permissions = [{
-                    'username': self.username,
-                    'permission': {
-                        'read': True,
-                        'write': True,
-                        'execute': True
-                    }
-                }]
-            document.save()
+            fields = document.to_dict()
+            fields.update(path=dest_parent or '/', name=dest_name)
+            moved = IndexedFile(**fields)
+            moved.meta.id = document.meta.id
+            # Deleted first, both routing keys may land on the same shard.
+            document.delete(ignore=404)
+            moved.save()
+        rollup.flush()
 
+        if document.format != 'folder':
+            return None
+        return update_path_prefix.apply_async(
+            args=[IndexedFile._doc_type.index, 'system._exact', system,
+                  path.strip('/'), dest_path.strip('/')],
+            kwargs={'routed': True},
+            link=link,
+            queue='indexing')
+
+    def index(self, file_object, pems, parent_pems=None):
+        """Indexes an Agave response file object (json) to an IndexedFile
+
+        The existing document is updated in place and only created, with
+        its mimetype, when the file has none yet. `parent_pems` flags the
+        document with `explicitPems` as in :meth:`document_action`.
+        """
+        fields = self._size_fields(self._file_object_fields(file_object))
+        pems = self._clean_pems(pems)
         if pems:
-            for pem in pems:
-                pem.pop('_links', None)
-                pem.pop('internalUsername', None)
-            document.update(permissions=pems)
+            fields.update(pems_fields(pems, explicit=self._explicit(pems, parent_pems)))
+        document = self.get_document(file_object.system,
+                                     file_object.path.strip('/'))
+        if document is not None:
+            document.update(**fields)
+            bump_generation(IndexedFile._doc_type.index)
+            return document
+
+        document = IndexedFile(**fields)
+        document.mimeType = FileManager.mimetype_lookup(file_object,
+                                                        settings.DEBUG)
+        document.set_permissions(pems or self._default_pems())
+        self._init_rollups(document)
+        document.save()
         return document
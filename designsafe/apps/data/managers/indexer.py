@@ -1,14 +1,44 @@
 import logging
 import datetime
 import os
+import threading
 import urllib2
+from collections import deque
+import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from designsafe.apps.data.models.elasticsearch import IndexedFile
 from designsafe.apps.data.managers.elasticsearch import FileManager as ESFileManager
+from designsafe.apps.data.managers.usage import UsageRollup, file_usage, document_usage
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+from designsafe.libs.elasticsearch.pems import PermissionsPropagator
 
 #pylint: disable=invalid-name
 logger = logging.getLogger(__name__)
 #pylint: enable=invalid-name
 
+_USER_SEMAPHORES = {}
+_USER_SEMAPHORES_LOCK = threading.Lock()
+
+def _user_semaphore(username, size):
+    """Returns the semaphore capping concurrent Agave calls for a user.
+
+    Semaphores are shared by every walk running in this process for
+    the same username.
+    """
+    with _USER_SEMAPHORES_LOCK:
+        semaphore = _USER_SEMAPHORES.get(username)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(size)
+            _USER_SEMAPHORES[username] = semaphore
+        return semaphore
+
+def _as_datetime(value):
+    """Parses a date string, datetimes are returned as they are"""
+    if isinstance(value, basestring):
+        return dateutil.parser.parse(value)
+    return value
+
 class AgaveIndexer(object):
     """Indexer class for all indexing needs.
 
@@ -69,8 +99,36 @@ class AgaveIndexer(object):
         >>> mgr.indexer.index(...)
 
     """
-    def __init__(self, agave_client=None, *args, **kwargs):
+    def __init__(self, agave_client=None, client_factory=None, *args, **kwargs):
+        """
+        :param agave_client: agave client used by the main thread
+        :param client_factory: callable returning a new agave client. If given,
+            every thread of :meth:`walk_levels_concurrent` lists with its own
+            client. If not, the threads share `agave_client` one call at a time,
+            the agave client is not thread safe.
+        """
         self.ag = agave_client
+        self.client_factory = client_factory
+        self.bulk_errors = []
+        self._local = threading.local()
+        self._client_lock = threading.Lock()
+
+    def _thread_client(self):
+        """Returns the agave client of the current walker thread.
+
+        Clients are built once per thread with `client_factory`. Building
+        them is serialized so token refreshes do not race.
+
+        :returns: an agave client or `None` if there is no `client_factory`
+        """
+        if self.client_factory is None:
+            return None
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            with self._client_lock:
+                client = self.client_factory()
+            self._local.client = client
+        return client
 
 
     def walk(self, system_id, path, bottom_up=False, yield_base=True):
@@ -192,7 +250,35 @@ class AgaveIndexer(object):
 
         """
 
-        resp = self.ag.files.list(systemId=system_id, filePath=urllib2.quote(path))
+        folders, files = self._list_level(system_id, path)
+        if not bottom_up:
+            yield (path, folders, files)
+        for _folder in folders:
+            for (spath, sfolders, sfiles) in self.walk_levels(system_id, _folder.path,
+                                                              bottom_up=bottom_up):
+                yield (spath, sfolders, sfiles)
+
+        if bottom_up:
+            yield (path, folders, files)
+
+    def _list_level(self, system_id, path, semaphore=None, client=None):
+        """Lists one level of an agave filesystem.
+
+        :param str system_id: system id
+        :param str path: path to list
+        :param semaphore: if given it will be held during the `files.list` call
+        :param client: agave client to list with. Default `self.ag`
+
+        :returns: a tuple with the list of folders and the list of files
+        :rtype: tuple
+        """
+        client = client or self.ag
+        if semaphore is not None:
+            with semaphore:
+                resp = client.files.list(systemId=system_id,
+                                         filePath=urllib2.quote(path))
+        else:
+            resp = client.files.list(systemId=system_id, filePath=urllib2.quote(path))
         folders = []
         files = []
         for _file in resp:
@@ -202,15 +288,89 @@ class AgaveIndexer(object):
                 folders.append(_file)
             else:
                 files.append(_file)
-        if not bottom_up:
-            yield (path, folders, files)
-        for _folder in folders:
-            for (spath, sfolders, sfiles) in self.walk_levels(system_id, _folder.path,
-                                                              bottom_up=bottom_up):
-                yield (spath, sfolders, sfiles)
+        return folders, files
 
-        if bottom_up:
-            yield (path, folders, files)
+    def _list_level_threaded(self, system_id, path, semaphore=None):
+        """Lists one level from a walker thread.
+
+        Uses the thread's own client, see :meth:`_thread_client`, or
+        the shared `self.ag` holding the client lock.
+        """
+        client = self._thread_client()
+        if client is not None:
+            return self._list_level(system_id, path, semaphore, client=client)
+        with self._client_lock:
+            return self._list_level(system_id, path, semaphore)
+
+    def walk_levels_concurrent(self, system_id, path, bottom_up=False,
+                               username=None, max_workers=None, levels=0):
+        """Walk a path in an agave filesystem listing sibling folders in parallel.
+
+        This generator yields the same `(root, folders, files)` triples
+        as :meth:`walk_levels` and in the same order when walking top
+        to bottom. The difference is that every time a level is yielded
+        the `files.list` calls for all of its sub-folders are submitted to
+        a bounded thread pool, so the listings of the next levels are
+        already in flight while the caller processes the current one.
+
+        :param str system_id: system id
+        :param str path: path to walk
+        :param bool bottom_up: if `True` walk the path bottom to top. Every level
+            is yielded after all of its sub-levels.
+        :param str username: if given, no more than
+            ``settings.AGAVE_INDEXER_WALK['max_user_concurrency']`` `files.list`
+            calls will be running at the same time for this user in this process.
+        :param int max_workers: size of the thread pool. Default
+            ``settings.AGAVE_INDEXER_WALK['max_workers']``
+        :param int levels: number of levels to walk. Default `0` which means
+            to walk all the levels.
+
+        Listings run with one agave client per thread when the indexer has
+        a `client_factory`, otherwise one at a time with the shared client.
+
+        Notes:
+        ------
+
+            As with :meth:`walk_levels` the `folders` list can be modified
+            inplace when walking top to bottom. Sub-folders are only submitted
+            for listing after the level is yielded back, so any folder removed
+            from the list will not be listed.
+        """
+        config = getattr(settings, 'AGAVE_INDEXER_WALK', {})
+        max_workers = max_workers or config.get('max_workers', 8)
+        semaphore = None
+        if username:
+            semaphore = _user_semaphore(username,
+                                        config.get('max_user_concurrency', 4))
+
+        base_depth = len(path.split('/'))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = deque([(path, executor.submit(self._list_level_threaded,
+                                                system_id, path, semaphore))])
+        visited = []
+        try:
+            while pending:
+                root, future = pending.popleft()
+                folders, files = future.result()
+                if bottom_up:
+                    visited.append((root, folders, files))
+                else:
+                    yield (root, folders, files)
+
+                if levels and (len(root.split('/')) - base_depth + 1) >= levels:
+                    continue
+                children = [(_folder.path,
+                             executor.submit(self._list_level_threaded,
+                                             system_id, _folder.path, semaphore))
+                            for _folder in folders]
+                pending.extendleft(reversed(children))
+
+            for level in reversed(visited):
+                yield level
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def _dedup_and_discover(self, system_id, username, root, files, folders):
         """Deduping and discovery of Agave Files in Elasticsearch (ES)
@@ -225,13 +385,15 @@ class AgaveIndexer(object):
         :param list files: a list of :class:`~designsafe.apps.api.data.agave.file.AgaveFile` objects
         :param list folders: a list of :class:`~designsafe.apps.api.data.agave.file.AgaveFile` objects
 
-        :returns: `(objs_to_index, docs_to_delete)` A tuple with two lists
-            `objs_to_index` is a list of :class:`~designsafe.apps.api.data.agave.file.AgaveFile`
+        :returns: `(objs_to_index, docs_to_delete, docs_by_name)` A tuple with two lists
+            and a dict. `objs_to_index` is a list of
+            :class:`~designsafe.apps.api.data.agave.file.AgaveFile`
             objects for which no ES object was found with the same `path` + `name`.
             `docs_to_delete` is a list of
             :class:`~designsafe.apps.api.agave.elasticsearch.document.Object` objects
-            which appear repeated in the ES index.
-        :rtype: tuple of lists
+            which appear repeated in the ES index. `docs_by_name` maps every
+            file name to the document we are keeping for it.
+        :rtype: tuple
 
         Pseudocode
         ----------
@@ -265,23 +427,153 @@ class AgaveIndexer(object):
         mgr = ESFileManager(username)
         r, s = mgr.listing(system_id, root)
         docs = []
-        doc_names = []
+        docs_by_name = {}
         docs_to_delete = []
 
         for d in s.scan():
             docs.append(d)
-            if d.name in doc_names:
+            if d.name in docs_by_name:
                 docs_to_delete.append(d)
             else:
-                doc_names.append(d.name)
+                docs_by_name[d.name] = d
 
-        objs_to_index = [o for o in objs if o.name not in doc_names]
+        objs_to_index = [o for o in objs if o.name not in docs_by_name]
         docs_to_delete += [o for o in docs if o.name not in objs_names]
-        return objs_to_index, docs_to_delete
+        return objs_to_index, docs_to_delete, docs_by_name
+
+    @staticmethod
+    def _is_unchanged(agave_folder, document, folders, files):
+        """Checks a folder listing against the watermark stored in its document
+
+        :param agave_folder: agave file object of the folder, as returned
+            in its parent's listing
+        :param IndexedFile document: indexed document of the folder
+        :param list folders: folders in the folder's listing
+        :param list files: files in the folder's listing
+
+        :returns: `True` if the folder's `lastModified` and children count
+            are the same as the last time it was indexed
+        :rtype: bool
+        """
+        watermark = getattr(document, 'watermark', None)
+        if agave_folder is None or not watermark:
+            return False
+
+        if getattr(watermark, 'childCount', None) != len(folders) + len(files):
+            return False
+
+        return _as_datetime(getattr(watermark, 'lastModified', None)) == \
+            _as_datetime(agave_folder.lastModified)
+
+    @staticmethod
+    def _record_watermark(agave_folder, document, child_count, bulk_indexer=None):
+        """Saves the index watermark of a folder on its document
+
+        :param agave_folder: agave file object of the folder
+        :param IndexedFile document: indexed document of the folder
+        :param int child_count: number of children listed
+        :param bulk_indexer: if given the update is added as a bulk action
+        """
+        if agave_folder is None or document is None:
+            return
+
+        watermark = {
+            'lastModified': _as_datetime(agave_folder.lastModified).isoformat(),
+            'childCount': child_count,
+            'indexed': datetime.datetime.utcnow().isoformat()
+        }
+        if bulk_indexer is not None:
+            bulk_indexer.add({
+                '_op_type': 'update',
+                '_index': document.meta.index,
+                '_type': document.meta.doc_type,
+                '_id': document.meta.id,
+                'doc': {'watermark': watermark}
+            })
+        else:
+            document.update(watermark=watermark)
+
+    @staticmethod
+    def _delete_descendants(mgr, document, docs_by_name, rollup=None):
+        """Deletes the descendants of a document which is going to be deleted.
+
+        Descendants are only deleted when the document is a folder which is
+        not in the listing anymore. A duplicated document shares its
+        descendants with the document we are keeping.
+
+        :param rollup: :class:`~designsafe.apps.data.managers.usage.UsageRollup`
+            recording the document and its descendants as deleted
+
+        :returns: number of descendants being deleted
+        :rtype: int
+        """
+        if rollup is not None:
+            rollup.record(document.system, document.full_path,
+                          old=document_usage(document))
+        if document.format != 'folder' or \
+           docs_by_name.get(document.name, document) is not document:
+            return 0
+        logger.debug(u'delete_recursive: %s', os.path.join(document.path, document.name))
+        if rollup is not None:
+            rollup.record_subtree_delete(document.system, document.full_path)
+        task_id, total = mgr.delete_descendants(
+            document.system, os.path.join(document.path, document.name))
+        return total
+
+    @staticmethod
+    def _record_usage(rollup, obj, document):
+        """Records the storage change of indexing an Agave file object
+        over its existing document."""
+        if rollup is not None:
+            rollup.record(obj.system, obj.path, old=document_usage(document),
+                          new=file_usage(obj.length, obj.format))
+
+    def _bulk_index_level(self, bulk, mgr, objs, docs_by_name, docs_to_delete,
+                          pems_indexing=False, rollup=None, parent_pems=None):
+        """Adds the bulk actions for one level of the walk.
+
+        :param bulk: :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer` instance
+        :param mgr: :class:`~designsafe.apps.data.managers.elasticsearch.FileManager`
+            instance
+        :param list objs: Agave file objects to index
+        :param dict docs_by_name: existing documents in this level by name
+        :param list docs_to_delete: documents to delete recursively
+        :param bool pems_indexing: if `True` call `files.listPermissions`
+            for every object
+        :param rollup: :class:`~designsafe.apps.data.managers.usage.UsageRollup`
+            recording the storage change of this level
+        :param list parent_pems: permissions of the folder being listed,
+            see :meth:`~designsafe.apps.data.managers.elasticsearch.FileManager.document_action`
+
+        :returns: a tuple with the count of actions for indexing and for deleting
+        :rtype: tuple
+        """
+        docs_indexed = 0
+        docs_deleted = 0
+        for d in docs_to_delete:
+            docs_deleted += self._delete_descendants(mgr, d, docs_by_name, rollup)
+            bulk.add(mgr.delete_action(d))
+            docs_deleted += 1
+
+        new_paths = [o.path for o in objs if docs_by_name.get(o.name) is None]
+        doc_ids = mgr.new_doc_ids(objs[0].system, new_paths) if new_paths else {}
+        for o in objs:
+            pems = None
+            if pems_indexing:
+                pems = self.ag.files.listPermissions(
+                    systemId=o.system, filePath=o.path)
+            self._record_usage(rollup, o, docs_by_name.get(o.name))
+            bulk.add(mgr.index_action(o, pems=pems,
+                                      document=docs_by_name.get(o.name),
+                                      parent_pems=parent_pems,
+                                      doc_id=doc_ids.get(o.path.strip('/'))))
+            docs_indexed += 1
+        return docs_indexed, docs_deleted
 
     def index(self, system_id, path, username, bottom_up = False,
               levels = 0, index_full_path = True, full_indexing = False,
-              pems_indexing = False):
+              pems_indexing = False, bulk = False, bulk_options = None,
+              concurrent_walk = False, incremental = False):
         """Indexes a file path
 
         This method walks an agave file path and indexes the file's information
@@ -302,9 +594,23 @@ class AgaveIndexer(object):
             no deduping or discovery is performed. Default `False`
         :param bool pems_indexing: if `True` "optimistic permissions" will not be
             used and the response to `files.listPermissions` will get indexed.
+        :param bool bulk: if `True` the documents of every level are written
+            using ES' bulk API instead of one get and one save per file.
+            Per-item errors are stored in :attr:`bulk_errors`. Default `False`
+        :param dict bulk_options: keyword arguments for
+            :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer`
+            (`chunk_size`, `flush_interval`, `refresh`). Defaults are taken
+            from ``settings.ES_BULK_INDEXING``.
+        :param bool concurrent_walk: if `True` use :meth:`walk_levels_concurrent`
+            to walk the path. Default `False`
+        :param bool incremental: if `True` every sub-folder whose Agave
+            `lastModified` and number of children match the `watermark`
+            stored in its document is skipped, along with everything under it.
+            Cannot be used with `bottom_up`. Default `False`
 
         :returns: a tuple with the count of documents created and documents deleted
         :rtype: list
+        :raises ValueError: if both `incremental` and `bottom_up` are set
 
         Pseudocode
         ----------
@@ -337,121 +643,181 @@ class AgaveIndexer(object):
                     6.2.1 get agave file object
                     6.2.2 get or create ES document
 
+            When `bulk` is `True` steps 3 to 5 do not write to ES directly.
+            Every delete, create or update is added as an action to a
+            :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer`.
+            Existing documents are taken from the level listing done in step 2
+            so no extra search is done per file.
+
+            When `incremental` is `True`, before step 2 the folder being
+            walked is compared with the `watermark` recorded on its document
+            the last time it was indexed. If its `lastModified` and children
+            count did not change the level is not indexed and the walk does
+            not descend into it. After the level is indexed a new watermark
+            is recorded.
+
         Notes
         -----
 
             The documents indexed count returned does not represent the new documents
             created. It represent all the documents that were created and/or updated.
             Meaning, all the documents touched.
+
+            A folder's `lastModified` only changes when its direct children
+            change. A change deep in a subtree whose intermediate folders kept
+            the same `lastModified` and children count will not be picked up by an
+            incremental run. A regular run will always pick it up.
+
+            An incremental run must walk top to bottom. Bottom up, a folder's
+            children are listed before the folder itself so its watermark
+            is not known yet and nothing could be skipped.
         """
+        if incremental and bottom_up:
+            raise ValueError('incremental indexing cannot walk bottom up')
         docs_indexed = 0
         docs_deleted = 0
         mgr = ESFileManager(username=username)
-        for root, folders, files in self.walk_levels(system_id, path,
-                                                     bottom_up=bottom_up):
+        rollup = UsageRollup()
+        bulk_indexer = None
+        if bulk:
+            bulk_indexer = BulkIndexer(**(bulk_options or {}))
+
+        if concurrent_walk:
+            walk = self.walk_levels_concurrent(system_id, path, bottom_up=bottom_up,
+                                               username=username)
+        else:
+            walk = self.walk_levels(system_id, path, bottom_up=bottom_up)
+
+        folder_docs = {}
+        for root, folders, files in walk:
             logger.debug('system_id: %s, path: %s', system_id, root)
 
-            objs_to_index, docs_to_delete = self._dedup_and_discover(system_id,
-                                                username, root, files, folders)
-            for d in docs_to_delete:
-                logger.debug(u'delete_recursive: %s', os.path.join(d.path, d.name))
-                res, search = mgr.listing_recursive(d.system, d.path)
-                if res.hits.total:
-                    for doc in search.scan():
-                        doc.delete(ignore=404)
-
-                d.delete(ignore=404)
-                docs_deleted += res.hits.total + 1
-
-            if not full_indexing:
-                for o in objs_to_index:
-                    logger.debug(u'Indexing: {}'.format(o.path))
-                    pems = None
-                    if pems_indexing:
-                        pems = self.ag.files.listPermissions(
-                            systemId=o.system,filePath=o.path)
-                    doc = mgr.index(o, pems=pems)
-                    docs_indexed += 1
+            if incremental:
+                agave_folder, folder_doc = folder_docs.pop(root, (None, None))
+                if self._is_unchanged(agave_folder, folder_doc, folders, files):
+                    logger.debug(u'Unchanged, skipping subtree: %s', root)
+                    del folders[:]
+                    continue
+
+            objs_to_index, docs_to_delete, docs_by_name = self._dedup_and_discover(
+                system_id, username, root, files, folders)
+
+            parent_pems = None
+            if pems_indexing:
+                parent_pems = self.ag.files.listPermissions(
+                    systemId=system_id, filePath=root)
+
+            if bulk_indexer is not None:
+                objs = folders + files if full_indexing else objs_to_index
+                indexed, deleted = self._bulk_index_level(
+                    bulk_indexer, mgr, objs, docs_by_name, docs_to_delete,
+                    pems_indexing=pems_indexing, rollup=rollup,
+                    parent_pems=parent_pems)
+                docs_indexed += indexed
+                docs_deleted += deleted
             else:
-                folders_and_files = folders + files
-                for o in folders_and_files:
-                    logger.debug(u'Get or create file: {}'.format(o.path))
-                    pems = None
-                    if pems_indexing:
-                        pems = self.ag.files.listPermissions(
-                            systemId=o.system,filePath=o.path)
-                    doc = mgr.index(o, pems=pems)
-                    docs_indexed += 1
+                for d in docs_to_delete:
+                    docs_deleted += self._delete_descendants(mgr, d, docs_by_name,
+                                                             rollup)
+                    d.delete(ignore=404)
+                    docs_deleted += 1
+
+                if not full_indexing:
+                    for o in objs_to_index:
+                        logger.debug(u'Indexing: {}'.format(o.path))
+                        pems = None
+                        if pems_indexing:
+                            pems = self.ag.files.listPermissions(
+                                systemId=o.system,filePath=o.path)
+                        self._record_usage(rollup, o, None)
+                        doc = mgr.index(o, pems=pems, parent_pems=parent_pems)
+                        docs_indexed += 1
+                else:
+                    folders_and_files = folders + files
+                    for o in folders_and_files:
+                        logger.debug(u'Get or create file: {}'.format(o.path))
+                        pems = None
+                        if pems_indexing:
+                            pems = self.ag.files.listPermissions(
+                                systemId=o.system,filePath=o.path)
+                        self._record_usage(rollup, o, docs_by_name.get(o.name))
+                        doc = mgr.index(o, pems=pems, parent_pems=parent_pems)
+                        docs_indexed += 1
+
+            if incremental:
+                self._record_watermark(agave_folder, folder_doc,
+                                       len(folders) + len(files), bulk_indexer)
+                for _folder in folders:
+                    if _folder.name in docs_by_name:
+                        folder_docs[_folder.path] = (_folder, docs_by_name[_folder.name])
 
             if levels and (len(root.split('/')) - len(path.split('/')) + 1) >= levels:
                 del folders[:]
 
+        if bulk_indexer is not None:
+            bulk_indexer.close()
+            self.bulk_errors = bulk_indexer.errors
+            if bulk_indexer.errors:
+                logger.error('%d bulk actions failed indexing %s/%s',
+                             len(bulk_indexer.errors), system_id, path)
+        rollup.flush()
+
         if index_full_path:
             path_comp = path.split('/')
+            full_path = []
             for i in range(len(path_comp)):
                 file_path = '/'.join(path_comp)
                 path, name = os.path.split(path)
                 afs = self.ag.files.list(systemId=system_id, filePath=file_path)
                 af = afs[0]
-                logger.debug(u'Get or create file: {}'.format(af.path))
                 pems = None
                 if pems_indexing:
                     pems = self.ag.files.listPermissions(
                         systemId=af.system, filePath=af.path)
-                doc = mgr.index(af, pems=pems)
-                docs_indexed += 1
+                full_path.append((af, pems))
                 path_comp.pop()
+            # Every folder is compared with its parent's permissions, the
+            # top one has no parent listed.
+            for i, (af, pems) in enumerate(full_path):
+                logger.debug(u'Get or create file: {}'.format(af.path))
+                parent_pems = full_path[i + 1][1] if i + 1 < len(full_path) else None
+                doc = mgr.index(af, pems=pems, parent_pems=parent_pems)
+                docs_indexed += 1
         return docs_indexed, docs_deleted
 
-    def index_permissions(self, system_id, path, username, bottom_up = True, levels = 0):
+    def index_permissions(self, system_id, path, username):
         """Indexes the permissions
 
-        This method works from the indexed documents. It searches for all the
-        Elasticsearch (ES) documents that are children of the given `path` and updates
-        the permissions doing a `files.listPermissions` call to agave. This means that
-        this method does not creates ES documents or do any deduping.
+        This method works from the indexed documents. It does a
+        `files.listPermissions` call to agave for the given `path` and sets
+        those permissions on every Elasticsearch (ES) document under it with
+        one `update_by_query`. Agave is only called again for the documents
+        flagged with `explicitPems`, i.e. which permissions differed from
+        their parent's when they were indexed, see
+        :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`.
+        This method does not creates ES documents or do any deduping.
+        The whole subtree is always updated.
 
         :param str system_id: system id
         :param str path: path to walk
         :param str username: username who is making the request
-        :param bool bottom_up: if `True` iterate through the ES documents from the bottom
-            to the top based on path length
-        :param int levels: number of levels to iterate through. If `bottom_up` is set
-            to `True` this does not do anything.
 
         :returns: count of documents updated
         :rtype: int
-
-        Notes
-        -----
-
-            In order to get all the documents that are children of the given path
-            we use a search that searches on `path._path` property of the document
-            this is set with a hierarchy tokenizer.
-
-            This means that with one search we can get all the children documents
-            of a given path in one call, but they are not necessarily going
-            to be sorted. In order to sort the files we sort them by the length
-            of their paths. This is not necessarily correct but it is good enough
-            for updating permissions.
         """
         import urllib
-        cnt = 0
-        mgr = ESFileManager(username=username)
-        r, s = mgr.listing_recursive(system_id, path)
-        objs = sorted(s.scan(), key = lambda x: len(x.path.split('/')), reverse=bottom_up)
-        if levels:
-            objs = filter(lambda x: len(x.path.split('/')) <= levels, objs)
-        p, n = os.path.split(path)
-        if p == '':
-            p = '/'
-        objs.append(mgr.get(system_id, os.path.join(p, n)))
-        for o in objs:
-            if len(o.path.split('/')) == 1 and o.name == 'Shared with me':
-                continue
+
+        def _list_pems(system, file_path):
             pems = self.ag.files.listPermissions(
-                filePath=urllib.quote(os.path.join(o.path, o.name)),
-                systemId=system_id)
-            o.update(permissions = pems)
-            cnt += 1
+                filePath=urllib.quote(file_path.strip('/')),
+                systemId=system)
+            return ESFileManager._clean_pems(pems)
+
+        owner = path.strip('/').split('/')[0]
+        propagator = PermissionsPropagator(
+            IndexedFile._doc_type.index, 'system._exact', _list_pems,
+            exclude=[{'bool': {'filter': [
+                {'term': {'path._exact': owner}},
+                {'term': {'name._exact': 'Shared with me'}}]}}])
+        cnt, pems_calls = propagator.propagate(system_id, path)
         return cnt
@@ -0,0 +1,330 @@
+"""
+.. module: designsafe.apps.data.managers.mounted_indexer
+   :synopsis: Indexer which crawls the mounted storage instead of using Agave.
+"""
+import logging
+import datetime
+import os
+import stat
+from collections import deque, namedtuple
+import magic
+from dateutil.tz import tzutc
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+from designsafe.apps.data.managers.elasticsearch import (FileManager as ESFileManager,
+                                                         mounted_path)
+from designsafe.apps.data.managers.indexer import AgaveIndexer
+from designsafe.apps.data.managers.usage import UsageRollup, file_usage, document_usage
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+#: Folder watermark data of a mounted folder.
+MountedFolder = namedtuple('MountedFolder', ['lastModified'])
+
+class MountedIndexer(AgaveIndexer):
+    """Indexer which crawls the mounted storage of a system.
+
+    Corral is mounted on the web and worker nodes for every system in
+    :data:`~designsafe.apps.data.managers.elasticsearch.SYSTEM_ID_PATHS`.
+    Instead of walking a path with one `files.list` call per folder this
+    class walks the mounted path with :func:`os.scandir` and builds the
+    :class:`~designsafe.apps.data.models.elasticsearch.IndexedFile` documents
+    directly from the stat data. Documents are written with
+    :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer`.
+
+    If the system is not mounted (e.g. local development) :meth:`index`
+    falls back to :meth:`AgaveIndexer.index`.
+
+    .. note:: Agave is still used to retrieve permissions of every indexed
+        document when `pems_indexing` is `True`.
+    """
+
+    @staticmethod
+    def mounted_root(system_id):
+        """Returns the mounted path of a system if it is available.
+
+        :param str system_id: system id
+
+        :returns: absolute path or `None`
+        :rtype: str
+        """
+        root = mounted_path(system_id)
+        if root is None or not os.path.isdir(root):
+            return None
+        return root
+
+    @staticmethod
+    def _scan_level(base, root):
+        """Lists one level of a mounted path.
+
+        :param str base: mounted root of the system
+        :param str root: path to list, relative to the system's root
+
+        :returns: a tuple with the list of folders and the list of files
+        :rtype: tuple
+        """
+        folders = []
+        files = []
+        for entry in scandir(os.path.join(base, root.strip('/'))):
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                folders.append(entry)
+            else:
+                files.append(entry)
+        folders.sort(key=lambda x: x.name)
+        files.sort(key=lambda x: x.name)
+        return folders, files
+
+    def walk_mounted(self, system_id, path, levels=0, bottom_up=False,
+                     max_workers=0):
+        """Walks a mounted path.
+
+        This generator yields the same `(root, folders, files)` triples
+        as :meth:`AgaveIndexer.walk_levels`. `root` is relative to the
+        system's root and `folders` and `files` are lists of
+        :class:`os.DirEntry` objects. When walking top to bottom the
+        `folders` list can be modified inplace to stop the walk from
+        descending into a folder. Symbolic links are not followed.
+
+        :param str system_id: system id
+        :param str path: path to walk, relative to the system's root
+        :param int levels: number of levels to walk. Default `0` which means
+            to walk all the levels.
+        :param bool bottom_up: if `True` every level is yielded after all
+            of its sub-levels.
+        :param int max_workers: if given, sub-folders of a yielded level are
+            listed by a thread pool of this size, as in
+            :meth:`AgaveIndexer.walk_levels_concurrent`.
+        """
+        base = self.mounted_root(system_id)
+        base_depth = len(path.split('/'))
+        executor = None
+        if max_workers:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def _submit(root):
+            """Starts listing a level if there is a thread pool"""
+            if executor is None:
+                return root, None
+            return root, executor.submit(self._scan_level, base, root)
+
+        pending = deque([_submit(path)])
+        visited = []
+        try:
+            while pending:
+                root, future = pending.popleft()
+                if future is None:
+                    folders, files = self._scan_level(base, root)
+                else:
+                    folders, files = future.result()
+                if bottom_up:
+                    visited.append((root, folders, files))
+                else:
+                    yield (root, folders, files)
+
+                if levels and (len(root.split('/')) - base_depth + 1) >= levels:
+                    continue
+                pending.extendleft(reversed([_submit(os.path.join(root, _folder.name))
+                                             for _folder in folders]))
+
+            for level in reversed(visited):
+                yield level
+        finally:
+            if executor is not None:
+                for _, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    def _watermark_folder(entry):
+        """Returns an object with the `lastModified` of a folder entry,
+        as expected by :meth:`AgaveIndexer._is_unchanged`"""
+        return MountedFolder(datetime.datetime.fromtimestamp(
+            entry.stat(follow_symlinks=False).st_mtime, tzutc()))
+
+    @staticmethod
+    def _stat_fields(system_id, path, name, stat_result, abs_path, mime_type=True):
+        """Builds IndexedFile fields from stat data.
+
+        :param str system_id: system id
+        :param str path: parent path relative to the system's root
+        :param str name: file name
+        :param stat_result: result of `stat`
+        :param str abs_path: absolute path of the file
+        :param bool mime_type: if `True` look up the file's mimetype
+
+        :returns: IndexedFile fields
+        :rtype: dict
+        """
+        is_dir = stat.S_ISDIR(stat_result.st_mode)
+        last_modified = datetime.datetime.fromtimestamp(stat_result.st_mtime, tzutc())
+        fields = {
+            'name': name,
+            'path': path.strip('/') or '/',
+            'lastModified': last_modified.isoformat(),
+            'length': stat_result.st_size,
+            'format': 'folder' if is_dir else 'raw',
+            'type': 'dir' if is_dir else 'file',
+            'system': system_id,
+        }
+        if mime_type:
+            if is_dir:
+                fields['mimeType'] = 'text/directory'
+            else:
+                fields['mimeType'] = magic.from_file(abs_path, mime=True)
+        return fields
+
+    def _entry_fields(self, system_id, root, entry, mime_type=True):
+        """Builds IndexedFile fields from a :class:`os.DirEntry`"""
+        return self._stat_fields(system_id, root, entry.name,
+                                 entry.stat(follow_symlinks=False),
+                                 entry.path, mime_type=mime_type)
+
+    def _entry_pems(self, system_id, root, entry):
+        """Retrieves permissions of an entry from Agave"""
+        return self.ag.files.listPermissions(
+            systemId=system_id,
+            filePath=os.path.join(root.strip('/'), entry.name))
+
+    def index(self, system_id, path, username, bottom_up=False, levels=0,
+              index_full_path=True, full_indexing=False, pems_indexing=False,
+              bulk_options=None, concurrent_walk=False, incremental=False,
+              **kwargs):
+        """Indexes a path crawling the mounted storage.
+
+        Parameters are the same as :meth:`AgaveIndexer.index`. When the
+        system is not mounted every parameter is passed to
+        :meth:`AgaveIndexer.index` and the Agave walk is done in bulk mode.
+        Documents are always written in bulk when crawling the mounted
+        storage. `concurrent_walk` lists sibling folders with a thread pool
+        of ``settings.AGAVE_INDEXER_WALK['max_workers']`` and `incremental`
+        skips folders whose mtime and children count match their watermark,
+        it cannot be used with `bottom_up`.
+
+        :returns: a tuple with the count of documents created and documents deleted
+        :rtype: tuple
+
+        Pseudocode
+        ----------
+
+            1. use `walk_mounted` to get the lists of files and folders
+            2. call `_dedup_and_discover` to get the entries to index
+                and the ES documents to delete
+            3. add a delete bulk action for every document to delete
+                and send a `delete_by_query` for its children
+            4. add an index bulk action for every new entry and, if `full_indexing`
+                is `True`, an update bulk action for every existing entry
+            5. if `index_full_path` is `True` do the same for every parent folder
+        """
+        if incremental and bottom_up:
+            raise ValueError('incremental indexing cannot walk bottom up')
+        base = self.mounted_root(system_id)
+        if base is None:
+            logger.debug('%s is not mounted, using agave listings', system_id)
+            kwargs.setdefault('bulk', True)
+            return super(MountedIndexer, self).index(
+                system_id, path, username, bottom_up=bottom_up, levels=levels,
+                index_full_path=index_full_path, full_indexing=full_indexing,
+                pems_indexing=pems_indexing, bulk_options=bulk_options,
+                concurrent_walk=concurrent_walk, incremental=incremental,
+                **kwargs)
+
+        docs_indexed = 0
+        docs_deleted = 0
+        mgr = ESFileManager(username=username)
+        rollup = UsageRollup()
+        bulk_indexer = BulkIndexer(**(bulk_options or {}))
+        max_workers = 0
+        if concurrent_walk:
+            max_workers = getattr(settings, 'AGAVE_INDEXER_WALK', {}).get(
+                'max_workers', 8)
+        folder_docs = {}
+        for root, folders, files in self.walk_mounted(system_id, path, levels=levels,
+                                                      bottom_up=bottom_up,
+                                                      max_workers=max_workers):
+            logger.debug('system_id: %s, path: %s', system_id, root)
+            if incremental:
+                folder, folder_doc = folder_docs.pop(root, (None, None))
+                if self._is_unchanged(folder, folder_doc, folders, files):
+                    logger.debug(u'Unchanged, skipping subtree: %s', root)
+                    del folders[:]
+                    continue
+
+            objs_to_index, docs_to_delete, docs_by_name = self._dedup_and_discover(
+                system_id, username, root.strip('/') or '/', files, folders)
+
+            for d in docs_to_delete:
+                docs_deleted += self._delete_descendants(mgr, d, docs_by_name,
+                                                         rollup)
+                bulk_indexer.add(mgr.delete_action(d))
+                docs_deleted += 1
+
+            parent_pems = None
+            if pems_indexing:
+                parent_pems = self.ag.files.listPermissions(
+                    systemId=system_id, filePath=root.strip('/') or '/')
+
+            doc_ids = mgr.new_doc_ids(system_id, [
+                os.path.join(root.strip('/'), entry.name)
+                for entry in folders + files if entry.name not in docs_by_name])
+            for entry in folders + files:
+                document = docs_by_name.get(entry.name)
+                if document is not None and not full_indexing:
+                    continue
+                pems = None
+                if pems_indexing:
+                    pems = self._entry_pems(system_id, root, entry)
+                fields = self._entry_fields(system_id, root, entry,
+                                            mime_type=document is None)
+                rollup.record(system_id, os.path.join(fields['path'], entry.name),
+                              old=document_usage(document),
+                              new=file_usage(fields['length'], fields['format']))
+                bulk_indexer.add(mgr.document_action(
+                    fields, pems=pems, document=document, parent_pems=parent_pems,
+                    doc_id=doc_ids.get(os.path.join(root.strip('/'), entry.name))))
+                docs_indexed += 1
+
+            if incremental:
+                self._record_watermark(folder, folder_doc,
+                                       len(folders) + len(files), bulk_indexer)
+                for _folder in folders:
+                    if _folder.name in docs_by_name:
+                        folder_docs[os.path.join(root, _folder.name)] = (
+                            self._watermark_folder(_folder),
+                            docs_by_name[_folder.name])
+
+        if index_full_path:
+            path_comps = path.strip('/').split('/')
+            while path_comps and path_comps[0]:
+                parent, name = os.path.split('/'.join(path_comps))
+                parent = parent or '/'
+                abs_path = os.path.join(base, parent.strip('/'), name)
+                res, search = mgr.get(system_id, parent, name)
+                document = res[0] if res.hits.total else None
+                fields = self._stat_fields(system_id, parent, name,
+                                           os.lstat(abs_path), abs_path,
+                                           mime_type=document is None)
+                doc_id = None
+                if document is None:
+                    full_path = '/'.join(path_comps)
+                    doc_id = mgr.new_doc_ids(system_id, [full_path]).get(full_path)
+                bulk_indexer.add(mgr.document_action(fields, document=document,
+                                                     doc_id=doc_id))
+                docs_indexed += 1
+                path_comps.pop()
+
+        bulk_indexer.close()
+        self.bulk_errors = bulk_indexer.errors
+        if bulk_indexer.errors:
+            logger.error('%d bulk actions failed indexing %s/%s',
+                         len(bulk_indexer.errors), system_id, path)
+        rollup.flush()
+        return docs_indexed, docs_deleted
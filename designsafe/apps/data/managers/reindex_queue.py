@@ -0,0 +1,231 @@
+"""
+.. module: designsafe.apps.data.managers.reindex_queue
+   :synopsis: Debounced, coalescing queue of reindex requests.
+"""
+import json
+import logging
+import time
+import redis
+from django.conf import settings
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+_CLIENT = None
+
+
+def _redis_client():
+    """Returns a shared redis client configured with ``settings.REINDEX_QUEUE``"""
+    global _CLIENT #pylint: disable=global-statement
+    if _CLIENT is None:
+        config = getattr(settings, 'REINDEX_QUEUE', {})
+        _CLIENT = redis.StrictRedis(host=config.get('host') or 'localhost',
+                                    port=int(config.get('port') or 6379),
+                                    db=int(config.get('db') or 0))
+    return _CLIENT
+
+
+def _full_path(request):
+    """`index_full_path` of a request tuple"""
+    return request[3] if len(request) > 3 else True
+
+
+def _depth(path):
+    """Number of components of a path, `0` for the root"""
+    path = path.strip('/')
+    return len(path.split('/')) if path else 0
+
+
+def covers(pending, request):
+    """Checks if a pending request also reindexes everything a new one would.
+
+    A request `(system, path, levels)` reindexes `levels` levels under `path`,
+    `levels=0` meaning the whole subtree. An optional fourth item is the
+    request's `index_full_path`, `True` when missing.
+
+    :param tuple pending: `(system, path, levels)` of the pending request
+    :param tuple request: `(system, path, levels)` of the new request
+
+    :rtype: bool
+    """
+    system, path, levels = pending[:3]
+    req_system, req_path, req_levels = request[:3]
+    if system != req_system:
+        return False
+
+    if _full_path(request) and not _full_path(pending):
+        return False
+
+    path = path.strip('/')
+    req_path = req_path.strip('/')
+    if path and req_path != path and not req_path.startswith(path + '/'):
+        return False
+
+    if not levels:
+        return True
+    if not req_levels:
+        return False
+    return _depth(req_path) - _depth(path) + req_levels <= levels
+
+
+class ReindexQueue(object):
+    """Collects reindex requests and dispatches them once things quiet down.
+
+    Pending requests live in a redis sorted set. Members are
+    `(system, path, levels)` and scores are the time of the last request
+    touching them. A request already covered by a pending ancestor (see
+    :func:`covers`) is collapsed into it, and a new request removes every
+    pending request it covers.
+
+    :meth:`dispatch` sends a
+    :func:`~designsafe.apps.api.tasks.reindex_agave` task for every request
+    which has not been touched in `quiet_period` seconds, or which has been
+    pending for more than `max_delay` seconds. It runs periodically
+    (see ``designsafe.celery``).
+
+    Counters for requests received, collapsed and dispatched are kept in
+    a redis hash, see :meth:`stats`.
+
+    Defaults are read from ``settings.REINDEX_QUEUE``.
+
+    >>> queue = ReindexQueue()
+    >>> queue.request('designsafe.storage.default', 'username/folder', levels=1)
+    """
+    PENDING_KEY = 'designsafe:reindex:pending'
+    FIRST_SEEN_KEY = 'designsafe:reindex:first_seen'
+    STATS_KEY = 'designsafe:reindex:stats'
+
+    def __init__(self, client=None, quiet_period=None, max_delay=None):
+        config = getattr(settings, 'REINDEX_QUEUE', {})
+        self.client = client or _redis_client()
+        if quiet_period is None:
+            quiet_period = config.get('quiet_period', 5)
+        self.quiet_period = quiet_period
+        if max_delay is None:
+            max_delay = config.get('max_delay', 60)
+        self.max_delay = max_delay
+
+    @staticmethod
+    def _member(system, path, levels, index_full_path=True):
+        if index_full_path:
+            return json.dumps([system, path, levels])
+        return json.dumps([system, path, levels, False])
+
+    @staticmethod
+    def _parse(member):
+        request = json.loads(member)
+        return tuple(request) + (True, ) * (4 - len(request))
+
+    def request(self, system, path, levels=1, index_full_path=True):
+        """Records a reindex request.
+
+        Parameters are the same as
+        :func:`~designsafe.apps.api.tasks.reindex_agave`'s `file_id`,
+        `levels` and `index_full_path`. If redis is not available the task
+        is sent right away.
+
+        :param str system: system id
+        :param str path: path to reindex
+        :param int levels: levels to reindex, `0` for the whole subtree
+        :param bool index_full_path: if `True` every parent folder is
+            reindexed too
+        """
+        path = path.strip('/') or '/'
+        new = (system, path, levels, index_full_path)
+        member = self._member(*new)
+
+        def _add(pipe):
+            now = time.time()
+            pending = [self._parse(_member) for _member in
+                       pipe.zrange(self.PENDING_KEY, 0, -1)]
+            ancestor = next((_pending for _pending in pending
+                             if covers(_pending, new)), None)
+            pipe.multi()
+            if ancestor is not None:
+                pipe.zadd(self.PENDING_KEY, now, self._member(*ancestor))
+                pipe.hincrby(self.STATS_KEY, 'collapsed', 1)
+                return
+
+            covered = [self._member(*_pending) for _pending in pending
+                       if covers(new, _pending)]
+            if covered:
+                pipe.zrem(self.PENDING_KEY, *covered)
+                pipe.hdel(self.FIRST_SEEN_KEY, *covered)
+                pipe.hincrby(self.STATS_KEY, 'collapsed', len(covered))
+            pipe.zadd(self.PENDING_KEY, now, member)
+            pipe.hsetnx(self.FIRST_SEEN_KEY, member, now)
+
+        try:
+            self.client.hincrby(self.STATS_KEY, 'received', 1)
+            self.client.transaction(_add, self.PENDING_KEY)
+        except redis.RedisError:
+            logger.exception('Could not queue reindex of %s/%s, sending it now',
+                             system, path)
+            self._send(*new)
+
+    def dispatch(self):
+        """Sends a reindex task for every request ready to go.
+
+        A request is removed from the queue before sending its task so
+        concurrent dispatchers never send the same request twice.
+
+        :returns: number of tasks sent
+        :rtype: int
+        """
+        now = time.time()
+        members = set(self.client.zrangebyscore(self.PENDING_KEY, '-inf',
+                                                now - self.quiet_period))
+        for _member, first_seen in self.client.hgetall(self.FIRST_SEEN_KEY).items():
+            if float(first_seen) <= now - self.max_delay:
+                members.add(_member)
+
+        dispatched = 0
+        for _member in members:
+            if not self.client.zrem(self.PENDING_KEY, _member):
+                continue
+            self.client.hdel(self.FIRST_SEEN_KEY, _member)
+            self._send(*self._parse(_member))
+            dispatched += 1
+
+        if dispatched:
+            self.client.hincrby(self.STATS_KEY, 'dispatched', dispatched)
+        return dispatched
+
+    @staticmethod
+    def _task_kwargs(system, path, levels, index_full_path=True):
+        return {'username': 'ds_admin',
+                'file_id': '{}/{}'.format(system, path.strip('/')),
+                'levels': levels,
+                'index_full_path': index_full_path}
+
+    @classmethod
+    def _send(cls, system, path, levels, index_full_path=True):
+        from designsafe.apps.api.tasks import reindex_agave
+        reindex_agave.apply_async(kwargs=cls._task_kwargs(system, path, levels,
+                                                          index_full_path),
+                                  queue='indexing')
+
+    @classmethod
+    def signature(cls, system, path, levels=1, index_full_path=True):
+        """Returns the reindex task of a request as a celery signature,
+        to be run after another task instead of going through the queue.
+
+        Parameters are the same as :meth:`request`.
+        """
+        from designsafe.apps.api.tasks import reindex_agave
+        return reindex_agave.si(**cls._task_kwargs(system, path, levels,
+                                                   index_full_path)).set(queue='indexing')
+
+    def stats(self):
+        """Returns the queue's counters.
+
+        :returns: `received`, `collapsed` and `dispatched` counters and
+            the number of `pending` requests
+        :rtype: dict
+        """
+        counters = self.client.hgetall(self.STATS_KEY)
+        stats = dict((key, int(counters.get(key, 0)))
+                     for key in ('received', 'collapsed', 'dispatched'))
+        stats['pending'] = self.client.zcard(self.PENDING_KEY)
+        return stats
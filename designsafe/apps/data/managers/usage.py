@@ -0,0 +1,514 @@
+"""
+.. module: designsafe.apps.data.managers.usage
+   :synopsis: Storage usage rollups of user home folders, projects and folders.
+"""
+import datetime
+import logging
+import os
+from django.conf import settings
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import bulk, scan
+from elasticsearch_dsl import Search, Q
+from elasticsearch_dsl.connections import connections
+from designsafe.apps.data.models.elasticsearch import IndexedFile, IndexedUsage
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+from designsafe.libs.elasticsearch.cache import bump_generation
+from designsafe.libs.elasticsearch.docs import (path_prefix_query,
+                                                file_routing, routed, routing_meta)
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+USER = 'user'
+PROJECT = 'project'
+PROJECT_PREFIX = 'project-'
+
+DELTA_SCRIPT = (
+    "ctx._source.totalBytes += params.bytes;"
+    "ctx._source.fileCount += params.files;"
+    "ctx._source.updated = params.updated;"
+)
+
+#: Folders which rollups were never computed are left for
+#: :meth:`UsageRollup.repair_folders`.
+FOLDER_DELTA_SCRIPT = (
+    "if (ctx._source.totalLength == null || ctx._source.descendantCount == null) {"
+    "  ctx.op = 'none';"
+    "} else {"
+    "  ctx._source.totalLength += params.bytes;"
+    "  ctx._source.descendantCount += params.count;"
+    "  ctx._source.size = ctx._source.totalLength;"
+    "}"
+)
+
+#: Folders looked up by path in one search, below ES' default
+#: `indices.query.bool.max_clause_count`.
+FOLDER_LOOKUP_SIZE = 500
+
+#: First component of a file's path, i.e. the home folder it is in.
+HOME_SCRIPT = (
+    "def path = doc['path._exact'].value;"
+    "int i = path.indexOf('/');"
+    "return i < 0 ? path : path.substring(0, i);"
+)
+
+
+def usage_owner(system, path):
+    """Returns the rollup a file counts towards.
+
+    Files in :data:`settings.AGAVE_STORAGE_SYSTEM` count towards the
+    home folder they are in, files in a `project-*` system towards the
+    project.
+
+    :param str system: system id
+    :param str path: full path of the file
+
+    :returns: `(kind, owner)` or `None` for files of any other system
+    :rtype: tuple
+    """
+    if system == settings.AGAVE_STORAGE_SYSTEM:
+        username = path.strip('/').split('/')[0]
+        return (USER, username) if username else None
+    if system and system.startswith(PROJECT_PREFIX):
+        return (PROJECT, system[len(PROJECT_PREFIX):])
+    return None
+
+
+def owner_system(kind, owner):
+    """Returns the system holding an owner's files"""
+    if kind == USER:
+        return settings.AGAVE_STORAGE_SYSTEM
+    return '{}{}'.format(PROJECT_PREFIX, owner)
+
+
+def file_usage(length, fmt):
+    """Returns the `(bytes, files)` a file adds to its rollup.
+
+    Folders do not count.
+    """
+    if fmt == 'folder':
+        return 0, 0
+    return int(length or 0), 1
+
+
+def document_usage(document):
+    """Returns the `(bytes, files)` of an indexed document, `None` for
+    a missing document."""
+    if document is None:
+        return None
+    return file_usage(getattr(document, 'length', 0),
+                      getattr(document, 'format', None))
+
+
+def _files_filter():
+    return {'bool': {'must_not': [{'term': {'format': 'folder'}}]}}
+
+
+def _hit_path(hit):
+    source = hit['_source']
+    return os.path.join(source.get('path', ''), source.get('name', '')).strip('/')
+
+
+def ancestors(path):
+    """Returns the full path of every folder above a file, bottom to top.
+
+    >>> ancestors('username/a/b.txt')
+    ['username/a', 'username']
+    """
+    comps = path.strip('/').split('/')
+    return ['/'.join(comps[:i]) for i in range(len(comps) - 1, 0, -1)]
+
+
+class UsageRollup(object):
+    """Total bytes and file count of every user home folder and project,
+    total bytes and descendant count of every folder.
+
+    Owner rollups are stored as
+    :class:`~designsafe.apps.data.models.elasticsearch.IndexedUsage`
+    documents so reading one is a single `get`. Folder rollups are stored
+    on the folder's own document as `totalLength` and `descendantCount`,
+    `size` mirrors `totalLength` for listings to sort on.
+
+    The indexers, the mounted storage watcher and
+    :meth:`~designsafe.apps.data.managers.elasticsearch.FileManager.move`
+    :meth:`record` the change of every file they write and :meth:`flush`
+    the deltas once, with one scripted update per owner and per ancestor
+    folder. Files changed in storage are only counted once they are
+    indexed again. :meth:`reconcile` (nightly) and :meth:`repair_folders`
+    (weekly) recompute the rollups from the files index to correct any
+    drift, e.g. from bulk writes which failed after being recorded.
+
+    >>> rollup = UsageRollup()
+    >>> rollup.record('designsafe.storage.default', 'username/file.txt',
+    ...               old=None, new=(1024, 'raw'))
+    >>> rollup.flush()
+    """
+    def __init__(self, using='default'):
+        self.using = using
+        self.deltas = {}
+        self.folder_deltas = {}
+
+    @property
+    def client(self):
+        """ES client"""
+        return connections.get_connection(self.using)
+
+    def add(self, system, path, total_bytes, file_count, descendants=0):
+        """Adds a delta to the rollups of a file.
+
+        :param str system: system id
+        :param str path: full path of the file
+        :param int total_bytes: bytes added, negative when removed
+        :param int file_count: files added, negative when removed
+        :param int descendants: documents added, files and folders,
+            negative when removed
+        """
+        if total_bytes or descendants:
+            for folder in ancestors(path):
+                delta = self.folder_deltas.setdefault((system, folder), [0, 0])
+                delta[0] += total_bytes
+                delta[1] += descendants
+
+        owner = usage_owner(system, path)
+        if owner is None or not (total_bytes or file_count):
+            return
+        delta = self.deltas.setdefault(owner, [0, 0])
+        delta[0] += total_bytes
+        delta[1] += file_count
+
+    def record(self, system, path, old=None, new=None):
+        """Records the change of a file.
+
+        :param str system: system id
+        :param str path: full path of the file
+        :param tuple old: `(bytes, files)` before the change, see
+            :func:`file_usage`. `None` for a new file
+        :param tuple new: `(bytes, files)` after the change.
+            `None` for a deleted file
+        """
+        descendants = (new is not None) - (old is not None)
+        old = old or (0, 0)
+        new = new or (0, 0)
+        self.add(system, path, new[0] - old[0], new[1] - old[1], descendants)
+
+    def subtree_usage(self, system, path):
+        """Returns the `(bytes, files, descendants)` under a folder"""
+        search = Search(using=self.using, index=IndexedFile._doc_type.index)\
+            .query(path_prefix_query('system._exact', system, path)).extra(size=0)
+        search = routed(search, system, path)
+        search.aggs.bucket('files', 'filter', _files_filter())\
+            .metric('total_bytes', 'sum', field='length')
+        res = search.execute()
+        files = res.aggregations.files
+        return int(files.total_bytes.value or 0), files.doc_count, res.hits.total
+
+    def record_move(self, system, path, dest_path, document):
+        """Records the move of a file and, if it is a folder, of every
+        file under it.
+
+        Must be called before the descendants are moved.
+
+        :param str system: system id
+        :param str path: current full path of the file
+        :param str dest_path: new full path of the file
+        :param document: the file's document
+        """
+        total_bytes, file_count = document_usage(document)
+        descendants = 1
+        if document.format == 'folder':
+            sub_bytes, sub_files, sub_descendants = self.subtree_usage(system, path)
+            total_bytes += sub_bytes
+            file_count += sub_files
+            descendants += sub_descendants
+        self.add(system, path, -total_bytes, -file_count, -descendants)
+        self.add(system, dest_path, total_bytes, file_count, descendants)
+
+    def record_subtree_delete(self, system, path):
+        """Records the deletion of every file under a folder.
+
+        Must be called before the documents are deleted.
+        """
+        total_bytes, file_count, descendants = self.subtree_usage(system, path)
+        self.add(system, path, -total_bytes, -file_count, -descendants)
+
+    def flush(self):
+        """Applies the recorded deltas.
+
+        Rollups which do not exist yet are not created, they are computed
+        the first time they are read or by the next :meth:`reconcile`.
+        """
+        now = datetime.datetime.utcnow().isoformat()
+        for (kind, owner), (total_bytes, file_count) in self.deltas.items():
+            if not (total_bytes or file_count):
+                continue
+            try:
+                self.client.update(
+                    index=IndexedUsage._doc_type.index,
+                    doc_type=IndexedUsage._doc_type.name,
+                    id=IndexedUsage.doc_id(kind, owner),
+                    body={'script': {'lang': 'painless',
+                                     'inline': DELTA_SCRIPT,
+                                     'params': {'bytes': total_bytes,
+                                                'files': file_count,
+                                                'updated': now}}},
+                    retry_on_conflict=5)
+            except NotFoundError:
+                logger.debug('No usage rollup for %s %s yet', kind, owner)
+        self.deltas = {}
+        self._flush_folders()
+
+    def _folder_docs(self, keys):
+        """Returns the id and routing of folder documents.
+
+        Ids are kept when folders are moved, so the documents are looked
+        up by `path` and `name`.
+
+        :param list keys: `(system, path)` of the folders
+
+        :returns: document metadata by `(system, path)`
+        :rtype: dict
+        """
+        docs = {}
+        for start in range(0, len(keys), FOLDER_LOOKUP_SIZE):
+            chunk = keys[start:start + FOLDER_LOOKUP_SIZE]
+            clauses = []
+            for system, folder in chunk:
+                parent, name = os.path.split(folder)
+                clauses.append(Q('bool', filter=[
+                    Q('term', **{'system._exact': system}),
+                    Q('term', **{'path._exact': parent or '/'}),
+                    Q('term', **{'name._exact': name})]))
+            search = Search(using=self.using, index=IndexedFile._doc_type.index)\
+                .query(Q('bool', should=clauses, minimum_should_match=1))\
+                .source(['system', 'path', 'name'])\
+                .extra(size=len(chunk))
+            for hit in search.execute():
+                key = (hit.system, os.path.join(hit.path, hit.name).strip('/'))
+                docs.setdefault(key, hit.meta)
+        return docs
+
+    def _flush_folders(self):
+        folder_deltas, self.folder_deltas = self.folder_deltas, {}
+        keys = [key for key in sorted(folder_deltas,
+                                      key=lambda key: -len(ancestors(key[1])))
+                if any(folder_deltas[key])]
+        if not keys:
+            return
+        docs = self._folder_docs(keys)
+        actions = [dict({
+            '_op_type': 'update',
+            '_index': IndexedFile._doc_type.index,
+            '_type': IndexedFile._doc_type.name,
+            '_id': docs[key].id,
+            '_retry_on_conflict': 5,
+            'script': {'lang': 'painless',
+                       'inline': FOLDER_DELTA_SCRIPT,
+                       'params': {'bytes': folder_deltas[key][0],
+                                  'count': folder_deltas[key][1]}}
+        }, **routing_meta(getattr(docs[key], 'routing', None)))
+                   for key in keys if key in docs]
+        if not actions:
+            return
+        _, errors = bulk(self.client, actions, raise_on_error=False)
+        for error in errors:
+            if error.get('update', {}).get('status') != 404:
+                logger.warning('Folder rollup update failed: %s', error)
+        bump_generation(IndexedFile._doc_type.index)
+
+    def systems(self):
+        """Returns the id of every system with indexed files"""
+        search = Search(using=self.using, index=IndexedFile._doc_type.index)\
+            .extra(size=0)
+        search.aggs.bucket('systems', 'terms', field='system._exact', size=10000)
+        res = search.execute()
+        return [bucket.key for bucket in res.aggregations.systems.buckets]
+
+    def _scan(self, query, routing=None):
+        kwargs = {'routing': routing} if routing is not None else {}
+        return scan(self.client, index=IndexedFile._doc_type.index,
+                    query={'query': query},
+                    _source=['path', 'name', 'format', 'length', 'size',
+                             'totalLength', 'descendantCount'],
+                    **kwargs)
+
+    @staticmethod
+    def _repair(bulk_indexer, hit, fields):
+        """Updates the fields of a document which differ.
+
+        :returns: `1` if the document is updated, `0` otherwise
+        """
+        source = hit['_source']
+        if all(source.get(key) == value for key, value in fields.items()):
+            return 0
+        action = {'_op_type': 'update',
+                  '_index': hit['_index'],
+                  '_type': hit['_type'],
+                  '_id': hit['_id'],
+                  'doc': fields}
+        action.update(routing_meta(hit.get('_routing')))
+        bulk_indexer.add(action)
+        return 1
+
+    def repair_folders(self, system):
+        """Recomputes `totalLength`, `descendantCount` and `size` of every
+        folder of a system.
+
+        Top level folders, i.e. home folders or the folders of a project,
+        are repaired one at a time so only the rollups of one of them are
+        held in memory. Files which `size` is not their `length`, e.g.
+        indexed before `size` was added, are repaired too.
+
+        :param str system: system id
+
+        :returns: number of documents updated
+        :rtype: int
+        """
+        top = {'bool': {'filter': [{'term': {'system._exact': system}},
+                                   {'term': {'path._exact': '/'}}]}}
+        repaired = 0
+        with BulkIndexer(using=self.using) as bulk_indexer:
+            for hit in self._scan(top):
+                source = hit['_source']
+                if source.get('format') == 'folder':
+                    repaired += self._repair_folder(bulk_indexer, system, hit)
+                else:
+                    repaired += self._repair(bulk_indexer, hit, {
+                        'size': file_usage(source.get('length'), None)[0]})
+        return repaired
+
+    def _repair_folder(self, bulk_indexer, system, folder_hit):
+        """Repairs a folder and every document under it with one scan"""
+        root = _hit_path(folder_hit)
+        folders = {root: [folder_hit]}
+        totals = {}
+        repaired = 0
+        for hit in self._scan(path_prefix_query('system._exact', system, root),
+                              routing=file_routing(system, root)):
+            source = hit['_source']
+            full_path = _hit_path(hit)
+            if source.get('format') == 'folder':
+                folders.setdefault(full_path, []).append(hit)
+            else:
+                repaired += self._repair(bulk_indexer, hit, {
+                    'size': file_usage(source.get('length'), None)[0]})
+            total_bytes, _ = file_usage(source.get('length'), source.get('format'))
+            for folder in ancestors(full_path):
+                total = totals.setdefault(folder, [0, 0])
+                total[0] += total_bytes
+                total[1] += 1
+
+        for full_path, hits in folders.items():
+            total_bytes, descendants = totals.get(full_path, (0, 0))
+            for hit in hits:
+                repaired += self._repair(bulk_indexer, hit, {
+                    'totalLength': total_bytes,
+                    'descendantCount': descendants,
+                    'size': total_bytes})
+        return repaired
+
+    def compute_query(self, query, routing=None):
+        """Returns the `(bytes, files)` of the files matching a query
+
+        :param dict query: query matching the files
+        :param str routing: routing key of the files, see
+            :func:`~designsafe.libs.elasticsearch.docs.file_routing`
+        """
+        search = Search(using=self.using, index=IndexedFile._doc_type.index)\
+            .query(query).filter(_files_filter()).extra(size=0)
+        if routing is not None:
+            search = search.params(routing=routing)
+        search.aggs.metric('total_bytes', 'sum', field='length')
+        res = search.execute()
+        return int(res.aggregations.total_bytes.value or 0), res.hits.total
+
+    def compute(self, kind, owner):
+        """Computes the `(bytes, files)` of an owner from the files index"""
+        system = owner_system(kind, owner)
+        if kind == USER:
+            query = path_prefix_query('system._exact', system, owner)
+        else:
+            query = {'term': {'system._exact': system}}
+        return self.compute_query(query, routing=file_routing(system, owner))
+
+    def _document(self, kind, owner, total_bytes, file_count, now):
+        return IndexedUsage(meta={'id': IndexedUsage.doc_id(kind, owner)},
+                            kind=kind, owner=owner,
+                            system=owner_system(kind, owner),
+                            totalBytes=total_bytes, fileCount=file_count,
+                            updated=now, reconciled=now)
+
+    def get(self, kind, owner):
+        """Returns the rollup of an owner.
+
+        The rollup is computed and saved if it does not exist yet.
+
+        :param str kind: :data:`USER` or :data:`PROJECT`
+        :param str owner: username or project uuid
+
+        :rtype: :class:`~designsafe.apps.data.models.elasticsearch.IndexedUsage`
+        """
+        usage = IndexedUsage.get(id=IndexedUsage.doc_id(kind, owner),
+                                 using=self.using, ignore=404)
+        if usage is None:
+            total_bytes, file_count = self.compute(kind, owner)
+            usage = self._document(kind, owner, total_bytes, file_count,
+                                   datetime.datetime.utcnow())
+            usage.save(using=self.using)
+        return usage
+
+    def _buckets(self, query, terms, partitions=1):
+        for partition in range(partitions):
+            search = Search(using=self.using, index=IndexedFile._doc_type.index)\
+                .query(query).filter(_files_filter()).extra(size=0)
+            if partitions > 1:
+                terms = dict(terms, include={'partition': partition,
+                                             'num_partitions': partitions})
+            search.aggs.bucket('owners', 'terms', **terms)\
+                .metric('total_bytes', 'sum', field='length')
+            res = search.execute()
+            for bucket in res.aggregations.owners.buckets:
+                yield bucket.key, int(bucket.total_bytes.value or 0), bucket.doc_count
+
+    def reconcile(self):
+        """Recomputes every rollup from the files index.
+
+        Projects are aggregated by system and home folders by the first
+        component of their files' paths, in `partitions` requests (see
+        ``settings.USAGE_ROLLUPS``).
+
+        :returns: number of rollups written
+        :rtype: int
+        """
+        config = getattr(settings, 'USAGE_ROLLUPS', {})
+        size = config.get('partition_size', 10000)
+        now = datetime.datetime.utcnow()
+        owners = []
+
+        homes = self._buckets(
+            {'bool': {'filter': [{'term': {'system._exact': settings.AGAVE_STORAGE_SYSTEM}}],
+                      'must_not': [{'term': {'path._exact': '/'}}]}},
+            {'script': {'lang': 'painless', 'inline': HOME_SCRIPT}, 'size': size},
+            partitions=config.get('partitions', 10))
+        owners += [(USER, key, total_bytes, count) for key, total_bytes, count in homes]
+
+        projects = self._buckets(
+            {'prefix': {'system._exact': PROJECT_PREFIX}},
+            {'field': 'system._exact', 'size': size},
+            partitions=config.get('partitions', 10))
+        owners += [(PROJECT, key[len(PROJECT_PREFIX):], total_bytes, count)
+                   for key, total_bytes, count in projects]
+
+        actions = (self._document(kind, owner, total_bytes, count, now)
+                   .to_dict(include_meta=True)
+                   for kind, owner, total_bytes, count in owners)
+        written, errors = bulk(self.client, actions, raise_on_error=False)
+        if errors:
+            logger.error('%d usage rollups could not be written', len(errors))
+
+        stale = Search(using=self.using, index=IndexedUsage._doc_type.index)\
+            .filter('range', reconciled={'lt': now.isoformat()})
+        self.client.delete_by_query(index=IndexedUsage._doc_type.index,
+                                    body={'query': stale.to_dict()['query']},
+                                    conflicts='proceed')
+        return written
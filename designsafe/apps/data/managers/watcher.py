@@ -0,0 +1,356 @@
+"""
+.. module: designsafe.apps.data.managers.watcher
+   :synopsis: Keeps the files index up to date with inotify events
+       from the mounted storage.
+"""
+import logging
+import os
+import stat
+import time
+from django.conf import settings
+from elasticsearch_dsl.query import Q
+from designsafe.apps.data.models.elasticsearch import IndexedFile
+from designsafe.apps.data.managers.elasticsearch import (FileManager as ESFileManager,
+                                                         mounted_path)
+from designsafe.apps.data.managers.mounted_indexer import MountedIndexer
+from designsafe.apps.data.managers.reindex_queue import ReindexQueue
+from designsafe.apps.data.managers.usage import (UsageRollup, file_usage,
+                                                 document_usage)
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+# inotify(7) event masks. Defined here so events can be processed
+# without importing pyinotify (e.g. in tests).
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+#: Prefix of project system ids. The projects root holds every project,
+#: one folder per project uuid.
+PROJECT_SYSTEM_PREFIX = 'project-'
+
+
+class MountedWatcher(object):
+    """Follows the mounted storage with inotify and updates the index.
+
+    Events are coalesced by path, the last event for a path wins. Pending
+    changes are written as one batch of
+    :class:`~designsafe.apps.data.models.elasticsearch.IndexedFile`
+    upserts and deletes once no events have been received for
+    `quiet_period` seconds or once `max_batch` paths are pending.
+    Documents are built from `stat` data, no Agave calls are made.
+
+    Inotify does not report the contents of a folder created or moved into
+    a watched folder, and it drops events when its queue overflows. In both
+    cases a targeted rescan of the affected folders is scheduled with
+    :class:`~designsafe.apps.data.managers.reindex_queue.ReindexQueue`.
+
+    Defaults are read from ``settings.AGAVE_MOUNT_WATCHER``.
+
+    :param list systems: system ids to watch.
+    :param bool all_projects: if `True` watch the root holding every project.
+    :param int quiet_period: seconds without events before a batch is written.
+    :param int max_batch: max number of pending paths before a batch is written.
+    :param dict bulk_options: keyword arguments for
+        :class:`~designsafe.libs.elasticsearch.bulk.BulkIndexer`.
+    :param rescan: callable used to schedule rescans. It is called with
+        `(system_id, path, levels)`. Defaults to :meth:`schedule_rescan`.
+
+    .. note:: Every folder under a watched root needs an inotify watch.
+        `fs.inotify.max_user_watches` must be raised accordingly.
+    """
+    def __init__(self, systems=None, all_projects=None, quiet_period=None,
+                 max_batch=None, bulk_options=None, rescan=None):
+        config = getattr(settings, 'AGAVE_MOUNT_WATCHER', {})
+        if systems is None:
+            systems = config.get('systems', [])
+        if all_projects is None:
+            all_projects = config.get('all_projects', False)
+        self.roots = []
+        for system_id in systems:
+            if system_id == PROJECT_SYSTEM_PREFIX:
+                raise ValueError('Use all_projects to watch every project')
+            root = mounted_path(system_id)
+            if root is None:
+                logger.warning('%s is not mounted, not watching it', system_id)
+                continue
+            self.roots.append((system_id, root.rstrip('/')))
+        if all_projects:
+            root = mounted_path(PROJECT_SYSTEM_PREFIX)
+            if root is None:
+                logger.warning('Projects are not mounted, not watching them')
+            else:
+                self.roots.append((PROJECT_SYSTEM_PREFIX, root.rstrip('/')))
+
+        if quiet_period is None:
+            quiet_period = config.get('quiet_period', 2)
+        self.quiet_period = quiet_period
+        self.max_batch = max_batch or config.get('max_batch', 500)
+        self.bulk_options = bulk_options or {}
+        self.rescan = rescan or self.schedule_rescan
+        self.stats = {'events': 0, 'upserts': 0, 'deletes': 0,
+                      'rescans': 0, 'overflows': 0}
+        self._pending = {}
+        self._rescans = {}
+        self._touched = set()
+        self._last_event = None
+
+    def resolve(self, abs_path):
+        """Maps an absolute path to a system id and a path.
+
+        :param str abs_path: absolute path in the mounted storage
+
+        :returns: `(system_id, path)`. `path` is relative to the system's root,
+            `''` for the system's root. `(None, None)` if the path
+            is not watched.
+        :rtype: tuple
+        """
+        for system_id, root in self.roots:
+            if abs_path != root and not abs_path.startswith(root + '/'):
+                continue
+            path = abs_path[len(root):].strip('/')
+            if system_id == PROJECT_SYSTEM_PREFIX:
+                if not path:
+                    return None, None
+                comps = path.split('/', 1)
+                system_id = PROJECT_SYSTEM_PREFIX + comps[0]
+                path = comps[1] if len(comps) > 1 else ''
+            return system_id, path
+        return None, None
+
+    def process_event(self, event):
+        """Records an inotify event.
+
+        Meant to be used as pyinotify's processing function but any object
+        with `mask` and `pathname` attributes works.
+        """
+        self.stats['events'] += 1
+        self._last_event = time.time()
+        mask = event.mask
+        if mask & IN_Q_OVERFLOW:
+            self.on_overflow()
+            return
+
+        abs_path = event.pathname.rstrip('/')
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self._pending[abs_path] = DELETE
+        else:
+            self._pending[abs_path] = UPSERT
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_rescan(abs_path, levels=0)
+        self._touched.add(os.path.dirname(abs_path))
+
+    def on_overflow(self):
+        """Schedules a rescan of every folder touched since the last batch.
+
+        If no folder has been touched yet every watched root is rescanned.
+        """
+        self.stats['overflows'] += 1
+        logger.warning('inotify queue overflow, rescanning %d folders',
+                       len(self._touched))
+        folders = self._touched or set(root for _, root in self.roots)
+        for abs_path in folders:
+            self._add_rescan(abs_path, levels=1)
+
+    def _add_rescan(self, abs_path, levels):
+        current = self._rescans.get(abs_path)
+        if current is None or (levels == 0 and current != 0):
+            self._rescans[abs_path] = levels
+
+    def ready(self):
+        """Checks if the pending changes should be written"""
+        if not self._pending and not self._rescans:
+            return False
+        if len(self._pending) >= self.max_batch:
+            return True
+        return time.time() - (self._last_event or 0) >= self.quiet_period
+
+    def flush(self):
+        """Writes every pending change to the index and schedules rescans.
+
+        :returns: `(upserts, deletes)` number of documents written
+            and deleted
+        :rtype: tuple
+        """
+        pending, self._pending = self._pending, {}
+        rescans, self._rescans = self._rescans, {}
+        self._touched = set()
+        upserts = 0
+        deletes = 0
+        pems_cache = {}
+        rollup = UsageRollup()
+        bulk_indexer = BulkIndexer(**self.bulk_options)
+        for abs_path in sorted(pending):
+            system_id, path = self.resolve(abs_path)
+            if not path:
+                continue
+
+            parent, name = os.path.split(path)
+            parent = parent or '/'
+            stat_result = None
+            if pending[abs_path] == UPSERT:
+                try:
+                    stat_result = os.lstat(abs_path)
+                except OSError:
+                    stat_result = None
+                else:
+                    if stat.S_ISLNK(stat_result.st_mode):
+                        continue
+
+            documents = self._documents(system_id, parent, name)
+            if stat_result is None:
+                if any(doc.format == 'folder' for doc in documents):
+                    for child in self._children(system_id, path):
+                        rollup.record(system_id, child.full_path,
+                                      old=document_usage(child))
+                        bulk_indexer.add(ESFileManager.delete_action(child))
+                        deletes += 1
+                for doc in documents:
+                    rollup.record(system_id, path, old=document_usage(doc))
+                    bulk_indexer.add(ESFileManager.delete_action(doc))
+                    deletes += 1
+                continue
+
+            document = documents[0] if documents else None
+            for doc in documents[1:]:
+                rollup.record(system_id, path, old=document_usage(doc))
+                bulk_indexer.add(ESFileManager.delete_action(doc))
+                deletes += 1
+
+            pems = None
+            if document is None:
+                pems = self._inherited_pems(system_id, parent, pems_cache)
+            fields = MountedIndexer._stat_fields(system_id, parent, name,
+                                                 stat_result, abs_path,
+                                                 mime_type=document is None)
+            mgr = ESFileManager(self.owner(system_id, path))
+            doc_id = None
+            if document is None:
+                doc_id = mgr.new_doc_ids(system_id, [path]).get(path.strip('/'))
+            rollup.record(system_id, path, old=document_usage(document),
+                          new=file_usage(fields['length'], fields['format']))
+            bulk_indexer.add(mgr.document_action(fields, pems=pems,
+                                                 document=document,
+                                                 doc_id=doc_id))
+            upserts += 1
+
+        bulk_indexer.close()
+        if bulk_indexer.errors:
+            logger.error('%d bulk actions failed writing watcher batch',
+                         len(bulk_indexer.errors))
+        rollup.flush()
+
+        for abs_path, levels in rescans.items():
+            system_id, path = self.resolve(abs_path)
+            if system_id is None:
+                continue
+            self.rescan(system_id, path or '/', levels)
+            self.stats['rescans'] += 1
+
+        self.stats['upserts'] += upserts
+        self.stats['deletes'] += deletes
+        logger.debug('watcher batch: %d upserts, %d deletes, %d rescans',
+                     upserts, deletes, len(rescans))
+        return upserts, deletes
+
+    @staticmethod
+    def owner(system_id, path):
+        """Returns the username used for the documents of a path.
+
+        Paths in the default storage system are owned by the user of the
+        home folder. Everything else is indexed as `ds_admin`.
+        """
+        if system_id == settings.AGAVE_STORAGE_SYSTEM:
+            return path.strip('/').split('/')[0]
+        return 'ds_admin'
+
+    @staticmethod
+    def _documents(system_id, path, name):
+        """Returns every document with the given `system`, `path` and `name`.
+
+        The permissions filter is not applied.
+        """
+        search = IndexedFile.search()
+        search = search.query(Q('bool', must=[
+            Q('term', **{'system._exact': system_id}),
+            Q('term', **{'path._exact': path}),
+            Q('term', **{'name._exact': name})
+        ]))
+        return list(search.scan())
+
+    @staticmethod
+    def _children(system_id, path):
+        """Returns every document under a folder"""
+        search = IndexedFile.search()
+        search = search.query(Q('bool', must=[
+            Q('term', **{'system._exact': system_id}),
+            Q('term', **{'path._path': path})
+        ]))
+        return search.scan()
+
+    def _inherited_pems(self, system_id, path, cache):
+        """Returns the permissions of a new document.
+
+        New documents inherit the permissions of their parent folder's
+        document. If there is no such document we fall back to the owner's
+        default permissions.
+        """
+        key = (system_id, path)
+        if key not in cache:
+            pems = None
+            if path != '/':
+                parent, name = os.path.split(path)
+                documents = self._documents(system_id, parent or '/', name)
+                if documents and documents[0].permissions:
+                    pems = [pem.to_dict() for pem in documents[0].permissions]
+            if pems is None:
+                pems = ESFileManager(self.owner(system_id, path))._default_pems()
+            cache[key] = pems
+        return cache[key]
+
+    @staticmethod
+    def schedule_rescan(system_id, path, levels):
+        """Schedules a rescan of a folder through the reindex queue.
+
+        Parent folders are not reindexed, the watcher already received
+        their events.
+        """
+        ReindexQueue().request(system_id, path, levels=levels,
+                               index_full_path=False)
+
+    def run(self):
+        """Watches the mounted roots until interrupted."""
+        import pyinotify
+
+        watch_manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(watch_manager,
+                                      default_proc_fun=self.process_event,
+                                      timeout=int(self.quiet_period * 1000))
+        for system_id, root in self.roots:
+            logger.info('Watching %s: %s', system_id, root)
+            watch_manager.add_watch(root, WATCH_MASK, proc_fun=self.process_event,
+                                    rec=True, auto_add=True)
+        try:
+            while True:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                if self.ready():
+                    self.flush()
+        finally:
+            self.flush()
+            notifier.stop()
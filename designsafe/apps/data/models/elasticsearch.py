@@ -2,6 +2,7 @@ from __future__ import unicode_literals, absolute_import
 from future.utils import python_2_unicode_compatible
 import logging
 import json
+import os
 from django.conf import settings
 from django.db import models
 from elasticsearch_dsl.connections import connections
@@ -11,16 +12,36 @@ from elasticsearch_dsl import (Search, DocType, Date, Nested,
                                GeoPoint, String, MetaField)
 from elasticsearch_dsl.query import Q
 from elasticsearch import TransportError, ConnectionTimeout
-from designsafe.libs.elasticsearch.analyzers import path_analyzer
+from designsafe.libs.elasticsearch.analyzers import (path_analyzer, ngram_analyzer,
+                                                     ngram_search_analyzer)
+from designsafe.libs.elasticsearch.docs import (new_file_doc_id, file_routing,
+                                                pems_principals)
+from designsafe.libs.elasticsearch.cache import bump_generation
+from designsafe.libs.elasticsearch.projections import LISTING, SEARCH, DETAIL
 
 #pylint: disable=invalid-name
 logger = logging.getLogger(__name__)
 #pylint: enable=invalid-name
 
+#: Fields of a file rendered by listings and searches.
+FILE_LISTING_FIELDS = ['agavePath', 'descendantCount', 'format', 'keywords',
+                       'lastModified', 'length', 'mimeType', 'name', 'path',
+                       'permissions', 'system', 'totalLength', 'type']
+
+#: `_source` projections of file documents, see
+#: :func:`~designsafe.libs.elasticsearch.projections.apply_projection`.
+FILE_SOURCE_PRESETS = {
+    LISTING: {'include': FILE_LISTING_FIELDS},
+    SEARCH: {'include': FILE_LISTING_FIELDS},
+    DETAIL: {'exclude': ['readers', 'writers', 'watermark']}
+}
+
 @python_2_unicode_compatible
 class IndexedFile(DocType):
     name = Text(fields={
-        '_exact': Keyword()
+        '_exact': Keyword(),
+        '_ngram': Text(analyzer=ngram_analyzer,
+                       search_analyzer=ngram_search_analyzer)
     })
     path = Text(fields={
         '_exact': Keyword(),
@@ -29,6 +50,10 @@ class IndexedFile(DocType):
     })
     lastModified = Date()
     length = Long()
+    totalLength = Long()
+    descendantCount = Long()
+    #: `length` of a file, `totalLength` of a folder. Listings sort on it.
+    size = Long()
     format = String()
     mimeType = Keyword()
     type = String()
@@ -46,7 +71,53 @@ class IndexedFile(DocType):
             'execute': Boolean()
         })
     })
+    readers = Keyword(multi=True)
+    writers = Keyword(multi=True)
+    #: `True` when `permissions` differ from the parent folder's.
+    explicitPems = Boolean()
+    keywords = Text(fields={
+        '_exact': Keyword(),
+        '_ngram': Text(analyzer=ngram_analyzer,
+                       search_analyzer=ngram_search_analyzer)
+    })
     uuid = Keyword()
+    watermark = Object(properties={
+        'lastModified': Date(),
+        'childCount': Long(),
+        'indexed': Date()
+    })
+
+    SOURCE_PRESETS = FILE_SOURCE_PRESETS
+
+    @property
+    def full_path(self):
+        """Returns the file's full path"""
+        return os.path.join(self.path, self.name)
+
+    def set_permissions(self, pems):
+        """Sets `permissions` and the `readers` and `writers` derived
+        from them, see
+        :func:`~designsafe.libs.elasticsearch.docs.pems_principals`."""
+        self.permissions = pems
+        self.readers, self.writers = pems_principals(pems)
+
+    def save(self, **kwargs):
+        """Saves the document, using a deterministic id for new documents.
+
+        See :func:`~designsafe.libs.elasticsearch.docs.new_file_doc_id`.
+        Existing documents keep their id, even if the file was moved.
+        """
+        if not getattr(self.meta, 'id', None):
+            self.meta.id = new_file_doc_id(self._doc_type.index,
+                                           self._doc_type.name, self.system,
+                                           self.full_path, routed=True)
+        if not getattr(self.meta, 'routing', None):
+            routing = file_routing(self.system, self.full_path)
+            if routing is not None:
+                self.meta.routing = routing
+        res = super(IndexedFile, self).save(**kwargs)
+        bump_generation(self._doc_type.index)
+        return res
 
     class Meta:
         index = settings.ES_INDICES['files']['name']
@@ -343,3 +414,31 @@ class IndexedPublicationLegacy(DocType):
         index = settings.ES_INDICES['publications_legacy']['name']
         doc_type = settings.ES_INDICES['publications_legacy']['documents'][0]['name']
         dynamic = MetaField('strict')
+
+@python_2_unicode_compatible
+class IndexedUsage(DocType):
+    """Storage used by a user's home folder or by a project.
+
+    Maintained by :class:`~designsafe.apps.data.managers.usage.UsageRollup`.
+    The document's id is `<kind>:<owner>`, see :meth:`doc_id`.
+    """
+    kind = Keyword()
+    owner = Keyword()
+    system = Keyword()
+    totalBytes = Long()
+    fileCount = Long()
+    updated = Date()
+    reconciled = Date()
+
+    @staticmethod
+    def doc_id(kind, owner):
+        """Returns the id of the rollup of an owner"""
+        return '{}:{}'.format(kind, owner)
+
+    def __str__(self):
+        return self.doc_id(self.kind, self.owner)
+
+    class Meta:
+        index = settings.ES_INDICES['usage']['name']
+        doc_type = settings.ES_INDICES['usage']['documents'][0]['name']
+        dynamic = MetaField('strict')
@@ -1,4 +1,4 @@
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
@@ -14,7 +14,12 @@ from unittest import skip
 
 from agavepy.agave import Agave
 import mock
+import os
+import urllib2
+import datetime
+from dateutil.tz import tzutc
 import json
+import threading
 
 import logging
 
@@ -109,3 +114,889 @@ class DataBrowserViewTestCase(DataBrowserBaseTestCase):
                 mock_public_listing.assert_called_with(None)
             else:
                 mock_public_listing.assert_called_with('/'.join(url_components[3:]))
+
+
+class AgaveIndexerBulkTestCase(TestCase):
+    """Tests for the bulk write path of :class:`AgaveIndexer`"""
+
+    def _agave_file(self, path, format='raw'):
+        return mock.MagicMock(system='designsafe.storage.default',
+                              path=path, format=format,
+                              name=path.split('/')[-1])
+
+    @mock.patch('designsafe.apps.data.managers.indexer.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.indexer.ESFileManager')
+    def test_index_bulk_adds_one_action_per_file(self, mock_mgr_cls, mock_bulk_cls):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        indexer = AgaveIndexer(agave_client=mock.MagicMock())
+        folder = self._agave_file('ds_user/folder', format='folder')
+        file_a = self._agave_file('ds_user/a.txt')
+        file_b = self._agave_file('ds_user/b.txt')
+        existing = mock.MagicMock()
+        indexer.walk_levels = mock.MagicMock(
+            return_value=iter([('ds_user', [folder], [file_a, file_b])]))
+        indexer._dedup_and_discover = mock.MagicMock(
+            return_value=([file_a, file_b], [], {'folder': existing}))
+        bulk = mock_bulk_cls.return_value
+        bulk.errors = []
+        mgr = mock_mgr_cls.return_value
+        mgr.new_doc_ids.return_value = {'ds_user/a.txt': 'id-a',
+                                        'ds_user/b.txt': 'id-b'}
+
+        indexed, deleted = indexer.index('designsafe.storage.default', 'ds_user',
+                                         'ds_user', full_indexing=True,
+                                         index_full_path=False, bulk=True)
+
+        self.assertEqual(indexed, 3)
+        self.assertEqual(deleted, 0)
+        self.assertEqual(bulk.add.call_count, 3)
+        mgr.index.assert_not_called()
+        mgr.new_doc_ids.assert_called_once_with('designsafe.storage.default',
+                                                ['ds_user/a.txt', 'ds_user/b.txt'])
+        mgr.index_action.assert_any_call(folder, pems=None, document=existing,
+                                         parent_pems=None, doc_id=None)
+        mgr.index_action.assert_any_call(file_a, pems=None, document=None,
+                                         parent_pems=None, doc_id='id-a')
+        bulk.close.assert_called_once_with()
+
+    @mock.patch('designsafe.apps.data.managers.indexer.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.indexer.ESFileManager')
+    def test_index_bulk_reports_errors(self, mock_mgr_cls, mock_bulk_cls):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        indexer = AgaveIndexer(agave_client=mock.MagicMock())
+        file_a = self._agave_file('ds_user/a.txt')
+        indexer.walk_levels = mock.MagicMock(
+            return_value=iter([('ds_user', [], [file_a])]))
+        indexer._dedup_and_discover = mock.MagicMock(
+            return_value=([file_a], [], {}))
+        error = {'index': {'_id': 'abc', 'status': 400}}
+        mock_bulk_cls.return_value.errors = [error]
+
+        indexer.index('designsafe.storage.default', 'ds_user', 'ds_user',
+                      index_full_path=False, bulk=True,
+                      bulk_options={'chunk_size': 10})
+
+        mock_bulk_cls.assert_called_once_with(chunk_size=10)
+        self.assertEqual(indexer.bulk_errors, [error])
+
+
+class AgaveIndexerConcurrentWalkTestCase(TestCase):
+    """Tests for :meth:`AgaveIndexer.walk_levels_concurrent`"""
+
+    tree = {
+        'ds_user': ['a/', 'b/', 'file1.txt'],
+        'ds_user/a': ['c/', 'file2.txt'],
+        'ds_user/a/c': ['file3.txt'],
+        'ds_user/b': ['file4.txt'],
+    }
+
+    def _listing(self, systemId, filePath):
+        path = urllib2.unquote(filePath)
+        listing = [mock.MagicMock(format='folder', path=path)]
+        listing[0].name = '.'
+        for entry in self.tree[path]:
+            name = entry.strip('/')
+            _file = mock.MagicMock(path='/'.join([path, name]),
+                                   format='folder' if entry.endswith('/') else 'raw')
+            _file.name = name
+            listing.append(_file)
+        return listing
+
+    def _indexer(self):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        agave_client = mock.MagicMock()
+        agave_client.files.list.side_effect = self._listing
+        return AgaveIndexer(agave_client=agave_client)
+
+    def test_same_levels_as_walk_levels(self):
+        indexer = self._indexer()
+        expected = [(root, [f.path for f in folders], [f.path for f in files])
+                    for root, folders, files in indexer.walk_levels('system', 'ds_user')]
+        levels = [(root, [f.path for f in folders], [f.path for f in files])
+                  for root, folders, files in indexer.walk_levels_concurrent(
+                      'system', 'ds_user', username='ds_user', max_workers=2)]
+        self.assertEqual(levels, expected)
+
+    def test_inplace_pruning(self):
+        indexer = self._indexer()
+        roots = []
+        for root, folders, files in indexer.walk_levels_concurrent('system', 'ds_user'):
+            roots.append(root)
+            folders[:] = [f for f in folders if f.name != 'a']
+        self.assertEqual(roots, ['ds_user', 'ds_user/b'])
+        listed = [c[1]['filePath'] for c in indexer.ag.files.list.call_args_list]
+        self.assertNotIn('ds_user/a', listed)
+
+    def test_levels_and_bottom_up(self):
+        indexer = self._indexer()
+        roots = [root for root, _, _ in indexer.walk_levels_concurrent(
+            'system', 'ds_user', bottom_up=True, levels=2)]
+        self.assertEqual(roots[-1], 'ds_user')
+        self.assertItemsEqual(roots, ['ds_user', 'ds_user/a', 'ds_user/b'])
+
+    def test_client_per_thread(self):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        clients = []
+        threads = set()
+
+        def _factory():
+            client = mock.MagicMock()
+            client.files.list.side_effect = self._listing
+            clients.append(client)
+            threads.add(threading.current_thread().ident)
+            return client
+
+        indexer = AgaveIndexer(agave_client=mock.MagicMock(),
+                               client_factory=_factory)
+        roots = [root for root, _, _ in indexer.walk_levels_concurrent(
+            'system', 'ds_user', max_workers=2)]
+        self.assertIn('ds_user/a', roots)
+        self.assertEqual(len(clients), len(threads))
+        self.assertLessEqual(len(clients), 2)
+        self.assertFalse(indexer.ag.files.list.called)
+        listed = sum(c.files.list.call_count for c in clients)
+        self.assertEqual(listed, len(roots))
+
+
+class AgaveIndexerIncrementalTestCase(TestCase):
+    """Tests for the watermark checks used by incremental indexing"""
+
+    def setUp(self):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        self.indexer_cls = AgaveIndexer
+        self.folder = mock.MagicMock(lastModified=datetime.datetime(
+            2018, 1, 2, 3, 4, 5, tzinfo=tzutc()))
+        self.document = mock.MagicMock()
+        self.document.watermark.childCount = 2
+        self.document.watermark.lastModified = '2018-01-02T03:04:05+00:00'
+
+    def test_unchanged_folder(self):
+        self.assertTrue(self.indexer_cls._is_unchanged(
+            self.folder, self.document, [mock.MagicMock()], [mock.MagicMock()]))
+
+    def test_changed_child_count(self):
+        self.assertFalse(self.indexer_cls._is_unchanged(
+            self.folder, self.document, [mock.MagicMock()], []))
+
+    def test_changed_last_modified(self):
+        self.folder.lastModified = datetime.datetime(2018, 2, 1, tzinfo=tzutc())
+        self.assertFalse(self.indexer_cls._is_unchanged(
+            self.folder, self.document, [mock.MagicMock()], [mock.MagicMock()]))
+
+    def test_no_watermark(self):
+        self.assertFalse(self.indexer_cls._is_unchanged(
+            self.folder, None, [mock.MagicMock()], [mock.MagicMock()]))
+        self.assertFalse(self.indexer_cls._is_unchanged(
+            None, self.document, [mock.MagicMock()], [mock.MagicMock()]))
+
+    def test_bottom_up_rejected(self):
+        from designsafe.apps.data.managers.mounted_indexer import MountedIndexer
+        for indexer_cls in (self.indexer_cls, MountedIndexer):
+            indexer = indexer_cls(agave_client=mock.MagicMock())
+            with self.assertRaises(ValueError):
+                indexer.index('designsafe.storage.default', 'ds_user', 'ds_user',
+                              bottom_up=True, incremental=True)
+
+    def test_record_watermark(self):
+        bulk = mock.MagicMock()
+        self.indexer_cls._record_watermark(self.folder, self.document, 2, bulk)
+        action = bulk.add.call_args[0][0]
+        self.assertEqual(action['_op_type'], 'update')
+        self.assertEqual(action['doc']['watermark']['childCount'], 2)
+        self.assertEqual(action['doc']['watermark']['lastModified'],
+                         '2018-01-02T03:04:05+00:00')
+
+
+class MountedIndexerTestCase(TestCase):
+    """Tests for :class:`MountedIndexer` using a local temp tree"""
+
+    def setUp(self):
+        import tempfile
+        self.base = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.base, 'ds_user', 'a', 'c'))
+        os.makedirs(os.path.join(self.base, 'ds_user', 'b'))
+        for path in ['ds_user/file1.txt', 'ds_user/a/file2.txt',
+                     'ds_user/a/c/file3.txt', 'ds_user/b/file4.txt']:
+            with open(os.path.join(self.base, path), 'w') as _file:
+                _file.write('data')
+        patcher = mock.patch(
+            'designsafe.apps.data.managers.mounted_indexer.mounted_path',
+            return_value=self.base)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.base)
+
+    def _indexer(self):
+        from designsafe.apps.data.managers.mounted_indexer import MountedIndexer
+        return MountedIndexer(agave_client=mock.MagicMock())
+
+    def test_walk_mounted(self):
+        indexer = self._indexer()
+        levels = [(root, [f.name for f in folders], [f.name for f in files])
+                  for root, folders, files in indexer.walk_mounted('system', 'ds_user')]
+        self.assertEqual(levels, [
+            ('ds_user', ['a', 'b'], ['file1.txt']),
+            ('ds_user/a', ['c'], ['file2.txt']),
+            ('ds_user/a/c', [], ['file3.txt']),
+            ('ds_user/b', [], ['file4.txt'])])
+        self.assertFalse(indexer.ag.files.list.called)
+
+    def test_walk_mounted_levels(self):
+        indexer = self._indexer()
+        roots = [root for root, _, _ in indexer.walk_mounted('system', 'ds_user', levels=1)]
+        self.assertEqual(roots, ['ds_user'])
+
+    def test_walk_mounted_bottom_up_concurrent(self):
+        indexer = self._indexer()
+        roots = [root for root, _, _ in indexer.walk_mounted(
+            'system', 'ds_user', bottom_up=True, max_workers=2)]
+        self.assertEqual(roots, ['ds_user/b', 'ds_user/a/c', 'ds_user/a', 'ds_user'])
+
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.ESFileManager')
+    def test_index_refreshes_pems(self, mock_mgr, mock_bulk):
+        indexer = self._indexer()
+        document = mock.MagicMock()
+        indexer._dedup_and_discover = mock.MagicMock(
+            return_value=([], [], {'file1.txt': document}))
+        mock_bulk.return_value.errors = []
+        indexer.index('system', 'ds_user', 'ds_user', levels=1,
+                      index_full_path=False, full_indexing=True,
+                      pems_indexing=True)
+        indexer.ag.files.listPermissions.assert_any_call(
+            systemId='system', filePath='ds_user/file1.txt')
+        _, kwargs = [c for c in mock_mgr.return_value.document_action.call_args_list
+                     if c[1]['document'] is document][0]
+        self.assertEqual(kwargs['pems'], indexer.ag.files.listPermissions.return_value)
+
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.ESFileManager')
+    def test_index_incremental(self, mock_mgr, mock_bulk):
+        indexer = self._indexer()
+        folder_a = mock.MagicMock()
+        folder_a.watermark.childCount = 2
+        folder_a.watermark.lastModified = datetime.datetime.fromtimestamp(
+            os.stat(os.path.join(self.base, 'ds_user', 'a')).st_mtime, tzutc())
+
+        def _dedup(system_id, username, root, files, folders):
+            if root == 'ds_user':
+                return [], [], {'a': folder_a}
+            return [], [], {}
+        indexer._dedup_and_discover = mock.MagicMock(side_effect=_dedup)
+        mock_bulk.return_value.errors = []
+        indexer.index('system', 'ds_user', 'ds_user', index_full_path=False,
+                      incremental=True)
+        roots = [c[0][2] for c in indexer._dedup_and_discover.call_args_list]
+        self.assertEqual(roots, ['ds_user', 'ds_user/b'])
+
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.mounted_indexer.ESFileManager')
+    def test_index(self, mock_mgr, mock_bulk):
+        indexer = self._indexer()
+        indexer._dedup_and_discover = mock.MagicMock(return_value=([], [], {}))
+        mock_mgr.return_value.document_action.side_effect = lambda fields, **kwargs: fields
+        mock_bulk.return_value.errors = []
+        indexed, deleted = indexer.index('system', 'ds_user', 'ds_user',
+                                         levels=1, index_full_path=False)
+        self.assertEqual((indexed, deleted), (3, 0))
+        actions = dict((c[0][0]['name'], c[0][0])
+                       for c in mock_bulk.return_value.add.call_args_list)
+        self.assertEqual(actions['a']['format'], 'folder')
+        self.assertEqual(actions['a']['mimeType'], 'text/directory')
+        self.assertEqual(actions['file1.txt']['path'], 'ds_user')
+        self.assertEqual(actions['file1.txt']['length'], 4)
+        self.assertEqual(actions['file1.txt']['type'], 'file')
+        self.assertTrue(mock_bulk.return_value.close.called)
+        self.assertFalse(indexer.ag.files.list.called)
+
+
+class MountedWatcherTestCase(TestCase):
+    """Tests for :class:`MountedWatcher` using a local temp tree"""
+
+    def setUp(self):
+        import tempfile
+        self.base = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.base, 'ds_user', 'a'))
+        with open(os.path.join(self.base, 'ds_user', 'file1.txt'), 'w') as _file:
+            _file.write('data')
+        patcher = mock.patch(
+            'designsafe.apps.data.managers.watcher.mounted_path',
+            return_value=self.base)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.data.managers.watcher.BulkIndexer')
+        self.mock_bulk = patcher.start()
+        self.mock_bulk.return_value.errors = []
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.data.managers.watcher.UsageRollup')
+        self.rollup = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch(
+            'designsafe.apps.data.managers.elasticsearch.FileManager.new_doc_ids',
+            return_value={'ds_user/file1.txt': 'doc_id'})
+        self.mock_new_doc_ids = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.base)
+
+    def _watcher(self):
+        from designsafe.apps.data.managers.watcher import MountedWatcher
+        watcher = MountedWatcher(systems=[settings.AGAVE_STORAGE_SYSTEM],
+                                 rescan=mock.MagicMock())
+        watcher._documents = mock.MagicMock(return_value=[])
+        watcher._children = mock.MagicMock(return_value=[])
+        return watcher
+
+    def _event(self, mask, *path):
+        return mock.MagicMock(mask=mask, pathname=os.path.join(self.base, *path))
+
+    def _actions(self):
+        return [c[0][0] for c in self.mock_bulk.return_value.add.call_args_list]
+
+    def test_resolve(self):
+        from designsafe.apps.data.managers.watcher import MountedWatcher
+        watcher = self._watcher()
+        self.assertEqual(watcher.resolve(os.path.join(self.base, 'ds_user', 'a')),
+                         (settings.AGAVE_STORAGE_SYSTEM, 'ds_user/a'))
+        self.assertEqual(watcher.resolve('/tmp/not/watched'), (None, None))
+        watcher = MountedWatcher(systems=[], all_projects=True, rescan=mock.MagicMock())
+        self.assertEqual(watcher.resolve(os.path.join(self.base, 'uuid', 'a')),
+                         ('project-uuid', 'a'))
+        self.assertRaises(ValueError, MountedWatcher, systems=['project-'])
+
+    @mock.patch('designsafe.apps.data.managers.watcher.ReindexQueue')
+    def test_rescan_skips_parents(self, mock_queue):
+        from designsafe.apps.data.managers.watcher import MountedWatcher
+        MountedWatcher.schedule_rescan(settings.AGAVE_STORAGE_SYSTEM, 'ds_user/a', 0)
+        mock_queue.return_value.request.assert_called_once_with(
+            settings.AGAVE_STORAGE_SYSTEM, 'ds_user/a', levels=0,
+            index_full_path=False)
+
+    def test_coalesced_upsert(self):
+        from designsafe.apps.data.managers import watcher as watcher_module
+        watcher = self._watcher()
+        watcher.process_event(self._event(watcher_module.IN_CREATE, 'ds_user', 'file1.txt'))
+        watcher.process_event(self._event(watcher_module.IN_CLOSE_WRITE, 'ds_user', 'file1.txt'))
+        self.assertEqual(watcher.flush(), (1, 0))
+        actions = self._actions()
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['_id'], 'doc_id')
+        self.mock_new_doc_ids.assert_called_once_with(
+            settings.AGAVE_STORAGE_SYSTEM, ['ds_user/file1.txt'])
+        source = actions[0]['upsert']
+        self.assertEqual(source['name'], 'file1.txt')
+        self.assertEqual(source['path'], 'ds_user')
+        self.assertEqual(source['length'], 4)
+        self.assertEqual(source['permissions'][0]['username'], 'ds_user')
+        self.rollup.record.assert_called_once_with(
+            settings.AGAVE_STORAGE_SYSTEM, 'ds_user/file1.txt', old=None, new=(4, 1))
+        self.assertTrue(self.rollup.flush.called)
+
+    def test_missing_file_is_deleted(self):
+        from designsafe.apps.data.managers import watcher as watcher_module
+        watcher = self._watcher()
+        document = mock.MagicMock(format='raw', length=10,
+                                  meta=mock.MagicMock(id='doc_id'))
+        watcher._documents.return_value = [document]
+        watcher.process_event(self._event(watcher_module.IN_CLOSE_WRITE, 'ds_user', 'gone.txt'))
+        self.assertEqual(watcher.flush(), (0, 1))
+        self.assertEqual(self._actions()[0]['_op_type'], 'delete')
+        self.assertFalse(watcher._children.called)
+        self.rollup.record.assert_called_once_with(
+            settings.AGAVE_STORAGE_SYSTEM, 'ds_user/gone.txt', old=(10, 1))
+
+    def test_new_folder_is_rescanned(self):
+        from designsafe.apps.data.managers import watcher as watcher_module
+        watcher = self._watcher()
+        watcher.process_event(self._event(
+            watcher_module.IN_MOVED_TO | watcher_module.IN_ISDIR, 'ds_user', 'a'))
+        watcher.flush()
+        watcher.rescan.assert_called_once_with(settings.AGAVE_STORAGE_SYSTEM, 'ds_user/a', 0)
+
+    def test_overflow_rescans_touched_folders(self):
+        from designsafe.apps.data.managers import watcher as watcher_module
+        watcher = self._watcher()
+        watcher.process_event(self._event(watcher_module.IN_DELETE, 'ds_user', 'a', 'x'))
+        watcher.process_event(mock.MagicMock(mask=watcher_module.IN_Q_OVERFLOW,
+                                             pathname=''))
+        watcher.flush()
+        watcher.rescan.assert_called_once_with(settings.AGAVE_STORAGE_SYSTEM, 'ds_user/a', 1)
+        self.assertEqual(watcher.stats['overflows'], 1)
+
+
+class ReindexQueueTestCase(TestCase):
+    """Tests for :class:`ReindexQueue`"""
+
+    def _queue(self, pending=None):
+        from designsafe.apps.data.managers.reindex_queue import ReindexQueue
+        client = mock.MagicMock()
+        self.pipe = mock.MagicMock()
+        self.pipe.zrange.return_value = [json.dumps(p) for p in pending or []]
+        client.transaction.side_effect = lambda func, *keys: func(self.pipe)
+        return ReindexQueue(client=client, quiet_period=5, max_delay=60)
+
+    def test_covers(self):
+        from designsafe.apps.data.managers.reindex_queue import covers
+        self.assertTrue(covers(('sys', 'a', 0), ('sys', 'a/b/c', 1)))
+        self.assertTrue(covers(('sys', 'a', 2), ('sys', 'a/b', 1)))
+        self.assertTrue(covers(('sys', '/', 0), ('sys', 'a', 0)))
+        self.assertFalse(covers(('sys', 'a', 1), ('sys', 'a/b', 1)))
+        self.assertFalse(covers(('sys', 'a', 2), ('sys', 'a/b', 0)))
+        self.assertFalse(covers(('sys', 'a', 0), ('sys', 'ab', 1)))
+        self.assertFalse(covers(('other', 'a', 0), ('sys', 'a', 1)))
+        self.assertTrue(covers(('sys', 'a', 0), ('sys', 'a/b', 1, False)))
+        self.assertFalse(covers(('sys', 'a', 0, False), ('sys', 'a/b', 1)))
+
+    def test_request_without_parents(self):
+        queue = self._queue(pending=[['sys', 'a', 0, False]])
+        queue.request('sys', 'a/b', levels=1)
+        self.pipe.zadd.assert_called_once_with(queue.PENDING_KEY, mock.ANY,
+                                               json.dumps(['sys', 'a/b', 1]))
+        self.assertFalse(self.pipe.zrem.called)
+
+    def test_request_collapsed_into_ancestor(self):
+        queue = self._queue(pending=[['sys', 'a', 0]])
+        queue.request('sys', 'a/b', levels=1)
+        self.pipe.zadd.assert_called_once_with(queue.PENDING_KEY, mock.ANY,
+                                               json.dumps(['sys', 'a', 0]))
+        self.pipe.hincrby.assert_called_once_with(queue.STATS_KEY, 'collapsed', 1)
+
+    def test_request_replaces_children(self):
+        queue = self._queue(pending=[['sys', 'a/b', 1], ['sys', 'c', 1]])
+        queue.request('sys', 'a', levels=0)
+        self.pipe.zrem.assert_called_once_with(queue.PENDING_KEY,
+                                               json.dumps(['sys', 'a/b', 1]))
+        self.pipe.zadd.assert_called_once_with(queue.PENDING_KEY, mock.ANY,
+                                               json.dumps(['sys', 'a', 0]))
+
+    @mock.patch('designsafe.apps.api.tasks.reindex_agave')
+    def test_dispatch(self, mock_reindex):
+        queue = self._queue()
+        queue.client.zrangebyscore.return_value = [json.dumps(['sys', 'a', 1])]
+        queue.client.hgetall.return_value = {}
+        queue.client.zrem.return_value = 1
+        self.assertEqual(queue.dispatch(), 1)
+        mock_reindex.apply_async.assert_called_once_with(
+            kwargs={'username': 'ds_admin', 'file_id': 'sys/a', 'levels': 1,
+                    'index_full_path': True},
+            queue='indexing')
+        queue.client.hincrby.assert_called_once_with(queue.STATS_KEY, 'dispatched', 1)
+
+    @mock.patch('designsafe.apps.api.tasks.reindex_agave')
+    def test_dispatch_already_claimed(self, mock_reindex):
+        queue = self._queue()
+        queue.client.zrangebyscore.return_value = [json.dumps(['sys', 'a', 1])]
+        queue.client.hgetall.return_value = {}
+        queue.client.zrem.return_value = 0
+        self.assertEqual(queue.dispatch(), 0)
+        self.assertFalse(mock_reindex.apply_async.called)
+
+
+class DocumentActionTestCase(TestCase):
+    """Tests for the bulk actions of file documents"""
+
+    def test_document_action_is_upsert(self):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        from designsafe.libs.elasticsearch.docs import file_doc_id
+        mgr = FileManager('ds_user')
+        fields = {'name': 'file.txt', 'path': 'ds_user/a', 'length': 4,
+                  'system': 'designsafe.storage.default'}
+        action = mgr.document_action(dict(fields))
+        self.assertEqual(action['_op_type'], 'update')
+        self.assertEqual(action['_id'], file_doc_id('designsafe.storage.default',
+                                                    'ds_user/a/file.txt'))
+        self.assertNotIn('permissions', action['doc'])
+        self.assertEqual(action['upsert']['permissions'][0]['username'], 'ds_user')
+        self.assertEqual(action, mgr.document_action(dict(fields)))
+        action = mgr.document_action(dict(fields), doc_id='moved_away')
+        self.assertEqual(action['_id'], 'moved_away')
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    @mock.patch('designsafe.apps.data.models.elasticsearch.IndexedFile.get')
+    def test_get_document_by_path(self, mock_get, mock_execute):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        moved_away = mock.Mock(path='ds_user/b')
+        moved_away.name = 'file.txt'
+        mock_get.return_value = moved_away
+        found = mock.Mock()
+        res = mock.MagicMock()
+        res.hits.total = 1
+        res.__getitem__.return_value = found
+        mock_execute.return_value = res
+
+        self.assertIs(FileManager.get_document('designsafe.storage.default',
+                                               'ds_user/a/file.txt'), found)
+        query = mock_execute.call_args[0][0].to_dict()['query']
+        self.assertIn({'term': {'path._exact': 'ds_user/a'}}, query['bool']['must'])
+
+        moved_away.path = 'ds_user/a'
+        self.assertIs(FileManager.get_document('designsafe.storage.default',
+                                               'ds_user/a/file.txt'), moved_away)
+        self.assertEqual(mock_execute.call_count, 1)
+
+    @override_settings(AGAVE_STORAGE_SYSTEM='designsafe.storage.default',
+                       ES_FILES_ROUTING=True)
+    def test_document_action_is_routed(self):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        action = FileManager('ds_user').document_action(
+            {'name': 'file.txt', 'path': 'ds_user/a', 'length': 4,
+             'system': 'designsafe.storage.default'})
+        self.assertEqual(action['_routing'], 'ds_user')
+
+    def test_document_action_flags_explicit_pems(self):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        mgr = FileManager('ds_user')
+        fields = {'name': 'file.txt', 'path': 'ds_user/a', 'length': 4,
+                  'system': 'designsafe.storage.default'}
+        pems = [{'username': 'ds_user', 'permission': {'read': True, 'write': True}}]
+        shared = pems + [{'username': 'other_user', 'permission': {'read': True}}]
+        action = mgr.document_action(dict(fields), pems=shared, parent_pems=pems)
+        self.assertTrue(action['doc']['explicitPems'])
+        self.assertTrue(action['upsert']['explicitPems'])
+        action = mgr.document_action(dict(fields), pems=pems, parent_pems=pems)
+        self.assertFalse(action['doc']['explicitPems'])
+        action = mgr.document_action(dict(fields), pems=shared)
+        self.assertNotIn('explicitPems', action['doc'])
+
+    def test_document_action_sets_size(self):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        mgr = FileManager('ds_user')
+        action = mgr.document_action({'name': 'file.txt', 'path': 'ds_user/a',
+                                      'length': 4, 'format': 'raw',
+                                      'system': 'designsafe.storage.default'})
+        self.assertEqual(action['doc']['size'], 4)
+        action = mgr.document_action({'name': 'a', 'path': 'ds_user',
+                                      'length': 4096, 'format': 'folder',
+                                      'system': 'designsafe.storage.default'})
+        self.assertNotIn('size', action['doc'])
+        self.assertEqual(action['upsert']['size'], 0)
+        self.assertEqual(action['upsert']['totalLength'], 0)
+
+    @mock.patch('elasticsearch_dsl.Search.execute', autospec=True)
+    def test_listing_sorted_by_size(self, mock_execute):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        _, search = FileManager('ds_user').listing(
+            'designsafe.storage.default', 'ds_user/a', sort='size',
+            offset=20, limit=10)
+        body = mock_execute.call_args[0][0].to_dict()
+        self.assertEqual(body['sort'], [{'size': {'order': 'desc', 'missing': '_last'}},
+                                        {'name._exact': 'asc'}])
+        self.assertEqual((body['from'], body['size']), (20, 10))
+
+
+class PathPrefixTasksTestCase(TestCase):
+    """Tests for the recursive move, copy and delete of file documents"""
+
+    @mock.patch('designsafe.apps.api.tasks.bump_generation_on_completion.apply_async')
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.delete_path_prefix')
+    def test_delete_descendants_bumps_on_completion(self, mock_delete, mock_bump):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        from designsafe.apps.data.models.elasticsearch import IndexedFile
+        mock_delete.return_value = ('node:1', 3)
+
+        self.assertEqual(FileManager.delete_descendants('sys', 'ds_user/a'),
+                         ('node:1', 3))
+        mock_bump.assert_called_once_with(
+            args=['node:1', IndexedFile._doc_type.index], queue='indexing')
+
+    @mock.patch('designsafe.libs.elasticsearch.cache.bump_generation')
+    @mock.patch('designsafe.libs.elasticsearch.docs.reroute_path_prefix')
+    @mock.patch('designsafe.libs.elasticsearch.docs.wait_for_task')
+    @mock.patch('elasticsearch_dsl.connections.connections.get_connection')
+    def test_update_path_prefix_task(self, mock_get_connection, mock_wait,
+                                     mock_reroute, mock_bump):
+        from designsafe.apps.api.tasks import update_path_prefix
+        client = mock_get_connection.return_value
+        client.update_by_query.return_value = {'task': 'node:1'}
+        mock_wait.side_effect = [{'total': 3, 'updated': 2, 'version_conflicts': 1},
+                                 {'total': 1, 'updated': 1, 'version_conflicts': 0}]
+
+        totals = update_path_prefix('des-files', 'system._exact', 'sys',
+                                    'ds_user/a', 'ds_user/b', routed=True)
+
+        self.assertEqual(totals, {'total': 3, 'updated': 3,
+                                  'version_conflicts': 0, 'rerouted': 0})
+        self.assertEqual(client.update_by_query.call_count, 2)
+        client.indices.refresh.assert_called_once_with(index='des-files')
+        self.assertFalse(mock_reroute.called)
+        mock_bump.assert_called_once_with('des-files')
+
+    @override_settings(AGAVE_STORAGE_SYSTEM='sys', ES_FILES_ROUTING=True)
+    @mock.patch('designsafe.libs.elasticsearch.cache.bump_generation')
+    @mock.patch('designsafe.libs.elasticsearch.docs.reroute_path_prefix')
+    @mock.patch('designsafe.libs.elasticsearch.docs.wait_for_task')
+    @mock.patch('elasticsearch_dsl.connections.connections.get_connection')
+    def test_update_path_prefix_task_reroutes(self, mock_get_connection, mock_wait,
+                                              mock_reroute, mock_bump):
+        from designsafe.apps.api.tasks import update_path_prefix
+        client = mock_get_connection.return_value
+        client.update_by_query.return_value = {'task': 'node:1'}
+        mock_wait.return_value = {'total': 2, 'updated': 2, 'version_conflicts': 0}
+        mock_reroute.return_value = 2
+
+        totals = update_path_prefix('des-files', 'system._exact', 'sys',
+                                    'ds_user/a', 'other_user/a', routed=True)
+
+        self.assertEqual(totals['rerouted'], 2)
+        mock_reroute.assert_called_once_with('des-files', 'system._exact', 'sys',
+                                             'other_user/a')
+
+    @override_settings(AGAVE_STORAGE_SYSTEM='designsafe.storage.default',
+                       ES_FILES_ROUTING=True)
+    @mock.patch('designsafe.libs.elasticsearch.cache.bump_generation')
+    @mock.patch('designsafe.libs.elasticsearch.docs.wait_for_task')
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_copy_path_prefix_task(self, mock_connections, mock_wait, mock_bump):
+        from designsafe.apps.api.tasks import copy_path_prefix
+        client = mock_connections.get_connection.return_value
+        client.count.return_value = {'count': 1}
+        client.reindex.return_value = {'task': 'node:2'}
+        mock_wait.return_value = {'total': 1, 'created': 1}
+
+        totals = copy_path_prefix('des-files', 'system._exact',
+                                  'designsafe.storage.default',
+                                  'ds_user/a', 'other_user/a_copy', routed=True)
+
+        self.assertEqual(totals, {'total': 1, 'created': 1})
+        self.assertEqual(client.reindex.call_count, 1)
+        params = client.reindex.call_args[1]['body']['script']['params']
+        self.assertTrue(params['routed'])
+        self.assertEqual(params['routing'], 'other_user')
+        self.assertFalse(client.bulk.called)
+        mock_bump.assert_called_once_with('des-files')
+
+    def test_indexer_skips_descendants_of_duplicates(self):
+        from designsafe.apps.data.managers.indexer import AgaveIndexer
+        mgr = mock.MagicMock()
+        mgr.delete_descendants.return_value = ('node:3', 5)
+        kept = mock.MagicMock(format='folder', path='ds_user', system='sys')
+        kept.name = 'folder'
+        duplicate = mock.MagicMock(format='folder', path='ds_user', system='sys')
+        duplicate.name = 'folder'
+
+        self.assertEqual(AgaveIndexer._delete_descendants(
+            mgr, duplicate, {'folder': kept}), 0)
+        self.assertEqual(AgaveIndexer._delete_descendants(
+            mgr, kept, {'folder': kept}), 5)
+        mgr.delete_descendants.assert_called_once_with('sys', 'ds_user/folder')
+
+
+@override_settings(AGAVE_STORAGE_SYSTEM='designsafe.storage.default')
+class UsageRollupTestCase(TestCase):
+    """Tests for :class:`~designsafe.apps.data.managers.usage.UsageRollup`"""
+
+    def test_usage_owner(self):
+        from designsafe.apps.data.managers.usage import usage_owner
+        self.assertEqual(usage_owner('designsafe.storage.default', 'ds_user/a/b.txt'),
+                         ('user', 'ds_user'))
+        self.assertEqual(usage_owner('project-1234', 'a/b.txt'), ('project', '1234'))
+        self.assertIsNone(usage_owner('designsafe.storage.community', 'a/b.txt'))
+
+    def test_record_accumulates_deltas(self):
+        from designsafe.apps.data.managers.usage import UsageRollup
+        rollup = UsageRollup()
+        system = 'designsafe.storage.default'
+        rollup.record(system, 'ds_user/new.txt', old=None, new=(100, 1))
+        rollup.record(system, 'ds_user/changed.txt', old=(50, 1), new=(80, 1))
+        rollup.record(system, 'ds_user/deleted.txt', old=(10, 1), new=None)
+        rollup.record(system, 'ds_user/folder', old=None, new=(0, 0))
+        self.assertEqual(rollup.deltas, {('user', 'ds_user'): [120, 0]})
+
+    @mock.patch('designsafe.apps.data.managers.usage.connections.get_connection')
+    def test_flush(self, mock_conn):
+        from designsafe.apps.data.managers.usage import UsageRollup
+        rollup = UsageRollup()
+        rollup.add('project-1234', 'a.txt', 100, 1)
+        rollup.flush()
+        kwargs = mock_conn.return_value.update.call_args[1]
+        self.assertEqual(kwargs['id'], 'project:1234')
+        self.assertEqual(kwargs['body']['script']['params']['bytes'], 100)
+        self.assertEqual(kwargs['body']['script']['params']['files'], 1)
+        self.assertEqual(rollup.deltas, {})
+
+    def test_record_folder_deltas(self):
+        from designsafe.apps.data.managers.usage import UsageRollup, ancestors
+        self.assertEqual(ancestors('ds_user/a/b.txt'), ['ds_user/a', 'ds_user'])
+        rollup = UsageRollup()
+        system = 'designsafe.storage.default'
+        rollup.record(system, 'ds_user/a/new.txt', old=None, new=(100, 1))
+        rollup.record(system, 'ds_user/a/b', old=None, new=(0, 0))
+        rollup.record(system, 'ds_user/deleted.txt', old=(10, 1), new=None)
+        self.assertEqual(rollup.folder_deltas, {
+            (system, 'ds_user/a'): [100, 2],
+            (system, 'ds_user'): [90, 1]
+        })
+
+    @mock.patch('designsafe.apps.data.managers.usage.bump_generation')
+    @mock.patch('designsafe.apps.data.managers.usage.connections.get_connection')
+    @mock.patch('designsafe.apps.data.managers.usage.bulk')
+    @mock.patch('designsafe.apps.data.managers.usage.Search.execute', autospec=True)
+    def test_flush_folders_by_path(self, mock_execute, mock_bulk, mock_conn, mock_bump):
+        from designsafe.apps.data.managers.usage import UsageRollup
+        system = 'designsafe.storage.default'
+        folder = mock.Mock(system=system, path='ds_user',
+                           meta=mock.Mock(id='moved_here', routing='ds_user'))
+        folder.name = 'a'
+        mock_execute.return_value = [folder]
+        mock_bulk.return_value = (1, [])
+        rollup = UsageRollup()
+        rollup.record(system, 'ds_user/a/new.txt', old=None, new=(100, 1))
+
+        rollup.flush()
+
+        query = mock_execute.call_args[0][0].to_dict()['query']
+        self.assertEqual(len(query['bool']['should']), 2)
+        actions = mock_bulk.call_args[0][1]
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['_id'], 'moved_here')
+        self.assertEqual(actions[0]['_routing'], 'ds_user')
+        self.assertEqual(actions[0]['script']['params'], {'bytes': 100, 'count': 1})
+        self.assertEqual(rollup.folder_deltas, {})
+
+    @override_settings(USAGE_ROLLUPS={'partitions': 2, 'partition_size': 100})
+    @mock.patch('designsafe.apps.data.managers.usage.connections.get_connection')
+    @mock.patch('designsafe.apps.data.managers.usage.bulk')
+    @mock.patch('designsafe.apps.data.managers.usage.Search.execute', autospec=True)
+    def test_reconcile(self, mock_execute, mock_bulk, mock_conn):
+        from designsafe.apps.data.managers.usage import UsageRollup, HOME_SCRIPT
+        from designsafe.apps.data.models.elasticsearch import IndexedUsage
+
+        def _res(*buckets):
+            res = mock.MagicMock()
+            res.aggregations.owners.buckets = [
+                mock.Mock(key=key, total_bytes=mock.Mock(value=total_bytes),
+                          doc_count=count) for key, total_bytes, count in buckets]
+            return res
+
+        mock_execute.side_effect = [
+            _res(('ds_user', 100.0, 2)), _res(('other_user', None, 1)),
+            _res(('project-1234', 50.0, 1)), _res()]
+        actions = []
+
+        def _bulk(client, docs, **kwargs):
+            actions.extend(docs)
+            return len(actions), []
+        mock_bulk.side_effect = _bulk
+
+        self.assertEqual(UsageRollup().reconcile(), 3)
+
+        searches = [c[0][0].to_dict() for c in mock_execute.call_args_list]
+        self.assertEqual(len(searches), 4)
+        homes = searches[0]['aggs']['owners']['terms']
+        self.assertEqual(homes['script']['inline'], HOME_SCRIPT)
+        self.assertEqual(homes['size'], 100)
+        self.assertEqual(homes['include'], {'partition': 0, 'num_partitions': 2})
+        self.assertEqual(searches[1]['aggs']['owners']['terms']['include'],
+                         {'partition': 1, 'num_partitions': 2})
+        self.assertEqual(searches[2]['aggs']['owners']['terms']['field'],
+                         'system._exact')
+        self.assertEqual([(a['_id'], a['_source']['totalBytes'], a['_source']['fileCount'])
+                          for a in actions],
+                         [('user:ds_user', 100, 2), ('user:other_user', 0, 1),
+                          ('project:1234', 50, 1)])
+        kwargs = mock_conn.return_value.delete_by_query.call_args[1]
+        self.assertEqual(kwargs['index'], IndexedUsage._doc_type.index)
+        self.assertIn('reconciled', kwargs['body']['query']['bool']['filter'][0]['range'])
+
+    @mock.patch('designsafe.apps.data.managers.usage.connections.get_connection')
+    @mock.patch('designsafe.apps.data.managers.usage.BulkIndexer')
+    @mock.patch('designsafe.apps.data.managers.usage.scan')
+    def test_repair_folders(self, mock_scan, mock_bulk, mock_conn):
+        from designsafe.apps.data.managers.usage import UsageRollup
+
+        def _hit(doc_id, path, name, fmt='raw', **source):
+            source.update(path=path, name=name, format=fmt)
+            return {'_index': 'des-files', '_type': 'file', '_id': doc_id,
+                    '_source': source}
+
+        mock_scan.side_effect = [
+            [_hit('1', '/', 'ds_user', 'folder', totalLength=0, descendantCount=0),
+             _hit('2', '/', 'top.txt', length=8, size=8),
+             _hit('3', '/', 'other', 'folder', totalLength=5,
+                  descendantCount=1, size=5)],
+            [_hit('4', 'ds_user', 'a', 'folder', totalLength=10,
+                  descendantCount=2, size=10),
+             _hit('5', 'ds_user/a', 'b.txt', length=10, size=10),
+             _hit('6', 'ds_user/a', 'c.txt', length=4)],
+            [_hit('7', 'other', 'd.txt', length=5, size=5)]]
+        bulk_indexer = mock_bulk.return_value.__enter__.return_value
+
+        self.assertEqual(UsageRollup().repair_folders('designsafe.storage.default'), 3)
+
+        queries = [c[1]['query']['query'] for c in mock_scan.call_args_list]
+        self.assertEqual(queries[0]['bool']['filter'][1], {'term': {'path._exact': '/'}})
+        self.assertEqual(queries[1]['bool']['filter'][1], {'term': {'path._path': 'ds_user'}})
+        self.assertEqual(queries[2]['bool']['filter'][1], {'term': {'path._path': 'other'}})
+        actions = dict((c[0][0]['_id'], c[0][0]['doc'])
+                       for c in bulk_indexer.add.call_args_list)
+        self.assertEqual(actions, {
+            '1': {'totalLength': 14, 'descendantCount': 3, 'size': 14},
+            '4': {'totalLength': 14, 'descendantCount': 2, 'size': 14},
+            '6': {'size': 4}
+        })
+
+    @mock.patch('designsafe.apps.data.managers.usage.UsageRollup.subtree_usage')
+    def test_record_move(self, mock_subtree_usage):
+        from designsafe.apps.data.managers.usage import UsageRollup
+        mock_subtree_usage.return_value = (100, 2, 3)
+        rollup = UsageRollup()
+        system = 'designsafe.storage.default'
+        folder = mock.Mock(format='folder', length=0)
+        rollup.record_move(system, 'ds_user/a/b', 'ds_user/c/b', folder)
+        mock_subtree_usage.assert_called_once_with(system, 'ds_user/a/b')
+        self.assertEqual(rollup.folder_deltas, {
+            (system, 'ds_user/a'): [-100, -4],
+            (system, 'ds_user/c'): [100, 4],
+            (system, 'ds_user'): [0, 0]
+        })
+        self.assertEqual(rollup.deltas, {('user', 'ds_user'): [0, 0]})
+
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.bump_generation')
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.UsageRollup')
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.IndexedFile')
+    def test_file_manager_move_records_usage(self, mock_indexed_file, mock_rollup,
+                                             mock_bump):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        document = mock.MagicMock(format='raw')
+        document.meta.routing = None
+        mgr = FileManager('ds_admin')
+        mgr.get_document = mock.MagicMock(return_value=document)
+
+        self.assertIsNone(mgr.move('designsafe.storage.default', '/ds_user/a/file.txt',
+                                   '/ds_user/b/file.txt'))
+
+        rollup = mock_rollup.return_value
+        rollup.record_move.assert_called_once_with(
+            'designsafe.storage.default', 'ds_user/a/file.txt',
+            'ds_user/b/file.txt', document)
+        self.assertTrue(rollup.flush.called)
+        document.update.assert_called_once_with(path='ds_user/b', name='file.txt')
+        self.assertFalse(document.delete.called)
+        self.assertFalse(mock_indexed_file.return_value.save.called)
+
+    @override_settings(ES_FILES_ROUTING=True)
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.UsageRollup')
+    @mock.patch('designsafe.apps.data.managers.elasticsearch.IndexedFile')
+    def test_file_manager_move_reroutes(self, mock_indexed_file, mock_rollup):
+        from designsafe.apps.data.managers.elasticsearch import FileManager
+        document = mock.MagicMock(format='raw')
+        document.meta.id = 'doc_id'
+        document.meta.routing = 'ds_user'
+        document.to_dict.return_value = {'name': 'file.txt', 'path': 'ds_user/a'}
+        mgr = FileManager('ds_admin')
+        mgr.get_document = mock.MagicMock(return_value=document)
+
+        mgr.move('designsafe.storage.default', 'ds_user/a/file.txt',
+                 'other_user/file.txt')
+
+        mock_indexed_file.assert_called_once_with(name='file.txt', path='other_user')
+        moved = mock_indexed_file.return_value
+        self.assertEqual(moved.meta.id, 'doc_id')
+        document.delete.assert_called_once_with(ignore=404)
+        moved.save.assert_called_once_with()
+        self.assertFalse(document.update.called)
@@ -0,0 +1 @@
+default_app_config = 'designsafe.apps.search.apps.DesignSafeSearchConfig'
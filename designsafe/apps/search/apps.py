@@ -3,4 +3,8 @@ from django.apps import AppConfig
 class DesignSafeSearchConfig(AppConfig):
     name = 'designsafe.apps.search'
     label = 'designsafe_search'
-    verbose_name = 'DesignSafe Search'
\ No newline at end of file
+    verbose_name = 'DesignSafe Search'
+
+    def ready(self):
+        from designsafe.apps.search.receivers import (index_published_page,
+                                                      index_unpublished_page)
@@ -0,0 +1,23 @@
+from django.dispatch import receiver
+from django.db import transaction
+from cms.models import Page
+from cms.signals import post_publish, post_unpublish
+from designsafe.apps.search.tasks import update_page_index
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _schedule_page_index(page, language):
+    page_id = page.pk
+    transaction.on_commit(
+        lambda: update_page_index.apply_async(args=(page_id, language)))
+
+@receiver(post_publish, sender=Page, dispatch_uid='search_page_published')
+def index_published_page(sender, instance, language, **kwargs):
+    logger.debug('Indexing published page %s (%s)', instance.pk, language)
+    _schedule_page_index(instance, language)
+
+@receiver(post_unpublish, sender=Page, dispatch_uid='search_page_unpublished')
+def index_unpublished_page(sender, instance, language, **kwargs):
+    logger.debug('Indexing unpublished page %s (%s)', instance.pk, language)
+    _schedule_page_index(instance, language)
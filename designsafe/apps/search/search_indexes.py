@@ -27,6 +27,17 @@ def _strip_tags(value):
     return re.sub(r'<[^>]*?>', ' ', force_unicode(value))
 
 
+def changed_watermark(page):
+    """
+    Returns the page's `changed_date` as a naive UTC datetime, the way
+    it is read back from the index.
+    """
+    changed_date = page.changed_date
+    if timezone.is_aware(changed_date):
+        changed_date = timezone.make_naive(changed_date, timezone.utc)
+    return changed_date.replace(microsecond=0)
+
+
 class TextPluginIndex(indexes.SearchIndex, indexes.Indexable):
     text = indexes.CharField(document=True)
     body = indexes.CharField()
@@ -35,6 +46,7 @@ class TextPluginIndex(indexes.SearchIndex, indexes.Indexable):
     slug = indexes.CharField()
     page_id = indexes.IntegerField()
     title = indexes.CharField()
+    changed_date = indexes.DateTimeField(null=True)
 
     def get_model(self):
         return Title
@@ -77,6 +89,7 @@ class TextPluginIndex(indexes.SearchIndex, indexes.Indexable):
         self.prepared_data["slug"] = obj.slug
         self.prepared_data["url"] = "https://" + obj.page.site.domain + '/' + obj.path
         self.prepared_data["title"] = obj.title
+        self.prepared_data["changed_date"] = changed_watermark(page)
 
         # self.prepared_data['language'] = self._language
         return self.prepared_data
@@ -3,11 +3,81 @@ import datetime
 import logging
 from django.core.management import call_command
 from django.conf import settings
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+from haystack.query import SearchQuerySet
+from cms.models import Title
+from designsafe.apps.search.search_indexes import changed_watermark
 
 logger = logging.getLogger(__name__)
 
+def _title_index():
+    return connections[DEFAULT_ALIAS].get_unified_index().get_index(Title)
+
 @shared_task()
 def update_search_index():
+    """Rebuilds the whole CMS search index.
+
+    Not scheduled anymore, published pages are indexed by
+    :func:`update_page_index` and :func:`sweep_search_index`.
+    """
     logger.info("Updating search index")
     if not settings.DEBUG:
         call_command("rebuild_index", interactive=False)
+
+@shared_task(bind=True, max_retries=3)
+def update_page_index(self, page_id, language=None):
+    """Indexes the titles of a page after it is published or unpublished.
+
+    Titles of the page's public version which are searchable are
+    re-indexed, every other title of the page is removed from the index.
+
+    :param int page_id: id of the draft or public page
+    :param str language: language published, every language if `None`
+    """
+    index = _title_index()
+    titles = Title.objects.filter(page_id=page_id) | \
+             Title.objects.filter(page__publisher_public_id=page_id)
+    if language is not None:
+        titles = titles.filter(language=language)
+    searchable = set(index.index_queryset().filter(
+        pk__in=titles.values_list('pk', flat=True)).values_list('pk', flat=True))
+    try:
+        for title in titles.select_related('page'):
+            if title.pk in searchable:
+                index.update_object(title, using=DEFAULT_ALIAS)
+            else:
+                index.remove_object(title, using=DEFAULT_ALIAS)
+    except Exception as exc: #pylint: disable=broad-except
+        logger.warning('Could not index page %s', page_id, exc_info=True)
+        raise self.retry(exc=exc, countdown=60)
+
+@shared_task()
+def sweep_search_index():
+    """Makes the CMS search index consistent with the published pages.
+
+    The `changed_date` of every indexed title is compared with its page's
+    `changed_date`. Titles changed after they were indexed, or not indexed
+    at all, are re-indexed and indexed titles which are not searchable
+    anymore are removed.
+    """
+    index = _title_index()
+    indexed = dict(
+        (int(django_id), changed_date) for django_id, changed_date in
+        SearchQuerySet(using=DEFAULT_ALIAS).models(Title)
+        .values_list('django_id', 'changed_date'))
+
+    updated = 0
+    for title in index.index_queryset().select_related('page').iterator():
+        watermark = indexed.pop(title.pk, None)
+        if watermark is not None and watermark >= changed_watermark(title.page):
+            continue
+        index.update_object(title, using=DEFAULT_ALIAS)
+        updated += 1
+
+    for title_id in indexed:
+        index.remove_object('cms.title.{}'.format(title_id), using=DEFAULT_ALIAS)
+
+    logger.info('CMS search index sweep: %d updated, %d removed',
+                updated, len(indexed))
+    return {'updated': updated, 'removed': len(indexed)}
@@ -1,3 +1,112 @@
 from django.test import TestCase
+from haystack.constants import DEFAULT_ALIAS
+from cms.models import Page
+from cms.signals import post_publish, post_unpublish
+import datetime
+import mock
 
-# Create your tests here.
+
+class PageIndexReceiversTestCase(TestCase):
+    """Tests for the receivers indexing CMS pages on publish and unpublish"""
+
+    def setUp(self):
+        patcher = mock.patch('designsafe.apps.search.receivers.transaction.on_commit',
+                             side_effect=lambda func: func())
+        self.mock_on_commit = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.search.tasks.update_page_index.apply_async')
+        self.mock_apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_publish_queues_page_index(self):
+        from designsafe.apps.search.receivers import index_published_page
+        self.assertIn(index_published_page, post_publish._live_receivers(Page))
+
+        index_published_page(sender=Page, instance=mock.Mock(pk=12), language='en')
+
+        self.assertEqual(self.mock_on_commit.call_count, 1)
+        self.mock_apply_async.assert_called_once_with(args=(12, 'en'))
+
+    def test_unpublish_queues_page_index(self):
+        from designsafe.apps.search.receivers import index_unpublished_page
+        self.assertIn(index_unpublished_page, post_unpublish._live_receivers(Page))
+
+        index_unpublished_page(sender=Page, instance=mock.Mock(pk=12), language='en')
+
+        self.mock_apply_async.assert_called_once_with(args=(12, 'en'))
+
+
+class UpdatePageIndexTestCase(TestCase):
+    """Tests for :func:`~designsafe.apps.search.tasks.update_page_index`"""
+
+    def setUp(self):
+        patcher = mock.patch('designsafe.apps.search.tasks._title_index')
+        self.index = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('designsafe.apps.search.tasks.Title')
+        mock_title = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.titles = mock.MagicMock()
+        self.titles.filter.return_value = self.titles
+        mock_title.objects.filter.return_value.__or__.return_value = self.titles
+
+    def _searchable(self, *pks):
+        self.index.index_queryset.return_value.filter.return_value\
+            .values_list.return_value = list(pks)
+
+    def test_unpublished_page_is_removed(self):
+        from designsafe.apps.search.tasks import update_page_index
+        title = mock.Mock(pk=3)
+        self.titles.select_related.return_value = [title]
+        self._searchable()
+
+        update_page_index(12, 'en')
+
+        self.titles.filter.assert_called_once_with(language='en')
+        self.index.remove_object.assert_called_once_with(title, using=DEFAULT_ALIAS)
+        self.index.update_object.assert_not_called()
+
+    def test_published_page_is_updated(self):
+        from designsafe.apps.search.tasks import update_page_index
+        draft, public = mock.Mock(pk=3), mock.Mock(pk=4)
+        self.titles.select_related.return_value = [draft, public]
+        self._searchable(4)
+
+        update_page_index(12, 'en')
+
+        self.index.update_object.assert_called_once_with(public, using=DEFAULT_ALIAS)
+        self.index.remove_object.assert_called_once_with(draft, using=DEFAULT_ALIAS)
+
+
+class SweepSearchIndexTestCase(TestCase):
+    """Tests for :func:`~designsafe.apps.search.tasks.sweep_search_index`"""
+
+    @staticmethod
+    def _title(pk, changed_date):
+        return mock.Mock(pk=pk, page=mock.Mock(changed_date=changed_date))
+
+    @mock.patch('designsafe.apps.search.tasks.SearchQuerySet')
+    @mock.patch('designsafe.apps.search.tasks._title_index')
+    def test_only_pages_changed_after_watermark(self, mock_title_index, mock_sqs):
+        from designsafe.apps.search.tasks import sweep_search_index
+        watermark = datetime.datetime(2017, 6, 1, 12, 0, 0)
+        before = watermark - datetime.timedelta(days=1)
+        after = watermark + datetime.timedelta(seconds=1)
+        mock_sqs.return_value.models.return_value.values_list.return_value = [
+            ('1', watermark), ('2', watermark), ('3', watermark), ('5', watermark)]
+        index = mock_title_index.return_value
+        changed = self._title(1, after)
+        unchanged = self._title(2, before)
+        same = self._title(3, watermark.replace(microsecond=500))
+        missing = self._title(4, before)
+        index.index_queryset.return_value.select_related.return_value\
+            .iterator.return_value = iter([changed, unchanged, same, missing])
+
+        result = sweep_search_index()
+
+        self.assertEqual(result, {'updated': 2, 'removed': 1})
+        self.assertEqual(index.update_object.call_args_list,
+                         [mock.call(changed, using=DEFAULT_ALIAS),
+                          mock.call(missing, using=DEFAULT_ALIAS)])
+        index.remove_object.assert_called_once_with('cms.title.5',
+                                                    using=DEFAULT_ALIAS)
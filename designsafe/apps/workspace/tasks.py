@@ -290,7 +290,8 @@ def handle_webhook_request(job):
                         logger.debug('Preparing to Index Job Output job=%s', job_name)
                         # index_job_outputs(user, job)
                         archivePath = '/'.join([job['archiveSystem'], job['archivePath']])
-                        reindex_agave.delay(username, archivePath, levels=0)
+                        reindex_agave.delay(username, archivePath, levels=0,
+                                            incremental=True)
                         logger.debug('Finished Indexing Job Output job=%s', job_name)
                     except Exception as e:
                         logger.exception('Error indexing job output')
@@ -353,4 +354,5 @@ def index_job_outputs(user, job):
     mgr = AgaveFileManager(user)
     mgr.indexer.index(system_id, archive_path, user.username,
                       full_indexing = True, pems_indexing = True,
-                      index_full_path = True)
+                      index_full_path = True, bulk = True,
+                      concurrent_walk = True, incremental = True)
@@ -3,6 +3,7 @@ import logging
 import os
 
 from celery import Celery
+from datetime import timedelta
 from celery.schedules import crontab
 
 logger = logging.getLogger(__name__)
@@ -23,13 +24,25 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 app.conf.update(
     CELERYBEAT_SCHEDULE = {
-        'update_user_storages': {
-            'task': 'designsafe.apps.search.tasks.update_search_index',
-            'schedule': crontab(minute="*/15"),
+        'sweep_search_index': {
+            'task': 'designsafe.apps.search.tasks.sweep_search_index',
+            'schedule': crontab(hour=3, minute=0),
         },
         'reindex_projects': {
             'task': 'designsafe.apps.api.tasks.reindex_projects',
             'schedule': crontab(hour="*/24")
+        },
+        'reconcile_usage': {
+            'task': 'designsafe.apps.api.tasks.reconcile_usage',
+            'schedule': crontab(hour=2, minute=0)
+        },
+        'repair_folder_rollups': {
+            'task': 'designsafe.apps.api.tasks.repair_folder_rollups',
+            'schedule': crontab(day_of_week=0, hour=4, minute=0)
+        },
+        'dispatch_reindex_queue': {
+            'task': 'designsafe.apps.api.tasks.dispatch_reindex_queue',
+            'schedule': timedelta(seconds=settings.REINDEX_QUEUE['quiet_period'])
         }
     }
 )
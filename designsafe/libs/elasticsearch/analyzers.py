@@ -12,3 +12,22 @@ logger = logging.getLogger(__name__)
 
 path_analyzer = analyzer('path_analyzer',
                          tokenizer=tokenizer('path_hierarchy'))
+
+#: Length of the shortest and longest n-grams indexed by :data:`ngram_analyzer`
+NGRAM_MIN = 3
+NGRAM_MAX = 20
+
+#: Indexes every substring of a value between :data:`NGRAM_MIN` and
+#: :data:`NGRAM_MAX` characters long, lowercased. Used for substring search
+#: instead of `*term*` wildcards.
+ngram_analyzer = analyzer('ngram_analyzer',
+                          tokenizer=tokenizer('ngram_tokenizer', 'ngram',
+                                              min_gram=NGRAM_MIN,
+                                              max_gram=NGRAM_MAX),
+                          filter=['lowercase'])
+
+#: Search analyzer for :data:`ngram_analyzer` fields. The searched term is
+#: looked up as a single n-gram.
+ngram_search_analyzer = analyzer('ngram_search_analyzer',
+                                 tokenizer='keyword',
+                                 filter=['lowercase'])
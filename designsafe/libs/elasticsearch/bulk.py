@@ -0,0 +1,105 @@
+"""
+.. module: designsafe.libs.elasticsearch.bulk
+   :synopsis: Buffered writer for Elasticsearch's bulk API.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+import time
+from django.conf import settings
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl.connections import connections
+from designsafe.libs.elasticsearch.cache import bump_generation
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+class BulkIndexer(object):
+    """Buffers bulk actions and sends them to ES in chunks.
+
+    Actions are plain bulk action dicts, e.g. the result of
+    ``doc.to_dict(include_meta=True)`` or
+    ``{'_op_type': 'delete', '_index': ..., '_type': ..., '_id': ...}``.
+    The buffer is flushed through :func:`elasticsearch.helpers.streaming_bulk`
+    every time it reaches ``chunk_size`` actions or when ``flush_interval``
+    seconds have passed since the last flush.
+
+    Per-item failures do not raise. They are logged and collected in
+    :attr:`errors` so the caller can report them back.
+
+    Defaults are read from ``settings.ES_BULK_INDEXING``.
+
+    :param int chunk_size: number of actions sent on every bulk request.
+    :param int flush_interval: max number of seconds to keep actions buffered.
+    :param refresh: refresh policy for every bulk request.
+        ``False``, ``True`` or ``'wait_for'``.
+    :param str using: connection alias to use.
+
+    >>> with BulkIndexer(chunk_size=200) as bulk:
+    ...     for doc in docs:
+    ...         bulk.add(doc.to_dict(include_meta=True))
+    >>> bulk.success, bulk.errors
+    """
+    def __init__(self, chunk_size=None, flush_interval=None, refresh=None,
+                 using='default'):
+        config = getattr(settings, 'ES_BULK_INDEXING', {})
+        self.chunk_size = chunk_size or config.get('chunk_size', 500)
+        if flush_interval is None:
+            flush_interval = config.get('flush_interval', 0)
+        self.flush_interval = flush_interval
+        if refresh is None:
+            refresh = config.get('refresh', False)
+        self.refresh = refresh
+        self.using = using
+        self.success = 0
+        self.errors = []
+        self._actions = []
+        self._last_flush = time.time()
+
+    def add(self, action):
+        """Adds an action to the buffer, flushing it if necessary."""
+        self._actions.append(action)
+        if len(self._actions) >= self.chunk_size:
+            self.flush()
+        elif self.flush_interval and \
+             time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends every buffered action to ES.
+
+        :returns: number of actions sent
+        :rtype: int
+        """
+        actions, self._actions = self._actions, []
+        self._last_flush = time.time()
+        if not actions:
+            return 0
+
+        kwargs = {}
+        if self.refresh:
+            kwargs['refresh'] = self.refresh
+        client = connections.get_connection(self.using)
+        for ok, item in streaming_bulk(client, actions,
+                                       chunk_size=self.chunk_size,
+                                       raise_on_error=False,
+                                       raise_on_exception=False,
+                                       **kwargs):
+            if ok:
+                self.success += 1
+            else:
+                logger.warning('Bulk action failed: %s', item)
+                self.errors.append(item)
+        bump_generation(*set(action['_index'] for action in actions
+                             if '_index' in action))
+        return len(actions)
+
+    def close(self):
+        """Flushes any remaining actions."""
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
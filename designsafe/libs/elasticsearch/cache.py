@@ -0,0 +1,210 @@
+"""
+.. module: designsafe.libs.elasticsearch.cache
+   :synopsis: Short lived cache of search responses.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+import hashlib
+import json
+import time
+import six
+from django.conf import settings
+from django.core.cache import caches
+from elasticsearch_dsl import MultiSearch
+from elasticsearch_dsl.connections import connections
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+GENERATION_KEY = 'es:generation:{}'
+STATS_KEY = 'es:cache:{}:{}'
+
+
+def _config():
+    return getattr(settings, 'ES_SEARCH_CACHE', {})
+
+
+def _cache():
+    return caches[_config().get('cache', 'default')]
+
+
+def generation_name(index):
+    """Returns the name used for an index's generation counter.
+
+    Indices and aliases configured in ``settings.ES_INDICES`` share the
+    counter of their ``ES_INDICES`` key, e.g. `des-files_a` and `des-files`
+    both use `files`. Any other index uses its own name.
+    """
+    for key, config in six.iteritems(getattr(settings, 'ES_INDICES', {})):
+        aliases = [alias if isinstance(alias, six.string_types) else alias['name']
+                   for alias in config.get('alias', [])]
+        if index == config['name'] or index in aliases:
+            return key
+    return index
+
+
+def _index_names(indices):
+    names = set()
+    for index in indices or []:
+        for name in index.split(','):
+            names.add(generation_name(name.strip()))
+    return sorted(names)
+
+
+def generation(index):
+    """Returns the current generation of an index.
+
+    Counters start at the current time in milliseconds so a counter
+    evicted from the cache never comes back with a value already used.
+    """
+    cache = _cache()
+    key = GENERATION_KEY.format(generation_name(index))
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, int(time.time() * 1000), None)
+        value = cache.get(key)
+    return value
+
+
+def bump_generation(*indices):
+    """Invalidates every cached response of the given indices.
+
+    Called every time documents are written to an index. Background
+    `_by_query` and `_reindex` tasks bump it when they are sent and
+    again when they complete, see
+    :func:`~designsafe.libs.elasticsearch.docs.wait_for_task`.
+
+    :param indices: index or alias names
+    """
+    cache = _cache()
+    for name in _index_names(indices):
+        key = GENERATION_KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), None)
+        except Exception: #pylint: disable=broad-except
+            logger.warning('Could not bump generation of %s', name, exc_info=True)
+
+
+class SearchCache(object):
+    """Caches search responses for a few seconds.
+
+    Responses are cached under a fingerprint of the search's indices,
+    doc types, body and parameters, the permission scope of the request
+    (e.g. the username, `None` for public data) and the current generation
+    of every index searched. Writing to an index bumps its generation (see
+    :func:`bump_generation`) so stale responses are never read again and
+    expire on their own.
+
+    Hits and misses are counted per `endpoint`, see :meth:`stats`.
+
+    Defaults are read from ``settings.ES_SEARCH_CACHE``.
+
+    :param str endpoint: name used for the statistics, e.g. `'search'`
+    :param int timeout: seconds to keep a response
+
+    >>> cache = SearchCache('public_listing')
+    >>> res = cache.execute(search[0:100], scope=None)
+    """
+    def __init__(self, endpoint, timeout=None):
+        config = _config()
+        self.endpoint = endpoint
+        self.enabled = config.get('enabled', True)
+        self.timeout = timeout or config.get('timeout', 30)
+        self.cache = _cache()
+
+    def key(self, search, scope=None):
+        """Returns the cache key of a search"""
+        indices = _index_names(search._index)
+        fingerprint = json.dumps({
+            'index': sorted(search._index or []),
+            'doc_type': sorted(str(doc_type) for doc_type in search._doc_type),
+            'body': search.to_dict(),
+            'params': search._params,
+            'scope': scope,
+            'generations': [generation(name) for name in indices]
+        }, sort_keys=True, default=str)
+        return 'es:search:{}'.format(hashlib.sha1(fingerprint.encode('utf-8')).hexdigest())
+
+    def _count(self, counter, value=1):
+        if not value:
+            return
+        key = STATS_KEY.format(self.endpoint, counter)
+        try:
+            self.cache.incr(key, value)
+        except ValueError:
+            self.cache.add(key, value, None)
+        except Exception: #pylint: disable=broad-except
+            logger.debug('Could not count cache %s', counter, exc_info=True)
+
+    def execute(self, search, scope=None):
+        """Executes a search, using the cached response when there is one.
+
+        :param search: :class:`elasticsearch_dsl.Search` instance
+        :param scope: permission scope of the search, e.g. a username
+
+        :returns: :class:`elasticsearch_dsl.response.Response`
+        """
+        if not self.enabled:
+            return search.execute()
+
+        key = self.key(search, scope)
+        raw = self.cache.get(key)
+        if raw is None:
+            self._count('misses')
+            client = connections.get_connection(search._using)
+            raw = client.search(index=search._index, doc_type=search._doc_type,
+                                body=search.to_dict(), **search._params)
+            self.cache.set(key, raw, self.timeout)
+        else:
+            self._count('hits')
+        return search._response_class(search, raw)
+
+    def execute_many(self, searches, scope=None):
+        """Executes several searches, sending the ones not cached in
+        one `_msearch` request.
+
+        :param list searches: :class:`elasticsearch_dsl.Search` instances
+        :param scope: permission scope of the searches, or a list with
+            the scope of every search
+
+        :returns: a list of responses in the same order as `searches`
+        """
+        if not self.enabled:
+            msearch = MultiSearch()
+            for search in searches:
+                msearch = msearch.add(search)
+            return list(msearch.execute()) if searches else []
+
+        scopes = scope if isinstance(scope, list) else [scope] * len(searches)
+        keys = [self.key(search, _scope) for search, _scope in zip(searches, scopes)]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        self._count('hits', len(keys) - len(missing))
+        self._count('misses', len(missing))
+        if missing:
+            msearch = MultiSearch()
+            for i in missing:
+                msearch = msearch.add(searches[i])
+            responses = msearch.execute()
+            for i, res in zip(missing, responses):
+                cached[keys[i]] = res.to_dict()
+            self.cache.set_many(dict((keys[i], cached[keys[i]]) for i in missing),
+                                self.timeout)
+        return [search._response_class(search, cached[key])
+                for search, key in zip(searches, keys)]
+
+    def stats(self):
+        """Returns the hit and miss counters of this endpoint.
+
+        :rtype: dict
+        """
+        counters = self.cache.get_many([STATS_KEY.format(self.endpoint, counter)
+                                        for counter in ('hits', 'misses')])
+        return {
+            'endpoint': self.endpoint,
+            'hits': counters.get(STATS_KEY.format(self.endpoint, 'hits'), 0),
+            'misses': counters.get(STATS_KEY.format(self.endpoint, 'misses'), 0)
+        }
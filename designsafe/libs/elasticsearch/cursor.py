@@ -0,0 +1,74 @@
+"""
+.. module: designsafe.libs.elasticsearch.cursor
+   :synopsis: `search_after` pagination with opaque cursors.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+import base64
+import json
+import six
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+
+def encode_cursor(sort_values):
+    """Returns an opaque cursor pointing after a hit.
+
+    :param list sort_values: `sort` values of the last hit of a page
+
+    :rtype: str
+    """
+    raw = json.dumps(list(sort_values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the `search_after` values of a cursor.
+
+    :param str cursor: cursor returned by :func:`encode_cursor`
+
+    :raises ValueError: if the cursor is not valid
+    :rtype: list
+    """
+    if isinstance(cursor, six.text_type):
+        cursor = cursor.encode('ascii')
+    cursor += b'=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def paginate(search, sort, limit, cursor=None):
+    """Returns one page of a search.
+
+    Pages are read with `search_after` so reading deep into a result set
+    costs the same as reading the first page and is not limited by
+    `index.max_result_window`. The last sort key must be unique, e.g.
+    `_uid`, for pages not to skip or repeat hits.
+
+    :param search: :class:`elasticsearch_dsl.Search` instance
+    :param list sort: sort keys, e.g. `['name._exact', '_uid']`
+    :param int limit: page size
+    :param str cursor: cursor of the previous page, `None` for the first one
+
+    :returns: `(search, next_cursor)` the search to execute and a function
+        taking the search's response and returning the cursor of the next
+        page, or `None` when there are no more pages.
+    :raises ValueError: if `cursor` is not valid
+    """
+    search = search.sort(*sort).extra(size=limit)
+    if cursor:
+        search = search.extra(search_after=decode_cursor(cursor))
+
+    def _next_cursor(res):
+        if not limit or len(res.hits) < limit:
+            return None
+        return encode_cursor(list(res.hits[-1].meta.sort))
+
+    return search, _next_cursor
@@ -6,10 +6,16 @@ from __future__ import unicode_literals, absolute_import
 from future.utils import python_2_unicode_compatible
 import logging
 import json
+import hashlib
+import os
+import time
 from django.conf import settings
 from elasticsearch_dsl.connections import connections
 from elasticsearch import TransportError, Elasticsearch
+from elasticsearch.helpers import scan
 from designsafe.libs.elasticsearch.analyzers import path_analyzer
+from designsafe.libs.elasticsearch.bulk import BulkIndexer
+from designsafe.libs.elasticsearch.cache import bump_generation
 
 #pylint: disable=invalid-name
 logger = logging.getLogger(__name__)
@@ -38,3 +44,540 @@ def reindex(from_index, from_doc_type, to_index, to_doc_type,
         request_timeout=120)
     resp = es_local.reindex(body=body, request_timeout=request_timeout)
     logger.debug(resp)
+
+def file_doc_id(system, path, seq=0):
+    """Returns the id a file's document is created with.
+
+    Ids are the sha256 hex digest of the system id and the file's full path
+    (`path` + `name`), so creating the same file twice always hits the same
+    document. Ids are assigned once: a moved document keeps its id, use
+    :func:`new_file_doc_ids` to get the id of a new document.
+
+    :param str system: system id
+    :param str path: full path of the file, relative to the system's root
+    :param int seq: position in the path's sequence of ids, used when
+        the previous ones are held by documents moved away from `path`
+
+    :returns: document id
+    :rtype: str
+
+    >>> file_doc_id('designsafe.storage.default', 'username/file.txt')
+    """
+    path = os.path.normpath(path or '/').strip('/')
+    if isinstance(path, bytes):
+        path = path.decode('utf-8')
+    key = '{}/{}'.format(system, path)
+    if seq:
+        key = '{}#{}'.format(key, seq)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _source_path(source):
+    """Returns the full path of a file document's `_source`"""
+    return os.path.join(source.get('path') or '', source.get('name') or '').strip('/')
+
+
+def new_file_doc_ids(index, doc_type, system, full_paths, routed=False,
+                     using='default'):
+    """Returns the ids to create the documents of new files with.
+
+    A file's id is :func:`file_doc_id` of its path, unless a document
+    moved away from that path still holds it. The next id of the path's
+    sequence is tried then, so a new file never overwrites a moved one.
+    Costs one `mget` for every position of the sequence tried.
+
+    :param str index: index (or alias) the documents are created in
+    :param str doc_type: document type
+    :param str system: system id
+    :param list full_paths: full paths of the new files
+    :param bool routed: if `True` documents are routed with
+        :func:`file_routing`
+    :param str using: connection alias to use
+
+    :returns: ids by full path, without leading or trailing slashes
+    :rtype: dict
+    """
+    client = connections.get_connection(using)
+    ids = {}
+    pending = dict((os.path.normpath(path or '/').strip('/'), 0)
+                   for path in full_paths)
+    while pending:
+        paths = sorted(pending)
+        docs = []
+        for path in paths:
+            doc = {'_index': index,
+                   '_type': doc_type,
+                   '_id': file_doc_id(system, path, seq=pending[path]),
+                   '_source': ['path', 'name']}
+            if routed:
+                doc.update(routing_meta(file_routing(system, path)))
+            docs.append(doc)
+        resp = client.mget(body={'docs': docs})
+        taken = {}
+        for path, doc in zip(paths, resp['docs']):
+            if doc.get('found') and _source_path(doc['_source']) != path:
+                taken[path] = pending[path] + 1
+            else:
+                ids[path] = doc['_id']
+        pending = taken
+    return ids
+
+
+def new_file_doc_id(index, doc_type, system, path, routed=False, using='default'):
+    """Returns the id to create the document of a new file with,
+    see :func:`new_file_doc_ids`."""
+    ids = new_file_doc_ids(index, doc_type, system, [path], routed=routed,
+                           using=using)
+    return list(ids.values())[0]
+
+
+#: Painless script rewriting the `path` prefix of file documents.
+#: Paths equal to `params.path` or under it are moved under `params.dest_path`.
+#: If `params.agave_path` is set `agavePath` is rebuilt as well.
+PATH_PREFIX_SCRIPT = (
+    "String path = ctx._source.path;"
+    "if (path == params.path || path.startsWith(params.path + '/')) {"
+    "  ctx._source.path = params.dest_path + path.substring(params.path.length());"
+    "  if (params.agave_path) {"
+    "    ctx._source.agavePath = 'agave://' + params.system + '/' +"
+    "      ctx._source.path + '/' + ctx._source.name;"
+    "  }"
+    "} else {"
+    "  ctx.op = 'noop';"
+    "}"
+)
+
+#: Same as :data:`PATH_PREFIX_SCRIPT` for `_reindex`. The copies' `_id` is
+#: cleared so ES generates a new one instead of overwriting the originals,
+#: and their `_routing` is set to `params.routing` when `params.routed` is set.
+PATH_PREFIX_COPY_SCRIPT = (
+    "ctx._id = null;"
+    "if (params.routed) {"
+    "  ctx._routing = params.routing;"
+    "}" + PATH_PREFIX_SCRIPT
+)
+
+
+def path_prefix_query(system_field, system, path):
+    """Returns a query matching every file document under a path.
+
+    :param str system_field: field holding the system id,
+        e.g. `system._exact` or `systemId`
+    :param str system: system id
+    :param str path: path of the folder, relative to the system's root
+    """
+    return {
+        'bool': {
+            'filter': [
+                {'term': {system_field: system}},
+                {'term': {'path._path': path.strip('/')}}
+            ]
+        }
+    }
+
+
+def path_prefix_update_body(system_field, system, path, dest_path, agave_path=False):
+    """Returns an `update_by_query` body moving every document under a path.
+
+    :param str system_field: field holding the system id
+    :param str system: system id
+    :param str path: current path of the folder
+    :param str dest_path: new path of the folder
+    :param bool agave_path: if `True` rebuild `agavePath`, only for
+        documents which have it.
+    """
+    return {
+        'query': path_prefix_query(system_field, system, path),
+        'script': {
+            'lang': 'painless',
+            'inline': PATH_PREFIX_SCRIPT,
+            'params': {
+                'system': system,
+                'path': path.strip('/'),
+                'dest_path': dest_path.strip('/'),
+                'agave_path': agave_path
+            }
+        }
+    }
+
+
+def _path_prefix_count(client, index, query):
+    return client.count(index=index, body={'query': query})['count']
+
+
+def delete_path_prefix(index, system_field, system, path, using='default'):
+    """Deletes every document under a path with `delete_by_query`.
+
+    Only the descendants are deleted, not the folder's own document.
+    The deletion runs in the background, use :func:`wait_for_task` with
+    `index` to wait for it. Searches cached while it runs are only
+    invalidated once it completes, use the
+    :func:`~designsafe.apps.api.tasks.bump_generation_on_completion` task
+    when not waiting.
+
+    :param str index: index (or alias) to delete from
+    :param str system_field: field holding the system id
+    :param str system: system id
+    :param str path: path of the folder
+    :param str using: connection alias to use
+
+    :returns: `(task_id, total)` ES task id and number of documents
+        matched when the task was sent
+    :rtype: tuple
+    """
+    client = connections.get_connection(using)
+    query = path_prefix_query(system_field, system, path)
+    total = _path_prefix_count(client, index, query)
+    if not total:
+        return None, 0
+    resp = client.delete_by_query(index=index, body={'query': query},
+                                  conflicts='proceed',
+                                  wait_for_completion=False)
+    bump_generation(index)
+    logger.debug('Deleting %d documents under %s/%s. Task: %s',
+                 total, system, path, resp['task'])
+    return resp['task'], total
+
+
+def copy_path_prefix(index, system_field, system, path, dest_path,
+                     agave_path=False, routed=False, using='default'):
+    """Copies every document under a path to `dest_path` with `_reindex`.
+
+    Only the descendants are copied, not the folder's own document.
+    The copies are written once, with ids generated by ES and, if `routed`,
+    the routing of `dest_path`. The copy runs in the background, use
+    :func:`wait_for_task` to wait for it, the
+    :func:`~designsafe.apps.api.tasks.copy_path_prefix` task does.
+
+    :param str index: index (or alias) to copy in
+    :param str system_field: field holding the system id
+    :param str system: system id
+    :param str path: path of the folder to copy
+    :param str dest_path: path of the copy
+    :param bool agave_path: rebuild `agavePath`
+    :param bool routed: route the copies with :func:`file_routing`
+    :param str using: connection alias to use
+
+    :returns: `(task_id, total)` ES task id and number of documents
+        matched when the task was sent
+    :rtype: tuple
+    """
+    client = connections.get_connection(using)
+    query = path_prefix_query(system_field, system, path)
+    total = _path_prefix_count(client, index, query)
+    if not total:
+        return None, 0
+    body = path_prefix_update_body(system_field, system, path, dest_path,
+                                   agave_path=agave_path)
+    body['script']['inline'] = PATH_PREFIX_COPY_SCRIPT
+    body['script']['params'].update(routed=routed,
+                                    routing=file_routing(system, dest_path))
+    body = {
+        'source': {'index': index, 'query': body['query']},
+        'dest': {'index': index},
+        'script': body['script']
+    }
+    resp = client.reindex(body=body, wait_for_completion=False)
+    bump_generation(index)
+    logger.debug('Copying %d documents under %s/%s to %s. Task: %s',
+                 total, system, path, dest_path, resp['task'])
+    return resp['task'], total
+
+
+def file_routing(system, path, enabled=None):
+    """Returns the custom routing key of a file document.
+
+    When ``settings.ES_FILES_ROUTING`` is enabled the files in a user's
+    home folder are routed by the username and the files of a project by
+    the project's system, so queries scoped to one home folder or project
+    hit a single shard. Any other file uses the default routing.
+
+    :param str system: system id
+    :param str path: full path of the file, or of a folder to query under
+    :param bool enabled: overrides ``settings.ES_FILES_ROUTING``
+
+    :returns: routing key, `None` for the default routing
+    :rtype: str
+    """
+    if enabled is None:
+        enabled = getattr(settings, 'ES_FILES_ROUTING', False)
+    if not enabled:
+        return None
+    if system == settings.AGAVE_STORAGE_SYSTEM:
+        return (path or '').strip('/').split('/')[0] or None
+    if system and system.startswith('project-'):
+        return system
+    return None
+
+
+def routed(search, system, path):
+    """Routes a search scoped to one home folder or project to the
+    shard holding it, see :func:`file_routing`.
+
+    :param search: :class:`elasticsearch_dsl.Search` instance
+    """
+    routing = file_routing(system, path)
+    if routing is None:
+        return search
+    return search.params(routing=routing)
+
+
+def routing_meta(routing):
+    """Returns the `_routing` entry of a bulk action, if any"""
+    return {'_routing': routing} if routing is not None else {}
+
+
+def reroute_path_prefix(index, system_field, system, path, using='default'):
+    """Moves every document under a path to its custom routing.
+
+    `update_by_query` can not change a document's `_routing`. When a
+    folder is moved to another home folder or project its descendants'
+    :func:`file_routing` changes, each of them is written again with
+    the new routing, keeping its id, and the old copy is deleted.
+    Documents already routed right are left alone.
+
+    :param str index: index (or alias) to reroute
+    :param str system_field: field holding the system id
+    :param str system: system id
+    :param str path: path of the folder whose descendants are rerouted
+    :param str using: connection alias to use
+
+    :returns: number of documents rerouted
+    :rtype: int
+    """
+    client = connections.get_connection(using)
+    client.indices.refresh(index=index)
+    rerouted = 0
+    bulk_indexer = BulkIndexer(using=using)
+    for hit in scan(client, index=index,
+                    query={'query': path_prefix_query(system_field, system, path)}):
+        routing = file_routing(system, _source_path(hit['_source']))
+        if hit.get('_routing') == routing:
+            continue
+
+        # Deleted first, both routing keys may land on the same shard.
+        action = {'_op_type': 'delete',
+                  '_index': hit['_index'],
+                  '_type': hit['_type'],
+                  '_id': hit['_id']}
+        action.update(routing_meta(hit.get('_routing')))
+        bulk_indexer.add(action)
+        action = {'_op_type': 'index',
+                  '_index': hit['_index'],
+                  '_type': hit['_type'],
+                  '_id': hit['_id'],
+                  '_source': hit['_source']}
+        action.update(routing_meta(routing))
+        bulk_indexer.add(action)
+        rerouted += 1
+
+    bulk_indexer.close()
+    if bulk_indexer.errors:
+        logger.error('%d bulk actions failed rerouting %s/%s',
+                     len(bulk_indexer.errors), system, path)
+    client.indices.refresh(index=index)
+    return rerouted
+
+
+def pems_principals(pems):
+    """Returns the users who can read and write a file.
+
+    :param list pems: permissions, as returned by `files.listPermissions`
+
+    :returns: `(readers, writers)` sorted lists of usernames
+    :rtype: tuple
+    """
+    readers = set()
+    writers = set()
+    for pem in pems or []:
+        if hasattr(pem, 'to_dict'):
+            pem = pem.to_dict()
+        permission = pem.get('permission') or {}
+        if not pem.get('username'):
+            continue
+        if permission.get('read'):
+            readers.add(pem['username'])
+        if permission.get('write'):
+            writers.add(pem['username'])
+    return sorted(readers), sorted(writers)
+
+
+def pems_fields(pems, explicit=None):
+    """Returns the `permissions`, `readers` and `writers` fields of a
+    file document, to be used on partial updates.
+
+    :param list pems: permissions, as returned by `files.listPermissions`
+    :param bool explicit: whether `pems` differ from the parent folder's,
+        stored as `explicitPems`. Left out when `None`, see
+        :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`.
+    """
+    readers, writers = pems_principals(pems)
+    fields = {'permissions': pems, 'readers': readers, 'writers': writers}
+    if explicit is not None:
+        fields['explicitPems'] = explicit
+    return fields
+
+
+def readers_filter(*usernames):
+    """Returns a filter matching the files readable by any of the users.
+
+    `readers` is a flat keyword array so this is a plain, cacheable
+    `terms` filter instead of a `nested` query on `permissions`.
+
+    >>> readers_filter('username', 'WORLD')
+    {'terms': {'readers': ['username', 'WORLD']}}
+    """
+    return {'terms': {'readers': list(usernames)}}
+
+
+#: Painless snippet setting `readers` and `writers` from `permissions`.
+#: See :func:`pems_principals`.
+PRINCIPALS_SCRIPT = (
+    "List readers = new ArrayList();"
+    "List writers = new ArrayList();"
+    "if (ctx._source.permissions != null) {"
+    "  for (def pem : ctx._source.permissions) {"
+    "    if (pem.permission == null || pem.username == null) { continue; }"
+    "    if (pem.permission.read == true && !readers.contains(pem.username)) {"
+    "      readers.add(pem.username);"
+    "    }"
+    "    if (pem.permission.write == true && !writers.contains(pem.username)) {"
+    "      writers.add(pem.username);"
+    "    }"
+    "  }"
+    "}"
+    "ctx._source.readers = readers;"
+    "ctx._source.writers = writers;"
+)
+
+#: Painless script setting the permissions of file documents.
+#: Entries of the users in `params.usernames` are replaced by `params.pems`.
+#: If `params.usernames` is `null` every entry is replaced.
+PEMS_SCRIPT = (
+    "List pems = ctx._source.permissions;"
+    "if (pems == null || params.usernames == null) {"
+    "  pems = new ArrayList();"
+    "} else {"
+    "  pems.removeIf(pem -> params.usernames.contains(pem.username));"
+    "}"
+    "pems.addAll(params.pems);"
+    "ctx._source.permissions = pems;"
+) + PRINCIPALS_SCRIPT
+
+
+def update_principals(index, missing_only=True, using='default'):
+    """Sets `readers` and `writers` of the documents of an index from
+    their `permissions` with `update_by_query`.
+
+    Used to fill in the fields of documents indexed before they existed.
+    The update runs in the background, use :func:`wait_for_task` with
+    `index` to wait for it.
+
+    :param str index: index (or alias) to update
+    :param bool missing_only: only update documents without `readers`
+    :param str using: connection alias to use
+
+    :returns: ES task id
+    :rtype: str
+    """
+    client = connections.get_connection(using)
+    query = {'match_all': {}}
+    if missing_only:
+        query = {'bool': {'must_not': [{'exists': {'field': 'readers'}}]}}
+    body = {
+        'query': query,
+        'script': {'lang': 'painless', 'inline': PRINCIPALS_SCRIPT}
+    }
+    resp = client.update_by_query(index=index, body=body, conflicts='proceed',
+                                  wait_for_completion=False)
+    bump_generation(index)
+    return resp['task']
+
+
+def update_path_prefix_pems(index, system_field, system, path, pems,
+                            usernames=None, exclude=None, filters=None,
+                            using='default'):
+    """Sets the permissions of every document under a path with
+    `update_by_query`.
+
+    Only the descendants are updated, not the folder's own document.
+    The update runs in the background, use :func:`wait_for_task` with
+    `index` to wait for it, or the
+    :func:`~designsafe.apps.api.tasks.bump_generation_on_completion` task
+    when not waiting.
+
+    :param str index: index (or alias) to update
+    :param str system_field: field holding the system id
+    :param str system: system id
+    :param str path: path of the folder
+    :param list pems: permissions, as returned by `files.listPermissions`
+    :param list usernames: if given only the entries of these users are
+        replaced, otherwise `pems` replaces every entry.
+    :param list exclude: queries matching documents not to update
+    :param list filters: queries every document to update must match,
+        e.g. :func:`readers_filter` of the user making the change
+    :param str using: connection alias to use
+
+    :returns: `(task_id, total)` ES task id and number of documents
+        matched when the task was sent
+    :rtype: tuple
+    """
+    client = connections.get_connection(using)
+    query = path_prefix_query(system_field, system, path)
+    if exclude:
+        query['bool']['must_not'] = exclude
+    if filters:
+        query['bool']['filter'] += filters
+    total = _path_prefix_count(client, index, query)
+    if not total:
+        return None, 0
+    body = {
+        'query': query,
+        'script': {
+            'lang': 'painless',
+            'inline': PEMS_SCRIPT,
+            'params': {'pems': pems, 'usernames': usernames}
+        }
+    }
+    resp = client.update_by_query(index=index, body=body, conflicts='proceed',
+                                  wait_for_completion=False)
+    bump_generation(index)
+    logger.debug('Updating permissions of %d documents under %s/%s. Task: %s',
+                 total, system, path, resp['task'])
+    return resp['task'], total
+
+
+def wait_for_task(task_id, progress=None, interval=None, index=None,
+                  using='default'):
+    """Waits for an ES task, e.g. an `update_by_query` sent with
+    `wait_for_completion=False`.
+
+    :param str task_id: task id returned by ES
+    :param progress: callable called with the task's status every time
+        it is polled
+    :param int interval: seconds between polls.
+        Default ``settings.ES_TRACKED_TASKS['poll_interval']``
+    :param str index: index (or alias) the task writes to. Its
+        generation is bumped once the task completes, see
+        :func:`~designsafe.libs.elasticsearch.cache.bump_generation`
+    :param str using: connection alias to use
+
+    :returns: the task's response, e.g. `total`, `updated`, `deleted`,
+        `version_conflicts`, `failures`
+    :rtype: dict
+    """
+    if interval is None:
+        interval = getattr(settings, 'ES_TRACKED_TASKS', {}).get('poll_interval', 1)
+    client = connections.get_connection(using)
+    while True:
+        resp = client.tasks.get(task_id=task_id)
+        status = resp.get('task', {}).get('status', {})
+        if progress is not None:
+            progress(status)
+        if resp.get('completed'):
+            if 'error' in resp:
+                logger.error('ES task %s failed: %s', task_id, resp['error'])
+            if index is not None:
+                bump_generation(index)
+            return resp.get('response', status)
+        time.sleep(interval)
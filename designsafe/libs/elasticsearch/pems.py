@@ -0,0 +1,191 @@
+"""
+.. module: designsafe.libs.elasticsearch.pems
+   :synopsis: Propagates file permissions down indexed subtrees.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+import os
+from elasticsearch.helpers import scan
+from elasticsearch_dsl.connections import connections
+from designsafe.libs.elasticsearch.docs import (path_prefix_query,
+                                                pems_fields,
+                                                update_path_prefix_pems,
+                                                wait_for_task)
+from designsafe.libs.elasticsearch.cache import bump_generation
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+def _depth(path):
+    path = path.strip('/')
+    return len(path.split('/')) if path else 0
+
+
+def pems_key(pems):
+    """Returns a comparable representation of a permissions list.
+
+    Only the username and the read, write and execute flags are compared.
+    """
+    key = set()
+    for pem in pems or []:
+        permission = pem.get('permission') or {}
+        key.add((pem.get('username'),
+                 bool(permission.get('read')),
+                 bool(permission.get('write')),
+                 bool(permission.get('execute'))))
+    return frozenset(key)
+
+
+def explicit_pems(pems, parent_pems):
+    """Returns whether a file's permissions differ from its parent
+    folder's, see :func:`pems_key`."""
+    return pems_key(pems) != pems_key(parent_pems)
+
+
+class PermissionsPropagator(object):
+    """Indexes the permissions of a subtree with as few Agave calls as possible.
+
+    Agave applies permissions recursively, so every file in a subtree has
+    the permissions of the subtree's root unless it carries explicit ACLs.
+    The indexers flag the documents which permissions differ from their
+    parent folder's with `explicitPems`. Instead of calling
+    `files.listPermissions` and saving every document, :meth:`propagate`:
+
+        1. lists the permissions of the subtree's root once and sets them
+            on every descendant with one scripted `update_by_query`
+            over `path._path`.
+        2. calls `files.listPermissions` only for the flagged documents,
+            top to bottom. A document which permissions still differ from
+            the ones it inherits repeats 1. for its subtree, any other
+            document loses the flag.
+
+    :param str index: index (or alias) holding the documents
+    :param str system_field: field holding the system id,
+        `system._exact` for IndexedFile and `systemId` for Object
+    :param list_pems: callable returning the permissions of a file.
+        It is called with `(system, path)`.
+    :param list exclude: queries matching documents which must not
+        be updated
+    :param str using: connection alias to use
+    """
+    def __init__(self, index, system_field, list_pems, exclude=None,
+                 using='default'):
+        self.index = index
+        self.system_field = system_field
+        self.list_pems = list_pems
+        self.exclude = exclude or []
+        self.using = using
+
+    @property
+    def client(self):
+        """ES client"""
+        return connections.get_connection(self.using)
+
+    def _root_hit(self, system, path):
+        parent, name = os.path.split(path.strip('/'))
+        query = {'bool': {'filter': [
+            {'term': {self.system_field: system}},
+            {'term': {'path._exact': parent or '/'}},
+            {'term': {'name._exact': name}}
+        ]}}
+        res = self.client.search(index=self.index,
+                                 body={'query': query, 'size': 1},
+                                 _source=['path', 'name', 'permissions'])
+        hits = res['hits']['hits']
+        return hits[0] if hits else None
+
+    def explicit_nodes(self, system, path):
+        """Returns the documents under a path flagged with `explicitPems`.
+
+        Only the flagged documents are read, not the whole subtree.
+
+        :param str system: system id
+        :param str path: path of the subtree's root
+
+        :returns: hits sorted from the top of the subtree to the bottom
+        :rtype: list
+        """
+        query = path_prefix_query(self.system_field, system, path)
+        query['bool']['filter'].append({'term': {'explicitPems': True}})
+        if self.exclude:
+            query['bool']['must_not'] = self.exclude
+        hits = scan(self.client, index=self.index, query={'query': query},
+                    _source=['path', 'name'])
+        return sorted(hits, key=lambda hit: _depth(hit['_source']['path']))
+
+    @staticmethod
+    def _inherited(inherited, path):
+        """Returns the permissions set on a folder's children by the
+        nearest ancestor propagated so far"""
+        path = path.strip('/')
+        while path not in inherited:
+            path = os.path.dirname(path)
+        return inherited[path]
+
+    def apply(self, system, path, pems, hit=None, explicit=None):
+        """Sets the permissions of a file and every file under it.
+
+        :param str system: system id
+        :param str path: full path of the file
+        :param list pems: permissions to set
+        :param dict hit: the file's document hit, if already known
+        :param bool explicit: `explicitPems` flag of the file's document,
+            left as is when `None`. Descendants keep their flag.
+
+        :returns: number of documents updated
+        :rtype: int
+        """
+        cnt = 0
+        if hit is not None:
+            cnt += self.apply_document(hit, pems, explicit=explicit)
+        task_id, total = update_path_prefix_pems(self.index, self.system_field,
+                                                 system, path, pems,
+                                                 exclude=self.exclude,
+                                                 using=self.using)
+        if task_id is not None:
+            result = wait_for_task(task_id, index=self.index, using=self.using)
+            cnt += result.get('updated', total)
+        else:
+            bump_generation(self.index)
+        return cnt
+
+    def propagate(self, system, path):
+        """Indexes the permissions of every file under a path.
+
+        :param str system: system id
+        :param str path: path of the subtree's root
+
+        :returns: `(updated, pems_calls)` number of documents updated
+            and of `files.listPermissions` calls made
+        :rtype: tuple
+        """
+        root = self._root_hit(system, path)
+        explicit = self.explicit_nodes(system, path)
+
+        updated = 0
+        pems_calls = 1
+        root_pems = self.list_pems(system, path)
+        updated += self.apply(system, path, root_pems, hit=root)
+        inherited = {path.strip('/'): root_pems}
+        for hit in explicit:
+            source = hit['_source']
+            node_path = os.path.join(source['path'], source['name'])
+            pems = self.list_pems(system, node_path)
+            pems_calls += 1
+            if explicit_pems(pems, self._inherited(inherited, source['path'])):
+                inherited[node_path.strip('/')] = pems
+                updated += self.apply(system, node_path, pems, hit=hit,
+                                      explicit=True)
+            else:
+                updated += self.apply_document(hit, pems, explicit=False)
+        logger.debug('Permissions of %s/%s: %d documents updated, '
+                     '%d listPermissions calls', system, path, updated, pems_calls)
+        return updated, pems_calls
+
+    def apply_document(self, hit, pems, explicit=None):
+        """Sets the permissions of a single document"""
+        self.client.update(index=hit['_index'], doc_type=hit['_type'],
+                           id=hit['_id'], routing=hit.get('_routing'),
+                           body={'doc': pems_fields(pems, explicit=explicit)})
+        return 1
@@ -0,0 +1,69 @@
+"""
+.. module: designsafe.libs.elasticsearch.projections
+   :synopsis: `_source` projections of listings and searches.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+#: Preset of one level listings, only the fields a listing renders.
+LISTING = 'listing'
+#: Preset of search results.
+SEARCH = 'search'
+#: Preset of a single document's view, usually the whole `_source`.
+DETAIL = 'detail'
+
+
+def source_filter(presets, preset):
+    """Returns the `_source` filter of a preset.
+
+    Document classes declare their presets in a `SOURCE_PRESETS`
+    dictionary mapping every preset name to a filter, e.g.
+    `{'include': ['name', 'path']}`, or to `None` to fetch the whole
+    `_source`.
+
+    :param dict presets: presets of a document class
+    :param str preset: preset name, `None` for the whole `_source`
+
+    :returns: `_source` filter, `None` for the whole `_source`
+    :rtype: dict
+    :raises ValueError: if the preset is unknown
+    """
+    if preset is None:
+        return None
+    try:
+        return presets[preset]
+    except KeyError:
+        raise ValueError('Unknown projection: {}'.format(preset))
+
+
+def merge_filters(*filters):
+    """Returns a filter fetching the fields of every filter given.
+
+    Used when one search reads several indices, e.g. publications.
+    Only `include` filters are merged, `None` wins over any filter.
+    """
+    include = []
+    for _filter in filters:
+        if _filter is None or 'include' not in _filter:
+            return None
+        include += [field for field in _filter['include'] if field not in include]
+    return {'include': include}
+
+
+def apply_projection(search, presets, preset):
+    """Fetches only the `_source` fields of a preset.
+
+    :param search: :class:`elasticsearch_dsl.Search` instance
+    :param dict presets: presets of the searched document class
+    :param str preset: preset name, `None` for the whole `_source`
+
+    :raises ValueError: if the preset is unknown
+    """
+    _filter = source_filter(presets, preset)
+    if _filter is None:
+        return search
+    return search.source(**_filter)
@@ -0,0 +1,90 @@
+"""
+.. module: designsafe.libs.elasticsearch.queries
+   :synopsis: Query builders shared by the search views.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+from elasticsearch_dsl.query import Q
+from designsafe.libs.elasticsearch.analyzers import NGRAM_MIN, NGRAM_MAX
+
+#pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+#pylint: enable=invalid-name
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+def substring_term_query(term, fields):
+    """Matches documents where any of `fields` contains `term`.
+
+    Uses the `_ngram` subfield of every field (see
+    :data:`~designsafe.libs.elasticsearch.analyzers.ngram_analyzer`).
+    Terms shorter than
+    :data:`~designsafe.libs.elasticsearch.analyzers.NGRAM_MIN` or longer
+    than :data:`~designsafe.libs.elasticsearch.analyzers.NGRAM_MAX` are not
+    indexed as n-grams and fall back to a `*term*` wildcard on the field
+    and on its `_exact` subfield. The analyzed field only holds lowercased
+    words so it is searched with the lowercased term, e.g. `*shake*`.
+    `_exact` holds the whole value as it was indexed so it is searched with
+    the term as typed, which also matches terms the analyzer splits,
+    e.g. `*Shake-Table_2018*`.
+
+    :param str term: term to look for
+    :param list fields: fields with `_ngram` and `_exact` subfields,
+        e.g. `['name']`
+    """
+    if NGRAM_MIN <= len(term) <= NGRAM_MAX:
+        queries = [Q('match', **{'{}._ngram'.format(field): term.lower()})
+                   for field in fields]
+    else:
+        queries = []
+        for field in fields:
+            queries.append(Q('wildcard', **{field: '*{}*'.format(term.lower())}))
+            queries.append(Q('wildcard', **{'{}._exact'.format(field): '*{}*'.format(term)}))
+    if len(queries) == 1:
+        return queries[0]
+    return Q('bool', should=queries, minimum_should_match=1)
+
+
+def substring_query(query_string, fields, default_operator='or'):
+    """Builds a substring search from a user's query string.
+
+    This is the n-gram counterpart of rewriting every term in
+    `query_string` to `*term*` and sending it as a `query_string` query.
+    `AND`, `OR` and `NOT` are supported, `AND` binds tighter than `OR`.
+
+    :param str query_string: user's query, e.g. `'shake AND table NOT old'`
+    :param list fields: fields with an `_ngram` subfield
+    :param str default_operator: operator used between two terms
+        without an explicit operator, `'or'` or `'and'`
+
+    :returns: a `bool` query
+    """
+    groups = []
+    must_not = []
+    operator = None
+    negate = False
+    for token in (query_string or '').split():
+        upper = token.upper()
+        if upper in ('AND', 'OR'):
+            operator = upper
+            continue
+        if upper == 'NOT':
+            negate = True
+            continue
+
+        query = substring_term_query(token, fields)
+        if negate:
+            must_not.append(query)
+        elif (operator or default_operator.upper()) == 'OR' or not groups:
+            groups.append([query])
+        else:
+            groups[-1].append(query)
+        operator = None
+        negate = False
+
+    should = [Q('bool', must=group) if len(group) > 1 else group[0]
+              for group in groups]
+    if not should:
+        return Q('bool', must=[Q('match_all')], must_not=must_not)
+    return Q('bool', should=should, minimum_should_match=1, must_not=must_not)
@@ -0,0 +1,352 @@
+from django.test import TestCase, override_settings
+from django.conf import settings
+import mock
+
+
+class DocIdTestCase(TestCase):
+    """Tests for file document ids and routing"""
+
+    def test_file_doc_id(self):
+        from designsafe.libs.elasticsearch.docs import file_doc_id
+        doc_id = file_doc_id('designsafe.storage.default', 'ds_user/a/file.txt')
+        self.assertEqual(doc_id, file_doc_id('designsafe.storage.default',
+                                             '/ds_user//a/file.txt/'))
+        self.assertNotEqual(doc_id, file_doc_id('designsafe.storage.community',
+                                                'ds_user/a/file.txt'))
+        self.assertEqual(len(doc_id), 64)
+
+    @override_settings(AGAVE_STORAGE_SYSTEM='designsafe.storage.default')
+    def test_file_routing(self):
+        from designsafe.libs.elasticsearch.docs import file_routing
+        self.assertIsNone(file_routing('designsafe.storage.default', 'ds_user/a'))
+        with self.settings(ES_FILES_ROUTING=True):
+            self.assertEqual(file_routing('designsafe.storage.default',
+                                          '/ds_user/a/file.txt'), 'ds_user')
+            self.assertIsNone(file_routing('designsafe.storage.default', '/'))
+            self.assertEqual(file_routing('project-1234', 'a/file.txt'),
+                             'project-1234')
+            self.assertIsNone(file_routing('designsafe.storage.community', 'a'))
+
+
+class PathPrefixTestCase(TestCase):
+    """Tests for the index-level recursive move, copy and delete"""
+
+    def test_update_body_rewrites_prefix(self):
+        from designsafe.libs.elasticsearch.docs import path_prefix_update_body
+        body = path_prefix_update_body('system._exact', 'designsafe.storage.default',
+                                       '/ds_user/a/', 'ds_user/b')
+        self.assertEqual(body['query']['bool']['filter'][1],
+                         {'term': {'path._path': 'ds_user/a'}})
+        self.assertEqual(body['script']['params']['path'], 'ds_user/a')
+        self.assertEqual(body['script']['params']['dest_path'], 'ds_user/b')
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_delete_path_prefix(self, mock_connections):
+        from designsafe.libs.elasticsearch.docs import delete_path_prefix
+        client = mock_connections.get_connection.return_value
+        client.count.return_value = {'count': 42}
+        client.delete_by_query.return_value = {'task': 'node:1'}
+
+        task_id, total = delete_path_prefix('des-files', 'system._exact',
+                                            'designsafe.storage.default', 'ds_user/a')
+
+        self.assertEqual((task_id, total), ('node:1', 42))
+        args, kwargs = client.delete_by_query.call_args
+        self.assertEqual(kwargs['index'], 'des-files')
+        self.assertFalse(kwargs['wait_for_completion'])
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_delete_path_prefix_empty_folder(self, mock_connections):
+        from designsafe.libs.elasticsearch.docs import delete_path_prefix
+        client = mock_connections.get_connection.return_value
+        client.count.return_value = {'count': 0}
+
+        self.assertEqual(delete_path_prefix('des-files', 'system._exact',
+                                            'designsafe.storage.default', 'ds_user/a'),
+                         (None, 0))
+        client.delete_by_query.assert_not_called()
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.bump_generation')
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_wait_for_task_bumps_generation_on_completion(self, mock_connections,
+                                                          mock_bump):
+        from designsafe.libs.elasticsearch.docs import wait_for_task
+        client = mock_connections.get_connection.return_value
+        client.tasks.get.side_effect = [
+            {'completed': False, 'task': {'status': {'deleted': 1}}},
+            {'completed': True, 'response': {'deleted': 2}}]
+
+        result = wait_for_task('node:1', interval=0, index='des-files')
+
+        self.assertEqual(result, {'deleted': 2})
+        self.assertEqual(client.tasks.get.call_count, 2)
+        mock_bump.assert_called_once_with('des-files')
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_copy_path_prefix(self, mock_connections):
+        from designsafe.libs.elasticsearch.docs import (copy_path_prefix,
+                                                        PATH_PREFIX_COPY_SCRIPT)
+        client = mock_connections.get_connection.return_value
+        client.count.return_value = {'count': 3}
+        client.reindex.return_value = {'task': 'node:2'}
+
+        task_id, total = copy_path_prefix('designsafe', 'systemId',
+                                          'designsafe.storage.default',
+                                          'ds_user/a', 'ds_user/a_copy',
+                                          agave_path=True)
+
+        self.assertEqual((task_id, total), ('node:2', 3))
+        args, kwargs = client.reindex.call_args
+        body = kwargs['body']
+        self.assertEqual(body['source']['index'], 'designsafe')
+        self.assertEqual(body['dest']['index'], 'designsafe')
+        self.assertEqual(body['script']['inline'], PATH_PREFIX_COPY_SCRIPT)
+        self.assertEqual(body['script']['params']['dest_path'], 'ds_user/a_copy')
+        self.assertTrue(body['script']['params']['agave_path'])
+        self.assertFalse(body['script']['params']['routed'])
+        self.assertIn('ctx._id = null;', PATH_PREFIX_COPY_SCRIPT)
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.BulkIndexer')
+    @mock.patch('designsafe.libs.elasticsearch.docs.scan')
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_reroute_path_prefix(self, mock_connections, mock_scan, mock_bulk):
+        from designsafe.libs.elasticsearch.docs import reroute_path_prefix
+        mock_bulk.return_value.errors = []
+        system = 'designsafe.storage.default'
+        kept = {'_index': 'des-files_a', '_type': 'file', '_id': 'kept_id',
+                '_routing': 'ds_user',
+                '_source': {'path': 'ds_user/b', 'name': 'x'}}
+        moved = {'_index': 'des-files_a', '_type': 'file', '_id': 'moved_id',
+                 '_routing': 'other_user',
+                 '_source': {'path': 'ds_user/b', 'name': 'y'}}
+        mock_scan.return_value = iter([kept, moved])
+
+        with self.settings(ES_FILES_ROUTING=True, AGAVE_STORAGE_SYSTEM=system):
+            self.assertEqual(reroute_path_prefix('des-files', 'system._exact',
+                                                 system, 'ds_user/b'), 1)
+
+        actions = [c[0][0] for c in mock_bulk.return_value.add.call_args_list]
+        self.assertEqual(actions[0], {'_op_type': 'delete', '_index': 'des-files_a',
+                                      '_type': 'file', '_id': 'moved_id',
+                                      '_routing': 'other_user'})
+        self.assertEqual(actions[1]['_op_type'], 'index')
+        self.assertEqual(actions[1]['_id'], 'moved_id')
+        self.assertEqual(actions[1]['_routing'], 'ds_user')
+        self.assertEqual(len(actions), 2)
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_new_file_doc_ids(self, mock_connections):
+        from designsafe.libs.elasticsearch.docs import new_file_doc_ids, file_doc_id
+        system = 'designsafe.storage.default'
+        client = mock_connections.get_connection.return_value
+        client.mget.side_effect = [
+            {'docs': [{'_id': file_doc_id(system, 'ds_user/a'), 'found': False},
+                      {'_id': file_doc_id(system, 'ds_user/b'), 'found': True,
+                       '_source': {'path': 'ds_user/moved', 'name': 'b'}}]},
+            {'docs': [{'_id': file_doc_id(system, 'ds_user/b', seq=1), 'found': True,
+                       '_source': {'path': 'ds_user', 'name': 'b'}}]}]
+
+        ids = new_file_doc_ids('des-files', 'file', system, ['ds_user/a', '/ds_user/b'])
+
+        self.assertEqual(ids, {'ds_user/a': file_doc_id(system, 'ds_user/a'),
+                               'ds_user/b': file_doc_id(system, 'ds_user/b', seq=1)})
+        self.assertNotEqual(ids['ds_user/b'], file_doc_id(system, 'ds_user/b'))
+        self.assertEqual(client.mget.call_count, 2)
+
+    @mock.patch('designsafe.libs.elasticsearch.docs.connections')
+    def test_update_path_prefix_pems_filters(self, mock_connections):
+        from designsafe.libs.elasticsearch.docs import (update_path_prefix_pems,
+                                                        readers_filter)
+        client = mock_connections.get_connection.return_value
+        client.count.return_value = {'count': 2}
+        client.update_by_query.return_value = {'task': 'node:4'}
+
+        update_path_prefix_pems('des-files', 'system._exact', 'sys', 'ds_user/a',
+                                [], usernames=['other_user'],
+                                filters=[readers_filter('ds_user')])
+
+        query = client.update_by_query.call_args[1]['body']['query']
+        self.assertIn({'terms': {'readers': ['ds_user']}}, query['bool']['filter'])
+        self.assertEqual(client.count.call_args[1]['body']['query'], query)
+
+
+class PermissionsPropagatorTestCase(TestCase):
+    """Tests for :class:`~designsafe.libs.elasticsearch.pems.PermissionsPropagator`"""
+
+    @staticmethod
+    def _pems(*usernames):
+        return [{'username': username,
+                 'permission': {'read': True, 'write': True, 'execute': True}}
+                for username in usernames]
+
+    def _hit(self, path, name, pems):
+        return {'_index': 'des-files_a', '_type': 'file', '_id': name,
+                '_source': {'path': path, 'name': name, 'permissions': pems}}
+
+    @mock.patch('designsafe.libs.elasticsearch.pems.connections')
+    @mock.patch('designsafe.libs.elasticsearch.pems.wait_for_task')
+    @mock.patch('designsafe.libs.elasticsearch.pems.update_path_prefix_pems')
+    @mock.patch('designsafe.libs.elasticsearch.pems.scan')
+    def test_propagate_lists_only_explicit_nodes(self, mock_scan, mock_update,
+                                                 mock_wait, mock_connections):
+        from designsafe.libs.elasticsearch.pems import PermissionsPropagator
+        inherited = self._pems('ds_user')
+        explicit = self._pems('ds_user', 'other_user')
+        root = self._hit('ds_user', 'folder', inherited)
+        client = mock_connections.get_connection.return_value
+        client.search.return_value = {'hits': {'hits': [root]}}
+        mock_scan.return_value = iter([
+            self._hit('ds_user/folder/b', 'c', explicit),
+            self._hit('ds_user/folder', 'b', explicit),
+        ])
+        mock_update.side_effect = [('node:1', 4), ('node:2', 1)]
+        mock_wait.side_effect = [{'updated': 4}, {'updated': 1}]
+        list_pems = mock.MagicMock(side_effect=[inherited, explicit, explicit])
+
+        propagator = PermissionsPropagator('des-files', 'system._exact', list_pems)
+        updated, pems_calls = propagator.propagate('designsafe.storage.default',
+                                                   'ds_user/folder')
+
+        query = mock_scan.call_args[1]['query']['query']
+        self.assertIn({'term': {'explicitPems': True}}, query['bool']['filter'])
+        self.assertEqual(pems_calls, 3)
+        self.assertEqual([c[0][1] for c in list_pems.call_args_list],
+                         ['ds_user/folder', 'ds_user/folder/b', 'ds_user/folder/b/c'])
+        self.assertEqual(mock_update.call_count, 2)
+        self.assertEqual(mock_update.call_args_list[1][0][3], 'ds_user/folder/b')
+        flags = [(c[1]['id'], c[1]['body']['doc'].get('explicitPems'))
+                 for c in client.update.call_args_list]
+        self.assertEqual(flags, [('folder', None), ('b', True), ('c', False)])
+        self.assertEqual(updated, 8)
+
+    def test_explicit_pems(self):
+        from designsafe.libs.elasticsearch.pems import explicit_pems
+        pems = self._pems('ds_user')
+        self.assertFalse(explicit_pems(pems, self._pems('ds_user')))
+        self.assertTrue(explicit_pems(pems, self._pems('ds_user', 'other_user')))
+
+    def test_pems_principals(self):
+        from designsafe.libs.elasticsearch.docs import pems_principals, readers_filter
+        pems = self._pems('ds_user') + [
+            {'username': 'reader', 'permission': {'read': True, 'write': False}},
+            {'username': 'none', 'permission': {'read': False, 'write': False}}]
+        self.assertEqual(pems_principals(pems), (['ds_user', 'reader'], ['ds_user']))
+        self.assertEqual(readers_filter('ds_user', 'WORLD'),
+                         {'terms': {'readers': ['ds_user', 'WORLD']}})
+
+
+class SubstringQueryTestCase(TestCase):
+    """Tests for :func:`~designsafe.libs.elasticsearch.queries.substring_query`"""
+
+    def test_term_uses_ngram_subfield(self):
+        from designsafe.libs.elasticsearch.queries import substring_term_query
+        query = substring_term_query('Shake', ['name'])
+        self.assertEqual(query.to_dict(), {'match': {'name._ngram': 'shake'}})
+
+    def test_short_and_long_terms_use_wildcard(self):
+        from designsafe.libs.elasticsearch.queries import substring_term_query
+        self.assertEqual(substring_term_query('Ab', ['name']).to_dict(),
+                         {'bool': {'should': [{'wildcard': {'name': '*ab*'}},
+                                              {'wildcard': {'name._exact': '*Ab*'}}],
+                                   'minimum_should_match': 1}})
+
+    def test_long_term_matches_exact_name(self):
+        from designsafe.libs.elasticsearch.queries import substring_term_query
+        long_term = 'Shake-Table_Run.2018-01'
+        self.assertTrue(len(long_term) > 20)
+        query = substring_term_query(long_term, ['name', 'keywords']).to_dict()
+        self.assertEqual(query['bool']['should'], [
+            {'wildcard': {'name': '*shake-table_run.2018-01*'}},
+            {'wildcard': {'name._exact': '*Shake-Table_Run.2018-01*'}},
+            {'wildcard': {'keywords': '*shake-table_run.2018-01*'}},
+            {'wildcard': {'keywords._exact': '*Shake-Table_Run.2018-01*'}}])
+
+    def test_operators(self):
+        from designsafe.libs.elasticsearch.queries import substring_query
+        query = substring_query('shake AND table OR wall NOT old', ['name']).to_dict()
+        self.assertEqual(query['bool']['minimum_should_match'], 1)
+        self.assertEqual(query['bool']['should'], [
+            {'bool': {'must': [{'match': {'name._ngram': 'shake'}},
+                               {'match': {'name._ngram': 'table'}}]}},
+            {'match': {'name._ngram': 'wall'}}
+        ])
+        self.assertEqual(query['bool']['must_not'],
+                         [{'match': {'name._ngram': 'old'}}])
+
+    def test_default_operator_and(self):
+        from designsafe.libs.elasticsearch.queries import substring_query
+        query = substring_query('shake table', ['name'],
+                                default_operator='and').to_dict()
+        self.assertEqual(len(query['bool']['should']), 1)
+        self.assertEqual(len(query['bool']['should'][0]['bool']['must']), 2)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ES_SEARCH_CACHE={'enabled': True, 'cache': 'default', 'timeout': 30})
+class SearchCacheTestCase(TestCase):
+    """Tests for :class:`~designsafe.libs.elasticsearch.cache.SearchCache`"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        client_patcher = mock.patch(
+            'designsafe.libs.elasticsearch.cache.connections.get_connection')
+        self.client = client_patcher.start().return_value
+        self.client.search.return_value = {'hits': {'total': 0, 'hits': []}}
+        self.addCleanup(client_patcher.stop)
+
+    def _search(self):
+        from elasticsearch_dsl import Search
+        return Search(index='des-files').query('match', name='shake')[0:10]
+
+    def test_second_execute_is_a_hit(self):
+        from designsafe.libs.elasticsearch.cache import SearchCache
+        cache = SearchCache('files_search')
+        cache.execute(self._search(), scope='ds_user')
+        res = cache.execute(self._search(), scope='ds_user')
+        self.assertEqual(self.client.search.call_count, 1)
+        self.assertEqual(res.hits.total, 0)
+        self.assertEqual(cache.stats(), {'endpoint': 'files_search',
+                                         'hits': 1, 'misses': 1})
+
+    def test_scopes_are_cached_apart(self):
+        from designsafe.libs.elasticsearch.cache import SearchCache
+        cache = SearchCache('files_search')
+        cache.execute(self._search(), scope='ds_user')
+        cache.execute(self._search(), scope='other_user')
+        self.assertEqual(self.client.search.call_count, 2)
+
+    def test_bump_generation_invalidates(self):
+        from designsafe.libs.elasticsearch.cache import (SearchCache,
+                                                         bump_generation)
+        cache = SearchCache('files_search')
+        cache.execute(self._search())
+        bump_generation(settings.ES_INDICES['files']['name'])
+        cache.execute(self._search())
+        self.assertEqual(self.client.search.call_count, 2)
+
+
+class CursorTestCase(TestCase):
+    """Tests for :mod:`designsafe.libs.elasticsearch.cursor`"""
+
+    def test_round_trip(self):
+        from designsafe.libs.elasticsearch.cursor import encode_cursor, decode_cursor
+        cursor = encode_cursor([1.25, 'publication#PRJ-1234'])
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), [1.25, 'publication#PRJ-1234'])
+
+    def test_invalid_cursor(self):
+        from designsafe.libs.elasticsearch.cursor import decode_cursor
+        with self.assertRaises(ValueError):
+            decode_cursor('not a cursor')
+
+    def test_paginate(self):
+        from elasticsearch_dsl import Search
+        from designsafe.libs.elasticsearch.cursor import encode_cursor, paginate
+        search, _ = paginate(Search(), ['_score', {'_uid': 'asc'}], 10,
+                             encode_cursor([2.5, 'publication#1']))
+        body = search.to_dict()
+        self.assertEqual(body['size'], 10)
+        self.assertEqual(body['search_after'], [2.5, 'publication#1'])
+        self.assertEqual(body['sort'], ['_score', {'_uid': 'asc'}])
@@ -540,6 +540,32 @@ AGAVE_CLIENT_SECRET = os.environ.get('AGAVE_CLIENT_SECRET')
 AGAVE_TOKEN_SESSION_ID = os.environ.get('AGAVE_TOKEN_SESSION_ID', 'agave_token')
 AGAVE_SUPER_TOKEN = os.environ.get('AGAVE_SUPER_TOKEN')
 AGAVE_STORAGE_SYSTEM = os.environ.get('AGAVE_STORAGE_SYSTEM')
+#
+# Concurrent walk of Agave file systems done by the indexer.
+# max_user_concurrency caps the `files.list` calls in flight for a single user.
+AGAVE_INDEXER_WALK = {
+    'max_workers': int(os.environ.get('AGAVE_INDEXER_WALK_WORKERS', 8)),
+    'max_user_concurrency': int(os.environ.get('AGAVE_INDEXER_USER_CONCURRENCY', 4)),
+}
+#
+# inotify watcher on the mounted storage.
+# See designsafe.apps.data.managers.watcher
+AGAVE_MOUNT_WATCHER = {
+    'systems': ['designsafe.storage.default', 'designsafe.storage.community'],
+    'all_projects': True,
+    'quiet_period': int(os.environ.get('AGAVE_MOUNT_WATCHER_QUIET_PERIOD', 2)),
+    'max_batch': int(os.environ.get('AGAVE_MOUNT_WATCHER_MAX_BATCH', 500)),
+}
+#
+# Debounced queue of reindex requests sent by file operations.
+# See designsafe.apps.data.managers.reindex_queue
+REINDEX_QUEUE = {
+    'host': os.environ.get('REINDEX_QUEUE_HOST', os.environ.get('WS_BACKEND_HOST')),
+    'port': os.environ.get('REINDEX_QUEUE_PORT', os.environ.get('WS_BACKEND_PORT')),
+    'db': os.environ.get('REINDEX_QUEUE_DB', os.environ.get('WS_BACKEND_DB')),
+    'quiet_period': int(os.environ.get('REINDEX_QUEUE_QUIET_PERIOD', 5)),
+    'max_delay': int(os.environ.get('REINDEX_QUEUE_MAX_DELAY', 60)),
+}
 
 AGAVE_JWT_PUBKEY = os.environ.get('AGAVE_JWT_PUBKEY')
 AGAVE_JWT_ISSUER = os.environ.get('AGAVE_JWT_ISSUER')
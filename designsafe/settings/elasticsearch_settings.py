@@ -64,6 +64,12 @@ ES_INDICES = {
                       {'name': 'eventType',
                        'class': 'designsafe.apps.rapid.models.RapidNHEventType'}]
     },
+    'usage': {
+        'name': 'des-usage_a',
+        'alias': ['des-usage'],
+        'documents': [{'name': 'usage',
+                       'class': 'designsafe.apps.data.models.elasticsearch.IndexedUsage'}]
+    },
     'projects': {
         'name': 'des-projects_a',
         'alias': ['des-projects'],
@@ -89,3 +95,39 @@ ES_INDICES = {
     #                   'class': 'designsafe.apps.workspace.models.elasticsearch.IndexedJob'}]
     #}
 }
+
+# Bulk writes done by the indexer. See designsafe.libs.elasticsearch.bulk
+# refresh can be False, True or 'wait_for'
+ES_BULK_INDEXING = {
+    'chunk_size': 500,
+    'flush_interval': 5,
+    'refresh': False,
+}
+
+# Long running ES tasks (update_by_query, delete_by_query, reindex)
+# tracked by celery tasks. See designsafe.libs.elasticsearch.docs.wait_for_task
+ES_TRACKED_TASKS = {
+    'poll_interval': 1,
+    'conflict_retries': 3,
+}
+
+# Route file documents by home folder owner or project system.
+# See designsafe.libs.elasticsearch.docs.file_routing. Existing documents
+# must be re-routed with `manage.py reroute_files_index` before enabling it.
+ES_FILES_ROUTING = False
+
+# Short lived cache of search responses. See designsafe.libs.elasticsearch.cache
+# cache is a key of CACHES, timeout is in seconds.
+ES_SEARCH_CACHE = {
+    'enabled': True,
+    'cache': 'default',
+    'timeout': 30,
+}
+
+# Storage usage rollups. See designsafe.apps.data.managers.usage
+# Reconciliation aggregates owners in `partitions` requests of
+# up to `partition_size` owners each.
+USAGE_ROLLUPS = {
+    'partitions': 10,
+    'partition_size': 10000,
+}